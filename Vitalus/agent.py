@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+"""
+Agent performing a batch of file operations on a remote host.
+
+This file is sent over ssh and run by the remote python3,
+so it must only depend on the standard library.
+The batch is read as JSON on stdin, results are written as JSON on stdout.
+
+A batch is a list of operations, for instance::
+
+    [{"op": "mkdir", "path": "/backup/job"},
+     {"op": "listdir", "path": "/backup/job"}]
+
+The result is a list with one item per operation::
+
+    [{"ok": true, "result": null},
+     {"ok": true, "result": ["2013-01-01_00h00m00s"]}]
+"""
+
+import os
+import sys
+import json
+import stat
+import errno
+import time
+import queue
+import shutil
+import base64
+import hashlib
+import sqlite3
+import threading
+
+# Catalog of the snapshots, in the directory of a job
+CATALOG = '.catalog.json'
+# Files removed between two pauses of op_purge()
+THROTTLE = 1000
+
+
+def op_mkdir(path):
+    """ mkdir -p path """
+    os.makedirs(path, exist_ok=True)
+
+
+def op_listdir(path):
+    """ List a directory, an empty list if it does not exist """
+    if not os.path.isdir(path):
+        return []
+    return os.listdir(path)
+
+
+def op_rename(src, dst):
+    """ Rename src to dst """
+    os.rename(src, dst)
+
+
+def set_metadata(path, uid=-1, gid=-1, mode=None, workers=4):
+    """
+    Equivalent to chown -R uid:gid path and chmod -R mode path,
+    without following symlinks.
+
+    The tree is walked with scandir by several threads, without recursion.
+    Entries which already have the owner and the mode are not changed,
+    and files with several links are changed only once.
+
+    :param path: path
+    :param uid: user ID, -1 to keep it
+    :param gid: group ID, -1 to keep it
+    :param mode: mode (e.g. 0o775), None to keep it
+    :param workers: number of threads
+    :returns: int -- number of changed entries
+    :raises: OSError -- the first error, once the walk is done
+    """
+    directories = queue.Queue()
+    lock = threading.Lock()
+    seen = set()
+    changed = [0]
+    errors = []
+
+    def update(entry_path, entry_stat):
+        """ Change an entry, return True if changed """
+        done = False
+        if ((uid != -1 and entry_stat.st_uid != uid) or
+                (gid != -1 and entry_stat.st_gid != gid)):
+            os.chown(entry_path, uid, gid, follow_symlinks=False)
+            done = True
+        if (mode is not None and not stat.S_ISLNK(entry_stat.st_mode) and
+                stat.S_IMODE(entry_stat.st_mode) != mode):
+            os.chmod(entry_path, mode)
+            done = True
+        return done
+
+    def scan(directory):
+        count = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    is_dir = stat.S_ISDIR(entry_stat.st_mode)
+                    if not is_dir and entry_stat.st_nlink > 1:
+                        # Hardlinks, e.g. rsync --link-dest
+                        key = (entry_stat.st_dev, entry_stat.st_ino)
+                        with lock:
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                    count += update(entry.path, entry_stat)
+                    if is_dir:
+                        # Changed before its content: it may have been unreadable
+                        directories.put(entry.path)
+                except OSError as e:
+                    errors.append(e)
+        with lock:
+            changed[0] += count
+
+    def worker():
+        while True:
+            directory = directories.get()
+            if directory is None:
+                break
+            try:
+                scan(directory)
+            except OSError as e:
+                errors.append(e)
+            finally:
+                directories.task_done()
+
+    changed[0] += update(path, os.lstat(path))
+    if os.path.isdir(path) and not os.path.islink(path):
+        directories.put(path)
+        threads = [threading.Thread(target=worker, daemon=True) for number in range(workers)]
+        for thread in threads:
+            thread.start()
+        directories.join()
+        for thread in threads:
+            directories.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return changed[0]
+
+
+def _rmtree(path, pause=0.):
+    """
+    rm -rf path, bottom-up.
+    Every THROTTLE files, sleep "pause" seconds to leave the disk to others.
+    If it fails, the mode is changed and removal is tried again.
+
+    :returns: bool -- True if removed
+    """
+    for attempt in range(2):
+        count = 0
+        try:
+            for root, dirs, files in os.walk(path, topdown=False):
+                for name in files:
+                    os.unlink(os.path.join(root, name))
+                    count += 1
+                    if pause and count % THROTTLE == 0:
+                        time.sleep(pause)
+                for name in dirs:
+                    child = os.path.join(root, name)
+                    if os.path.islink(child):
+                        os.unlink(child)
+                    else:
+                        os.rmdir(child)
+            os.rmdir(path)
+            return True
+        except OSError:
+            if attempt == 0:
+                try:
+                    set_metadata(path, mode=0o775)
+                except OSError:
+                    pass
+    return False
+
+
+def op_rmtree(paths):
+    """
+    Remove directories.
+
+    :returns: list of paths which could not be removed
+    """
+    return [path for path in paths if not _rmtree(path)]
+
+
+def op_trash(paths, trash):
+    """
+    Move directories to a trash directory (same filesystem),
+    they are deleted later by op_purge().
+
+    :returns: list of paths which could not be moved
+    """
+    if paths:
+        os.makedirs(trash, exist_ok=True)
+    failed = []
+    for path in paths:
+        name = os.path.basename(path)
+        destination = os.path.join(trash, name)
+        number = 0
+        while os.path.lexists(destination):
+            number += 1
+            destination = os.path.join(trash, '%s.%i' % (name, number))
+        try:
+            os.rename(path, destination)
+        except OSError:
+            failed.append(path)
+    return failed
+
+
+def op_purge(path, pause=0.):
+    """
+    Empty a trash directory.
+    Every THROTTLE files, sleep "pause" seconds to leave the disk to others.
+
+    :returns: list of paths which could not be removed
+    """
+    if not os.path.isdir(path):
+        return []
+    failed = []
+    for name in sorted(os.listdir(path)):
+        entry = os.path.join(path, name)
+        if os.path.islink(entry) or not os.path.isdir(entry):
+            os.unlink(entry)
+        elif not _rmtree(entry, pause):
+            failed.append(entry)
+    return failed
+
+
+def op_symlink(target, link):
+    """ Create (or replace) a symlink named link pointing to target """
+    if os.path.islink(link):
+        os.remove(link)
+    os.symlink(target, link)
+
+
+def op_catalog(path):
+    """
+    Return the snapshots recorded in the catalog of a job directory.
+
+    If the catalog is missing, unreadable or the directory was modified
+    since it was written, the snapshots are listed: those unknown
+    to the catalog have an unknown size and completion state (None).
+
+    :returns: dict -- entries (list of dict: name, time, complete, size,
+        sorted by name) and rebuilt (bool)
+    """
+    if not os.path.isdir(path):
+        return {'entries': [], 'rebuilt': False}
+    try:
+        with open(os.path.join(path, CATALOG)) as catalog_file:
+            catalog = json.load(catalog_file)
+        mtime, entries = catalog['mtime'], catalog['entries']
+    except (OSError, ValueError, KeyError, TypeError):
+        mtime, entries = None, []
+    if mtime == os.stat(path).st_mtime_ns:
+        return {'entries': entries, 'rebuilt': False}
+
+    known = {entry['name']: entry for entry in entries}
+    entries = []
+    with os.scandir(path) as listing:
+        for entry in listing:
+            # Skip the symlink 'last' and the catalog
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name in known:
+                entries.append(known[entry.name])
+            else:
+                entries.append({'name': entry.name,
+                                'time': entry.stat(follow_symlinks=False).st_mtime,
+                                'complete': None, 'size': None})
+    entries.sort(key=lambda entry: entry['name'])
+    return {'entries': entries, 'rebuilt': True}
+
+
+def op_write_catalog(path, entries):
+    """
+    Replace the catalog of a job directory (atomically).
+    The directory mtime is set to the one recorded in the catalog,
+    any later change in the directory makes the catalog stale.
+
+    :param entries: list of dict (name, time, complete, size)
+    """
+    # Even number of seconds: kept as is by all filesystems (FAT: 2s)
+    mtime = int(time.time()) // 2 * 2 * 10**9
+    temp = os.path.join(path, CATALOG + '.tmp')
+    with open(temp, 'w') as catalog_file:
+        json.dump({'mtime': mtime, 'entries': entries}, catalog_file)
+        catalog_file.flush()
+        os.fsync(catalog_file.fileno())
+    os.replace(temp, os.path.join(path, CATALOG))
+    os.utime(path, ns=(mtime, mtime))
+
+
+def op_statvfs(path):
+    """
+    Return the space of the filesystem containing path.
+    If path does not exist yet, its nearest existing parent is used.
+
+    :returns: dict -- free (bytes available to the user) and total
+    """
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    result = os.statvfs(path)
+    return {'free': result.f_bavail * result.f_frsize,
+            'total': result.f_blocks * result.f_frsize}
+
+
+def _usage_cache(cache):
+    """ Open the cache of op_usage() """
+    db = sqlite3.connect(cache, timeout=30)
+    db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+               'path TEXT PRIMARY KEY, mtime INTEGER, '
+               'size INTEGER, allocated INTEGER, files INTEGER, subdirs TEXT)')
+    # Regular files, counted once per inode: a file may be
+    # linked by a later snapshot while its directory is unchanged
+    db.execute('CREATE TABLE IF NOT EXISTS files ('
+               'dir TEXT, dev INTEGER, ino INTEGER, size INTEGER, allocated INTEGER)')
+    db.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+    return db
+
+
+def op_usage(path, cache=None):
+    """
+    Return the disk usage of a tree (du -s),
+    the files linked several times (snapshots) are counted once.
+
+    The totals of each directory are cached in a sqlite database
+    and used while the mtime of the directory is unchanged:
+    only the modified directories are read again.
+    A file modified in place is not detected (rsync renames files).
+
+    :param path: path
+    :param cache: sqlite database path, None for no cache
+    :returns: dict -- size (bytes), allocated (bytes on disk) and files
+    """
+    db = None
+    if cache is not None:
+        db = _usage_cache(cache)
+    root = os.lstat(path)
+    size, allocated, files = root.st_size, root.st_blocks * 512, 0
+    inodes = {}
+    visited = []
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        try:
+            mtime = os.lstat(directory).st_mtime_ns
+        except OSError:
+            continue
+        visited.append((directory,))
+        row = None
+        if db is not None:
+            row = db.execute('SELECT mtime, size, allocated, files, subdirs FROM dirs '
+                             'WHERE path = ?', (directory,)).fetchone()
+        if row is not None and row[0] == mtime:
+            dir_size, dir_allocated, dir_files, subdirs = row[1], row[2], row[3], json.loads(row[4])
+            regular = db.execute('SELECT dev, ino, size, allocated FROM files WHERE dir = ?',
+                                 (directory,)).fetchall()
+        else:
+            dir_size, dir_allocated, dir_files, subdirs, regular = 0, 0, 0, [], []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            entry_stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if stat.S_ISDIR(entry_stat.st_mode):
+                            subdirs.append(entry.name)
+                        elif stat.S_ISREG(entry_stat.st_mode):
+                            regular.append((entry_stat.st_dev, entry_stat.st_ino,
+                                            entry_stat.st_size, entry_stat.st_blocks * 512))
+                            dir_files += 1
+                            continue
+                        else:
+                            dir_files += 1
+                        dir_size += entry_stat.st_size
+                        dir_allocated += entry_stat.st_blocks * 512
+            except OSError:
+                pass
+            if db is not None:
+                db.execute('DELETE FROM files WHERE dir = ?', (directory,))
+                db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                               [(directory,) + entry for entry in regular])
+                db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)',
+                           (directory, mtime, dir_size, dir_allocated, dir_files,
+                            json.dumps(subdirs)))
+        for dev, ino, file_size, file_allocated in regular:
+            inodes[(dev, ino)] = (file_size, file_allocated)
+        size += dir_size
+        allocated += dir_allocated
+        files += dir_files
+        directories.extend(os.path.join(directory, name) for name in subdirs)
+    for file_size, file_allocated in inodes.values():
+        size += file_size
+        allocated += file_allocated
+
+    if db is not None:
+        # Forget the directories removed from the tree
+        db.execute('CREATE TEMP TABLE visited (path TEXT PRIMARY KEY)')
+        db.executemany('INSERT OR IGNORE INTO visited VALUES (?)', visited)
+        prefix = os.path.join(path, '')
+        for table, column in (('dirs', 'path'), ('files', 'dir')):
+            db.execute('DELETE FROM %s WHERE (%s = ? OR substr(%s, 1, ?) = ?) '
+                       'AND %s NOT IN (SELECT path FROM visited)' %
+                       (table, column, column, column),
+                       (path, len(prefix), prefix))
+        db.commit()
+        db.close()
+    return {'size': size, 'allocated': allocated, 'files': files}
+
+
+def op_link_tree(src, dst, skip=()):
+    """
+    Copy a tree with hardlinks (cp -al), as rsync --link-dest does
+    for unchanged files: the files are linked, the directories
+    and the symlinks are created with the same mode, owner and times.
+    A file with too many links is copied.
+
+    :param src: tree
+    :param dst: copy, created if needed
+    :param skip: paths relative to src not copied (a directory with its content)
+    :returns: int -- number of linked files
+    """
+    skip = set(skip)
+    os.makedirs(dst, exist_ok=True)
+    directories = [('', src, dst)]
+    linked = 0
+    for relative, source, destination in directories:
+        with os.scandir(source) as entries:
+            for entry in entries:
+                path = os.path.join(relative, entry.name)
+                if path in skip:
+                    continue
+                target = os.path.join(destination, entry.name)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target)
+                elif entry.is_dir():
+                    os.mkdir(target)
+                    directories.append((path, entry.path, target))
+                else:
+                    try:
+                        os.link(entry.path, target)
+                        linked += 1
+                    except OSError as e:
+                        if e.errno != errno.EMLINK:
+                            raise
+                        shutil.copy2(entry.path, target)
+    # The content of a directory changes its mtime: set it last
+    for relative, source, destination in reversed(directories):
+        shutil.copystat(source, destination)
+        source_stat = os.stat(source)
+        try:
+            os.chown(destination, source_stat.st_uid, source_stat.st_gid)
+        except OSError:
+            # Not root
+            pass
+    return linked
+
+
+def _entry_record(name, entry_stat):
+    """ Metadata of an entry hashed by op_fingerprint() """
+    return b'%s\0%o\0%i\0%i\0%i\0%i\0%i\n' % (
+        os.fsencode(name), entry_stat.st_mode, entry_stat.st_size, entry_stat.st_mtime_ns,
+        entry_stat.st_ino, entry_stat.st_uid, entry_stat.st_gid)
+
+
+def op_fingerprint(path, workers=4):
+    """
+    Return a fingerprint of a tree: a hash of the names, modes, sizes,
+    mtimes, inodes and owners of its entries, without reading the files.
+
+    The hash of a directory covers its entries and the hashes of its
+    subdirectories (Merkle tree): any change below the root changes it.
+    Symlinks are followed, as rsync -L does; a directory reached twice
+    is walked once. The tree is walked with scandir by several threads.
+
+    A file modified in place without changing its size and mtime
+    is not detected, as by the quick check of rsync.
+
+    :param path: path
+    :param workers: number of threads
+    :returns: dict -- digest (hex, None if an entry could not be read),
+        files and directories
+    """
+    directories = queue.Queue()
+    lock = threading.Lock()
+    seen = set()
+    # id: (hash of the files, [(record, id of the subdirectory)])
+    nodes = {}
+    counts = {'files': 0, 'directories': 0}
+    errors = []
+
+    def add_directory(directory, directory_stat):
+        """ Queue a directory, return its id, None if already walked """
+        with lock:
+            key = (directory_stat.st_dev, directory_stat.st_ino)
+            if key in seen:
+                return None
+            seen.add(key)
+            node = len(seen)
+        directories.put((node, directory))
+        return node
+
+    def scan(node, directory):
+        files = hashlib.sha256()
+        subdirectories = []
+        count = 0
+        with os.scandir(directory) as listing:
+            entries = sorted(listing, key=lambda entry: entry.name)
+        for entry in entries:
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                # Broken symlink
+                entry_stat = entry.stat(follow_symlinks=False)
+            record = _entry_record(entry.name, entry_stat)
+            if stat.S_ISDIR(entry_stat.st_mode):
+                subdirectories.append((record, add_directory(entry.path, entry_stat)))
+            else:
+                files.update(record)
+                count += 1
+        with lock:
+            nodes[node] = (files.digest(), subdirectories)
+            counts['files'] += count
+            counts['directories'] += 1
+
+    def worker():
+        while True:
+            item = directories.get()
+            if item is None:
+                break
+            try:
+                scan(*item)
+            except OSError as e:
+                errors.append(e)
+            finally:
+                directories.task_done()
+
+    root_stat = os.stat(path)
+    root = hashlib.sha256(_entry_record('', root_stat))
+    if stat.S_ISDIR(root_stat.st_mode):
+        add_directory(path, root_stat)
+        threads = [threading.Thread(target=worker, daemon=True) for number in range(workers)]
+        for thread in threads:
+            thread.start()
+        directories.join()
+        for thread in threads:
+            directories.put(None)
+        for thread in threads:
+            thread.join()
+        if errors:
+            return dict(counts, digest=None)
+        # A subdirectory has a larger id than its parent: hash the children first
+        digests = {}
+        for node in sorted(nodes, reverse=True):
+            files, subdirectories = nodes.pop(node)
+            digest = hashlib.sha256(files)
+            for record, child in subdirectories:
+                digest.update(record)
+                if child is not None:
+                    digest.update(digests.pop(child))
+            digests[node] = digest.digest()
+        root.update(digests[1])
+    else:
+        counts['files'] = 1
+    return dict(counts, digest=root.hexdigest())
+
+
+OPERATIONS = {'mkdir': op_mkdir,
+              'listdir': op_listdir,
+              'rename': op_rename,
+              'rmtree': op_rmtree,
+              'trash': op_trash,
+              'purge': op_purge,
+              'symlink': op_symlink,
+              'catalog': op_catalog,
+              'write_catalog': op_write_catalog,
+              'statvfs': op_statvfs,
+              'usage': op_usage,
+              'fingerprint': op_fingerprint,
+              'link_tree': op_link_tree,
+              }
+
+
+def execute(batch):
+    """
+    Execute a batch of operations.
+    An error does not stop the batch.
+
+    :param batch: list of operations
+    :returns: list of results
+    """
+    results = []
+    for operation in batch:
+        operation = dict(operation)
+        name = operation.pop('op')
+        try:
+            result = OPERATIONS[name](**operation)
+        except Exception as e:
+            results.append({'ok': False, 'error': '%s: %s' % (type(e).__name__, e)})
+        else:
+            results.append({'ok': True, 'result': result})
+    return results
+
+
+def remote_command():
+    """
+    Return the remote command running this agent.
+    The source is embedded in the command, stdin is left for the batch.
+
+    :returns: list
+    """
+    with open(os.path.abspath(__file__), 'rb') as agent:
+        source = base64.b64encode(agent.read()).decode('ascii')
+    # ssh gives the command to a shell: quote it
+    return ['python3', '-c',
+            "'import base64;exec(base64.b64decode(\"%s\"))'" % source]
+
+
+def main():
+    batch = json.load(sys.stdin)
+    json.dump(execute(batch), sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import sys
+import json
+import logging
+import datetime
+
+EVENTS = 'events.jsonl'
+
+# Status of the job_end events
+JOB_STATUS = ('success', 'partial', 'failed')
+
+
+class EventLog:
+    """
+    Append events to a JSON-lines file.
+
+    Each event has a date ('time'), a type ('event') and fields:
+
+    * run_start: version, jobs (names of the due jobs)
+    * run_end: status ('ok', 'cancelled', 'error'), duration (seconds)
+    * already_running: another instance holds the pidfile
+    * job_start: job, destination
+    * job_end: job, destination, status ('success', 'partial', 'failed'),
+      returncode, bytes, duration, phases, counters (subprocesses, ssh_roundtrips),
+      unchanged (source unchanged, rsync not run)
+    * mirror_end: job, destination, status
+    * error: job, message
+
+    Each event is written with a single write in append mode:
+    the lines of several processes are not mixed.
+
+    :param path: events file path
+    :type path: string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('Vitalus.EventLog')
+
+    def emit(self, event, **fields):
+        """
+        Write an event
+
+        :param event: event type
+        :type event: string
+        :param fields: values of the event, serializable in JSON
+        """
+        record = {'time': datetime.datetime.now().isoformat(), 'event': event}
+        record.update(fields)
+        line = json.dumps(record) + '\n'
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.logger.warning('Could not write the event %s: %s', event, e)
+
+
+def _new_day():
+    return {'runs': 0, 'ok': 0, 'cancelled': 0, 'error': 0,
+            'already_running': 0, 'jobs': {}, 'errors': {}}
+
+
+def _new_job():
+    job = {status: 0 for status in JOB_STATUS}
+    job.update({'unchanged': 0, 'mirrors_failed': 0, 'bytes': 0, 'duration': 0.})
+    return job
+
+
+class Summary:
+    """
+    Totals of the events per day, updated incrementally.
+
+    The totals are stored with the offset of the last event read
+    in path + '.summary.json': an update reads the new events only
+    and a report adds the totals of a few days,
+    whatever the size of the events file.
+
+    :param path: events file path
+    :type path: string
+    :param keep_days: the totals of the older days are dropped
+    :type keep_days: int
+    """
+    def __init__(self, path, keep_days=400):
+        self.path = path
+        self.summary_path = path + '.summary.json'
+        self.keep_days = keep_days
+        self.logger = logging.getLogger('Vitalus.Summary')
+        try:
+            with open(self.summary_path) as summary:
+                data = json.load(summary)
+        except (OSError, ValueError):
+            data = {'inode': None, 'offset': 0, 'days': {}}
+        self.inode = data['inode']
+        self.offset = data['offset']
+        self.days = data['days']
+
+    def _add(self, record):
+        """
+        Add an event to the totals of its day
+        """
+        day = self.days.setdefault(record['time'][:10], _new_day())
+        event = record['event']
+        if event == 'run_start':
+            day['runs'] += 1
+        elif event == 'run_end':
+            status = record.get('status', 'ok')
+            day[status] = day.get(status, 0) + 1
+        elif event == 'already_running':
+            day['already_running'] += 1
+        elif event == 'job_end':
+            job = day['jobs'].setdefault(record['job'], _new_job())
+            job[record['status']] += 1
+            if record.get('unchanged'):
+                job['unchanged'] += 1
+            job['bytes'] += record.get('bytes') or 0
+            job['duration'] += record.get('duration') or 0
+        elif event == 'mirror_end':
+            if record.get('status') != 'success':
+                job = day['jobs'].setdefault(record['job'], _new_job())
+                job['mirrors_failed'] += 1
+        elif event == 'error':
+            message = '%s: %s' % (record.get('job'), record.get('message'))
+            day['errors'][message] = day['errors'].get(message, 0) + 1
+
+    def update(self):
+        """
+        Read the events written since the last update
+
+        :returns: int -- number of events read
+        """
+        try:
+            events = open(self.path, 'rb')
+        except FileNotFoundError:
+            return 0
+        count = 0
+        with events:
+            stat = os.fstat(events.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                # New or truncated file
+                self.inode = stat.st_ino
+                self.offset = 0
+            events.seek(self.offset)
+            data = events.read()
+        # The last line may be incomplete (being written)
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                self._add(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                self.logger.warning('Invalid event: %s', line)
+                continue
+            count += 1
+        self.offset += end
+
+        limit = (datetime.date.today() - datetime.timedelta(days=self.keep_days)).isoformat()
+        for day in [day for day in self.days if day < limit]:
+            del self.days[day]
+
+        with open(self.summary_path + '.tmp', 'w') as summary:
+            json.dump({'inode': self.inode, 'offset': self.offset, 'days': self.days}, summary)
+        os.replace(self.summary_path + '.tmp', self.summary_path)
+        return count
+
+    def report(self, days=1, today=None):
+        """
+        Return the totals of the last days
+
+        :param days: number of days, today included
+        :param today: last day of the report (default: today)
+        :type today: datetime.date
+        :returns: dict -- see the totals of a day
+        """
+        if today is None:
+            today = datetime.date.today()
+        total = _new_day()
+        for number in range(days):
+            day = self.days.get((today - datetime.timedelta(days=number)).isoformat())
+            if day is None:
+                continue
+            for key in ('runs', 'ok', 'cancelled', 'error', 'already_running'):
+                total[key] += day.get(key, 0)
+            for name, job in day['jobs'].items():
+                job_total = total['jobs'].setdefault(name, _new_job())
+                for key, value in job.items():
+                    job_total[key] += value
+            for message, count in day['errors'].items():
+                total['errors'][message] = total['errors'].get(message, 0) + count
+        return total
+
+
+def format_report(report):
+    """
+    Return a report of Summary.report() as text
+
+    :param report: dict
+    :returns: string
+    """
+    lines = ['Runs: %(runs)i (ok %(ok)i, cancelled %(cancelled)i, error %(error)i), '
+             'already running: %(already_running)i' % report]
+    if report['jobs']:
+        lines.append('Jobs:')
+        for name in sorted(report['jobs']):
+            job = report['jobs'][name]
+            line = '    %s: %i done, %i partial, %i failed, %.1f MB in %.0f s' % (
+                name, job['success'], job['partial'], job['failed'],
+                job['bytes'] / 1e6, job['duration'])
+            if job['unchanged']:
+                line += ' (%i unchanged)' % job['unchanged']
+            if job['mirrors_failed']:
+                line += ', %i mirror failures' % job['mirrors_failed']
+            lines.append(line)
+    if report['errors']:
+        lines.append('Errors:')
+        for message, count in sorted(report['errors'].items()):
+            lines.append('    %s: %i time(s)' % (message, count))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Print the summary of the last days:
+    python -m Vitalus.events [--days 7] ~/.backup/events.jsonl
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Summary of the Vitalus runs')
+    parser.add_argument('path', nargs='?', default=os.path.expanduser('~/.backup/' + EVENTS),
+                        help='events file')
+    parser.add_argument('--days', type=int, default=1, help='number of days')
+    args = parser.parse_args(argv)
+    summary = Summary(args.path)
+    summary.update()
+    print(format_report(summary.report(args.days)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
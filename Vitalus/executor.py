@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import asyncio
+import logging
+import contextlib
+
+
+def resource_keys(job):
+    """
+    Return the resources used by a job.
+
+    A resource is the destination host (or the local device
+    of the destination) and the source device (or the source host).
+
+    :param job: a job
+    :returns: dict -- {'host': key, 'device': key}
+    """
+    keys = {}
+    destination = getattr(job, 'destination', None)
+    if destination is not None:
+        if destination.is_ssh():
+            keys['host'] = 'ssh:' + destination.domain
+        else:
+            keys['host'] = 'local:' + _device(destination.path)
+    source = getattr(job, 'source', None)
+    if source is not None:
+        if source.is_ssh():
+            keys['device'] = 'ssh:' + source.domain
+        else:
+            keys['device'] = 'local:' + _device(source.path)
+    return keys
+
+
+def _device(path):
+    """
+    Return the device id of a path as a string.
+    If the path does not exist, the path itself is used.
+    """
+    try:
+        return str(os.stat(path).st_dev)
+    except OSError:
+        return path
+
+
+class JobExecutor:
+    """
+    Run jobs concurrently in an asyncio event loop.
+
+    Jobs writing to the same destination host or reading
+    from the same source device are limited to run concurrently.
+
+    :param max_workers: max number of jobs running at the same time
+    :type max_workers: int
+    :param host_limit: max number of jobs per destination host
+    :type host_limit: int
+    :param device_limit: max number of jobs per source device
+    :type device_limit: int
+
+    .. note::
+
+        Jobs providing a `run_async()` coroutine are run in the event loop.
+        Other jobs (custom jobs) are run with `run()` in a thread.
+        If :attr:`tracer` is set, the wait for the resources
+        and the run of each job are recorded.
+    """
+    tracer = None
+
+    def __init__(self, max_workers=1, host_limit=1, device_limit=1):
+        if max_workers < 1 or host_limit < 1 or device_limit < 1:
+            raise ValueError('Limits must be strictly positive')
+        self.max_workers = max_workers
+        self.limits = {'host': host_limit, 'device': device_limit}
+        self.logger = logging.getLogger('Vitalus.JobExecutor')
+
+    def _get_semaphores(self, job, semaphores):
+        """
+        Return the semaphores to acquire for a job,
+        sorted to avoid deadlocks.
+
+        :param semaphores: dict of the semaphores already created
+        """
+        keys = resource_keys(job)
+        job_semaphores = []
+        for kind, key in sorted(keys.items()):
+            name = (kind, key)
+            if name not in semaphores:
+                semaphores[name] = asyncio.Semaphore(self.limits[kind])
+            job_semaphores.append(semaphores[name])
+        return job_semaphores
+
+    async def _run_job(self, job, semaphores):
+        """
+        Run a single job, holding its resources.
+        Exceptions are logged, other jobs are not affected.
+        """
+        track = str(getattr(job, 'name', job))
+        if self.tracer is not None:
+            wait_start = self.tracer.now()
+        async with contextlib.AsyncExitStack() as stack:
+            for sem in semaphores:
+                await stack.enter_async_context(sem)
+            if self.tracer is not None:
+                self.tracer.complete('wait', track, wait_start, category='executor')
+                stack.enter_context(self.tracer.span('job', track, 'job'))
+            try:
+                if hasattr(job, 'run_async'):
+                    await job.run_async()
+                else:
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(None, job.run)
+            except Exception:
+                self.logger.exception('Exception raised in run() for job %s',
+                                      getattr(job, 'name', job))
+
+    async def run_async(self, jobs):
+        """
+        Run all jobs and wait for them (coroutine).
+
+        :param jobs: list of jobs
+        """
+        # Semaphores are bound to the running loop
+        semaphores = {}
+        workers = asyncio.Semaphore(self.max_workers)
+        tasks = []
+        for job in jobs:
+            # Take a worker only once the resources are available
+            job_semaphores = self._get_semaphores(job, semaphores) + [workers]
+            tasks.append(self._run_job(job, job_semaphores))
+        # If cancelled, gather cancels all the jobs
+        await asyncio.gather(*tasks)
+
+    def run(self, jobs):
+        """
+        Run all jobs and wait for them.
+
+        :param jobs: list of jobs
+        """
+        asyncio.run(self.run_async(jobs))
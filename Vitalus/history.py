@@ -16,12 +16,284 @@
 #
 # Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
 
-import os.path
+import re
+import array
+import bisect
+import calendar
 import logging
 import datetime
 
 logger = logging.getLogger('Vitalus.history')
 
+FORMAT = '%Y-%m-%d_%Hh%Mm%Ss'
+DAY_NAME = re.compile(r'(\d{4})-(\d\d)-(\d\d)')
+CLOCK_NAME = re.compile(r'_(\d\d)h(\d\d)m(\d\d)s')
+
+HOUR = 3600
+DAY = 86400
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def _timestamp(date):
+    """
+    Return the seconds since the epoch of a naive datetime,
+    in the same (timezone-free) scale as Snapshots.times
+    """
+    return calendar.timegm(date.timetuple())
+
+
+def _parse_day(day):
+    """
+    Return the seconds since the epoch of "%Y-%m-%d", None if invalid
+    """
+    match = DAY_NAME.fullmatch(day)
+    if match is None:
+        return None
+    try:
+        date = datetime.date(*(int(value) for value in match.groups()))
+    except ValueError:
+        return None
+    return (date.toordinal() - EPOCH) * DAY
+
+
+def _parse_clock(clock):
+    """
+    Return the seconds since midnight of "_%Hh%Mm%Ss", None if invalid
+    """
+    match = CLOCK_NAME.fullmatch(clock)
+    if match is None:
+        return None
+    hour, minute, second = (int(value) for value in match.groups())
+    if hour > 23 or minute > 59 or second > 61:
+        return None
+    return hour * HOUR + minute * 60 + second
+
+
+class Snapshots:
+    """
+    Snapshot names of a job, parsed once.
+
+    The names are sorted (the format sorts like the dates) and
+    their dates are stored in a compact array of seconds, so that
+    the selections are done by bisection.
+    Names not in the format "%Y-%m-%d_%Hh%Mm%Ss" (e.g. 'last') are ignored.
+
+    :param file_list: list of files
+    :attr names: sorted list of snapshot names
+    :attr times: array of seconds, same order
+    """
+    def __init__(self, file_list):
+        self.names = []
+        self.times = array.array('q')
+        # Snapshots share their days and, often, their time of the day:
+        # each part is parsed once
+        days = {}
+        clocks = {}
+        for name in sorted(file_list):
+            day = name[:10]
+            clock = name[10:]
+            if day not in days:
+                days[day] = _parse_day(day)
+            if clock not in clocks:
+                clocks[clock] = _parse_clock(clock)
+            if days[day] is None or clocks[clock] is None:
+                continue
+            self.names.append(name)
+            self.times.append(days[day] + clocks[clock])
+
+    def __len__(self):
+        return len(self.names)
+
+    def last(self):
+        """
+        Return the most recent snapshot, None if no snapshot
+
+        :returns: string
+        """
+        if self.names == []:
+            return None
+        return self.names[-1]
+
+    def older(self, days, now=None):
+        """
+        Return the snapshots older than "days"
+
+        :param days: snapshots older than this value are old
+        :param now: reference date (default: now)
+        :type now: datetime.datetime
+        :returns: sorted list
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        limit = _timestamp(now) - days * DAY
+        return self.names[:bisect.bisect_right(self.times, limit)]
+
+    def select(self, policy, now=None):
+        """
+        Apply a retention policy
+
+        :param policy: AgePolicy, GFSPolicy or LogarithmicPolicy
+        :param now: reference date (default: now)
+        :type now: datetime.datetime
+        :returns: tuple -- (sorted list to keep, sorted list to delete)
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        kept = policy.keep(self, _timestamp(now))
+        keep = []
+        delete = []
+        for index, name in enumerate(self.names):
+            if index in kept:
+                keep.append(name)
+            else:
+                delete.append(name)
+        logger.debug('%s: keep %i, delete %i snapshots', policy, len(keep), len(delete))
+        return keep, delete
+
+
+class AgePolicy:
+    """
+    Delete the snapshots older than "days"
+    but keep a minimum amount of snapshots
+
+    :param days: snapshots older than this value are old
+    :param keep: keep at least this number of snapshots
+    """
+    def __init__(self, days=50, keep=10):
+        if (days < 0) or (keep < 0):
+            raise ValueError
+        self.days = days
+        self.min_keep = keep
+
+    def __repr__(self):
+        return 'AgePolicy(days=%s, keep=%s)' % (self.days, self.min_keep)
+
+    def keep(self, snapshots, now):
+        """
+        Return the indices of the snapshots to keep
+
+        :param snapshots: Snapshots
+        :param now: reference date (seconds, see Snapshots.times)
+        :returns: set
+        """
+        split = bisect.bisect_right(snapshots.times, now - self.days * DAY)
+        split = min(split, max(0, len(snapshots) - self.min_keep))
+        return set(range(split, len(snapshots)))
+
+
+def _floor_month(time, months):
+    date = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=time)
+    index = (date.year * 12 + date.month - 1) // months * months
+    return _timestamp(datetime.datetime(index // 12, index % 12 + 1, 1))
+
+
+def _floor_week(time):
+    days = time // DAY
+    # 1970-01-01 is a thursday
+    return (days - (days + 3) % 7) * DAY
+
+
+# Start of the bucket containing a date (seconds)
+BUCKETS = (('hourly', lambda time: time - time % HOUR),
+           ('daily', lambda time: time - time % DAY),
+           ('weekly', _floor_week),
+           ('monthly', lambda time: _floor_month(time, 1)),
+           ('yearly', lambda time: _floor_month(time, 12)),
+           )
+
+
+class GFSPolicy:
+    """
+    Grandfather-father-son retention:
+    keep the most recent snapshot of the last hours, days,
+    weeks (starting on monday), months and years having snapshots.
+
+    :param hourly: number of hours
+    :param daily: number of days
+    :param weekly: number of weeks
+    :param monthly: number of months
+    :param yearly: number of years
+    :param keep: keep at least this number of the most recent snapshots
+    """
+    def __init__(self, hourly=0, daily=7, weekly=4, monthly=12, yearly=0, keep=1):
+        self.counts = {'hourly': hourly, 'daily': daily, 'weekly': weekly,
+                       'monthly': monthly, 'yearly': yearly}
+        if min(self.counts.values()) < 0 or keep < 0:
+            raise ValueError
+        self.min_keep = keep
+
+    def __repr__(self):
+        counts = ', '.join('%s=%s' % (bucket, self.counts[bucket]) for bucket, floor in BUCKETS)
+        return 'GFSPolicy(%s, keep=%s)' % (counts, self.min_keep)
+
+    def keep(self, snapshots, now):
+        """
+        Return the indices of the snapshots to keep
+
+        :param snapshots: Snapshots
+        :param now: reference date (seconds, see Snapshots.times)
+        :returns: set
+        """
+        times = snapshots.times
+        kept = set(range(max(0, len(times) - self.min_keep), len(times)))
+        for bucket, floor in BUCKETS:
+            # Jump from a snapshot to the last one before its bucket,
+            # empty buckets are skipped
+            end = len(times)
+            for number in range(self.counts[bucket]):
+                if end == 0:
+                    break
+                kept.add(end - 1)
+                end = bisect.bisect_left(times, floor(times[end - 1]), 0, end - 1)
+        return kept
+
+
+class LogarithmicPolicy:
+    """
+    Logarithmic thinning:
+    keep the oldest snapshot of the last "period" and of each interval
+    between period * 2**n and period * 2**(n+1) hours ago,
+    so that the density of snapshots decreases with their age.
+
+    :param period: length of the first interval (hours)
+    :param keep: keep at least this number of the most recent snapshots
+    """
+    def __init__(self, period=1, keep=10):
+        if period <= 0 or keep < 0:
+            raise ValueError
+        self.period = period
+        self.min_keep = keep
+
+    def __repr__(self):
+        return 'LogarithmicPolicy(period=%s, keep=%s)' % (self.period, self.min_keep)
+
+    def keep(self, snapshots, now):
+        """
+        Return the indices of the snapshots to keep
+
+        :param snapshots: Snapshots
+        :param now: reference date (seconds, see Snapshots.times)
+        :returns: set
+        """
+        times = snapshots.times
+        kept = set(range(max(0, len(times) - self.min_keep), len(times)))
+        if len(times) == 0:
+            return kept
+        length = self.period * HOUR
+        # The first interval includes the snapshots in the future
+        end = float('inf')
+        start = now - length
+        while True:
+            index = bisect.bisect_left(times, start)
+            # times[index] is the oldest snapshot of [start, end[
+            if index < len(times) and times[index] < end:
+                kept.add(index)
+            if start <= times[0]:
+                break
+            end = start
+            start = now - 2 * (now - start)
+        return kept
+
 
 def older(file_list, days=5):
     """
@@ -34,23 +306,8 @@ def older(file_list, days=5):
     """
     if days < 0:
         raise ValueError
+    return Snapshots(file_list).older(days)
 
-    now = datetime.datetime.now()
-
-    old = []
-    recent = []
-    for afile in file_list:
-        try:
-            date = datetime.datetime.strptime(afile, '%Y-%m-%d_%Hh%Mm%Ss')
-        except ValueError:
-            continue
-        if (now - date) >= datetime.timedelta(days):
-            old.append(afile)
-        else:
-            recent.append(afile)
-
-    old.sort()
-    return old
 
 def older_keepmin(file_list, days=5, keep=10):
     """
@@ -62,28 +319,4 @@ def older_keepmin(file_list, days=5, keep=10):
 
     :returns: a sorted list of old files
     """
-
-    if (days < 0) or (keep < 0):
-        raise ValueError
-
-    now = datetime.datetime.now()
-
-    old = []
-    recent = []
-    for afile in file_list:
-        try:
-            date = datetime.datetime.strptime(afile, '%Y-%m-%d_%Hh%Mm%Ss')
-        except ValueError:
-            continue
-        if (now - date) >= datetime.timedelta(days):
-            old.append(afile)
-        else:
-            recent.append(afile)
-
-    old.sort()
-    # While we remove too much,
-    # re-feed keep array
-    while (len(recent) < keep) and (old != []):
-        recent.append(old.pop(-1))
-
-    return old
+    return Snapshots(file_list).select(AgePolicy(days, keep))[1]
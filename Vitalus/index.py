@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import json
+import stat
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+
+class Changes:
+    """
+    Differences between a source and its index
+
+    :param changed: new or modified entries (relative paths)
+    :param deleted: entries removed, or replaced by an entry
+        of another type (directory, file)
+    :param directories: the changed entries which are directories
+    :param entries: number of entries in the source
+    """
+    def __init__(self, changed, deleted, directories, entries):
+        self.changed = changed
+        self.deleted = deleted
+        self.directories = directories
+        self.entries = entries
+
+    def paths(self):
+        """
+        Return the paths to give to rsync --files-from:
+        the changed entries and the deleted ones (missing in the source)
+
+        :returns: list
+        """
+        changed = set(self.changed)
+        return self.changed + [path for path in self.deleted if path not in changed]
+
+    def unlinked(self):
+        """
+        Return the paths of the previous snapshot not to reuse as is:
+        the changed entries but the directories, and the deleted ones
+
+        :returns: list
+        """
+        return sorted((set(self.changed) - self.directories) | set(self.deleted))
+
+
+def _record(entry_stat):
+    """ Metadata of an entry kept in the index """
+    return [entry_stat.st_mode, entry_stat.st_size, entry_stat.st_mtime_ns,
+            entry_stat.st_ino, entry_stat.st_uid, entry_stat.st_gid]
+
+
+class SourceIndex:
+    """
+    Index of the entries of a local source (mode, size, mtime, inode,
+    owner), stored in a sqlite database with one row per directory.
+
+    scan() compares the source to the index and records the new rows
+    aside: they replace the index when commit() is called, after a
+    successful transfer. Otherwise, the next scan() starts again
+    from the index.
+
+    :param path: database path
+    :type path: string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('Vitalus.SourceIndex')
+        # Used by the jobs run in threads
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                            'path TEXT PRIMARY KEY, entries TEXT NOT NULL)')
+            # entries NULL: directory removed with its subdirectories
+            self.db.execute('CREATE TABLE IF NOT EXISTS pending ('
+                            'path TEXT PRIMARY KEY, entries TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                            'key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        """
+        Close the database
+        """
+        self.db.close()
+
+    def info(self):
+        """
+        Return the backup matching the index
+
+        :returns: dict -- snapshot (name of the backup, None if the
+            index was never committed), settings (see commit())
+            and full_pass (timestamp of the last full pass, None if never done)
+        """
+        meta = dict(self.db.execute('SELECT key, value FROM meta').fetchall())
+        full_pass = meta.get('full_pass')
+        return {'snapshot': meta.get('snapshot'), 'settings': meta.get('settings'),
+                'full_pass': float(full_pass) if full_pass is not None else None}
+
+    def _walk(self, root, workers):
+        """
+        Walk a tree with scandir in several threads, following symlinks
+        as rsync -L does (a directory inside itself is not walked again).
+
+        :returns: generator of (relative path, entries, error),
+            entries is a dict {name: record}
+        """
+        directories = queue.Queue()
+        results = queue.Queue()
+        stop = threading.Event()
+
+        def scan(relative, ancestors):
+            directory = os.path.join(root, relative)
+            entries = {}
+            with os.scandir(directory) as listing:
+                for entry in listing:
+                    try:
+                        entry_stat = entry.stat()
+                    except OSError:
+                        # Broken symlink
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    entries[entry.name] = _record(entry_stat)
+                    key = (entry_stat.st_dev, entry_stat.st_ino)
+                    if stat.S_ISDIR(entry_stat.st_mode) and key not in ancestors:
+                        directories.put((os.path.join(relative, entry.name),
+                                         ancestors | {key}))
+                        # Known by the consumer before the result
+                        results.put(('directory', None, None))
+            return entries
+
+        def worker():
+            while True:
+                item = directories.get()
+                if item is None:
+                    break
+                if stop.is_set():
+                    continue
+                try:
+                    results.put(('done', item[0], scan(*item)))
+                except OSError as e:
+                    results.put(('error', item[0], e))
+
+        root_stat = os.stat(root)
+        directories.put(('', frozenset([(root_stat.st_dev, root_stat.st_ino)])))
+        threads = [threading.Thread(target=worker, daemon=True) for number in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            remaining = 1
+            while remaining:
+                kind, relative, value = results.get()
+                if kind == 'directory':
+                    remaining += 1
+                    continue
+                remaining -= 1
+                if kind == 'error':
+                    yield relative, None, value
+                else:
+                    yield relative, value, None
+        finally:
+            stop.set()
+            for thread in threads:
+                directories.put(None)
+
+    def scan(self, root, collect=True, workers=4):
+        """
+        Compare a source to the index
+
+        :param root: source directory
+        :param collect: if False, only the new index is computed
+            (full pass): the changes are not listed
+        :param workers: number of threads
+        :returns: :class:`Changes`, the entries are relative to root
+        :raises: OSError -- if a directory could not be read
+        """
+        changed = []
+        directories = set()
+        deleted = []
+        count = 0
+        with self.db:
+            self.db.execute('DELETE FROM pending')
+        try:
+            for relative, entries, error in self._walk(root, workers):
+                if error is not None:
+                    # The deleted entries would be unknown
+                    raise error
+                count += len(entries)
+                row = self.db.execute('SELECT entries FROM dirs WHERE path = ?',
+                                      (relative,)).fetchone()
+                old = json.loads(row[0]) if row is not None else {}
+                if entries == old:
+                    continue
+                self.db.execute('INSERT INTO pending VALUES (?, ?)',
+                                (relative, json.dumps(entries)))
+                for name, record in old.items():
+                    is_dir = stat.S_ISDIR(record[0])
+                    if name in entries and stat.S_ISDIR(entries[name][0]) == is_dir:
+                        continue
+                    if is_dir:
+                        self.db.execute('INSERT OR REPLACE INTO pending VALUES (?, NULL)',
+                                        (os.path.join(relative, name),))
+                    if collect:
+                        deleted.append(os.path.join(relative, name))
+                if collect:
+                    for name, record in entries.items():
+                        if old.get(name) != record:
+                            path = os.path.join(relative, name)
+                            changed.append(path)
+                            if stat.S_ISDIR(record[0]):
+                                directories.add(path)
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+        changed.sort()
+        deleted.sort()
+        self.logger.debug('Scan of %s: %i entries, %i changed, %i deleted',
+                          root, count, len(changed), len(deleted))
+        return Changes(changed, deleted, directories, count)
+
+    def commit(self, snapshot, full=False, settings=None):
+        """
+        Replace the index by the result of the last scan
+
+        :param snapshot: name of the backup of this source
+        :param full: the backup was a full pass
+        :param settings: settings of the transfer (e.g. source, filters),
+            the index is valid for these ones only
+        :type settings: string
+        """
+        with self.db:
+            for path, in self.db.execute('SELECT path FROM pending '
+                                         'WHERE entries IS NULL').fetchall():
+                self.db.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?',
+                                (path, len(path) + 1, path + '/'))
+            self.db.execute('INSERT OR REPLACE INTO dirs SELECT path, entries FROM pending '
+                            'WHERE entries IS NOT NULL')
+            self.db.execute('DELETE FROM pending')
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('snapshot', ?)", (snapshot,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)", (settings,))
+            if full:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('full_pass', ?)",
+                                (repr(time.time()),))
@@ -18,11 +18,37 @@
 
 import os
 import re
-import shelve
+import time
+import asyncio
 import datetime
 import logging
-from contextlib import closing
+import threading
 import socket
+import contextlib
+
+from Vitalus import ssh
+from Vitalus import logs
+from Vitalus.state import StateStore
+
+
+def get_job_logger(log_dir, name):
+    """
+    Return the logger of a job, writing in log_dir/name.log
+
+    :param log_dir: Log directory path
+    :param name: Job name
+    :returns: logger
+
+    .. note::
+        The file is written by a thread (see :mod:`Vitalus.logs`)
+        and opened when the job logs something.
+    """
+    job_log = os.path.join(log_dir, name + '.log')
+    job_logger = logging.getLogger(name)
+    # Several jobs (mirrors, Vitalus instances) share the handler
+    logs.add_file_handler(job_logger, job_log)
+    job_logger.setLevel(logging.INFO)
+    return job_logger
 
 
 class TARGETError(Exception):
@@ -36,6 +62,111 @@ class TARGETError(Exception):
         Exception.__init__(self, message)
 
 
+class AvailabilityCache:
+    """
+    Cache of the reachability of SSH hosts, shared by all targets.
+
+    :param ttl: a result is kept during this time (seconds)
+    :type ttl: float
+    :param timeout: connection timeout (seconds)
+    :type timeout: float
+    """
+    def __init__(self, ttl=300, timeout=5):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.logger = logging.getLogger('Vitalus.AvailabilityCache')
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _get(self, address):
+        """
+        Return the cached result for an address, None if missing or expired
+        """
+        with self._lock:
+            try:
+                date, available = self._results[address]
+            except KeyError:
+                return None
+        if time.monotonic() - date > self.ttl:
+            return None
+        return available
+
+    def _set(self, address, available):
+        with self._lock:
+            self._results[address] = (time.monotonic(), available)
+
+    def clear(self):
+        """
+        Forget all results
+        """
+        with self._lock:
+            self._results = {}
+
+    def is_available(self, address):
+        """
+        Return True if the address is reachable.
+        The connection is attempted only if there is no fresh result.
+
+        :param address: (host, port)
+        :type address: tuple
+        :returns: bool
+        """
+        available = self._get(address)
+        if available is None:
+            self.logger.debug('Probe %s:%s', *address)
+            try:
+                sock = socket.create_connection(address, timeout=self.timeout)
+            except (socket.error, socket.timeout):
+                available = False
+            else:
+                sock.close()
+                available = True
+            self._set(address, available)
+        return available
+
+    async def is_available_async(self, address):
+        """
+        Same as :meth:`is_available`, without blocking the event loop
+
+        :param address: (host, port)
+        :type address: tuple
+        :returns: bool
+        """
+        available = self._get(address)
+        if available is None:
+            available = await self._probe(address)
+        return available
+
+    async def _probe(self, address):
+        """
+        Probe an address without blocking the event loop
+
+        :returns: bool -- True if the address is reachable
+        """
+        self.logger.debug('Probe %s:%s', *address)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*address),
+                                                    self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            available = False
+        else:
+            writer.close()
+            await writer.wait_closed()
+            available = True
+        self._set(address, available)
+        return available
+
+    async def probe_all(self, addresses):
+        """
+        Probe concurrently addresses without fresh results.
+
+        :param addresses: list of (host, port)
+        """
+        addresses = set(address for address in addresses if self._get(address) is None)
+        self.logger.debug('Probe %s', addresses)
+        await asyncio.gather(*[self._probe(address) for address in addresses])
+
+
 class Target:
     """
     A target is a source or a destination.
@@ -43,7 +174,14 @@ class Target:
 
     :param target: a target
     :type target: string
+
+    .. note::
+
+        The reachability of SSH hosts is cached
+        in :attr:`Target.availability` for all targets.
     """
+    availability = AvailabilityCache()
+
     def __init__(self, target):
         # Here, we do not check that path exists.
         # It is checked in check_availability()
@@ -52,6 +190,7 @@ class Target:
         self.logger.debug("Read target %s", target)
         self.target = target
         self.ttype = self._detect_target_type()
+        self._address = None  # read in ssh config when needed
 
         if self.is_local():
             self.path = target
@@ -98,6 +237,22 @@ class Target:
         else:
             return False
 
+    def address(self):
+        """
+        Return the address of a SSH host.
+        HostName and Port are read in ~/.ssh/config.
+
+        :returns: tuple -- (host, port)
+        """
+        if self._address is None:
+            config = ssh.read_config(self.domain)
+            try:
+                port = int(config.get('port', 22))
+            except ValueError:
+                port = 22
+            self._address = (config.get('hostname', self.domain), port)
+        return self._address
+
     def check_availability(self):
         """
         Check if the target is available
@@ -108,15 +263,25 @@ class Target:
         if self.is_ssh():
             # TODO; here we check the connection.
             # We may check also the filepath
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                sock.connect((self.domain, 22))
-            except socket.error:
+            if not self.availability.is_available(self.address()):
                 raise TARGETError("SSH target %s unreachable" % self.target)
         elif self.is_local():
             if not os.path.exists(self.path):
                 raise TARGETError("Local target %s unreachable" % self.target)
 
+    async def check_availability_async(self):
+        """
+        Same as :meth:`check_availability`, the SSH host is probed
+        without blocking the event loop
+
+        :raises: TARGETError -- if not available
+        """
+        if self.is_ssh():
+            if not await self.availability.is_available_async(self.address()):
+                raise TARGETError("SSH target %s unreachable" % self.target)
+        else:
+            self.check_availability()
+
 
 class Job():
     """
@@ -136,8 +301,19 @@ class Job():
 
     .. note::
 
-        ---
+        The state (last backup, runs) is stored in :attr:`state`,
+        shared by the jobs of a Vitalus instance, or log_dir/state.db.
+        The events of the job are written in :attr:`events`
+        (:class:`Vitalus.events.EventLog`) and its measures are sent
+        to :attr:`metrics` (:class:`Vitalus.metrics.MetricsSink`), if set.
+        Its spans are recorded by :attr:`tracer` (:class:`Vitalus.trace.Tracer`),
+        on the track of the job name or :attr:`track`.
     """
+    state = None
+    events = None
+    metrics = None
+    tracer = None
+    track = None
 
     def __init__(self, log_dir, destination, name, source, period):
 
@@ -154,29 +330,60 @@ class Job():
         self.logger = logging.getLogger('Vitalus.Job')
 
         # Logs specific to the rsync job
-        job_log = os.path.join(self.backup_log_dir, self.name + '.log')
-        self.job_logger = logging.getLogger(self.name)
-        log_rotator = logging.handlers.TimedRotatingFileHandler(job_log,
-                                                                when='midnight',
-                                                                interval=1,
-                                                                backupCount=30,
-                                                                encoding=None,
-                                                                delay=False,
-                                                                utc=False)
-        self.job_logger.addHandler(log_rotator)
-        self.job_logger.setLevel(logging.INFO)
+        self.job_logger = get_job_logger(self.backup_log_dir, self.name)
 
         # Set previous and current backup paths
         self.previous_backup_path = None  # will be detected later
         self.current_backup_path = None
 
+    def _get_state(self):
+        """
+        Return the state store
+
+        :returns: :class:`Vitalus.state.StateStore`
+        """
+        if self.state is None:
+            self.state = StateStore(os.path.join(self.backup_log_dir, 'state.db'))
+        return self.state
+
     def _set_lastbackup_time(self):
         """
         Set the last backup (labeled name) time
         """
         self.logger.debug('Set lastbackup time')
-        with closing(shelve.open(os.path.join(self.backup_log_dir, 'time.db'))) as timebase:
-            timebase[self.name] = datetime.datetime.now()
+        self._get_state().set_last_backup(self.name, datetime.datetime.now())
+
+    def _record_run(self, status, bytes=None):
+        """
+        Record the run in the history of the job
+
+        :param status: e.g. 'success', 'partial', 'failed'
+        :param bytes: bytes written in the destination
+        """
+        self._get_state().record_run(self.name, self.now, datetime.datetime.now(), status, bytes)
+
+    def _emit(self, event, **fields):
+        """
+        Write an event of the job, if the events are recorded
+
+        :param event: event type (see :class:`Vitalus.events.EventLog`)
+        :param fields: values of the event
+        """
+        if self.events is not None:
+            self.events.emit(event, job=self.name, **fields)
+
+    def _span(self, name, category='vitalus', **args):
+        """
+        Return a context manager recording the span of a block
+        on the track of the job, if traced
+
+        :param name: span name
+        :param category: category of the span
+        :param args: values shown with the span
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext(args)
+        return self.tracer.span(name, self.track or self.name, category, **args)
 
     def _check_need_backup(self):
         """
@@ -186,14 +393,12 @@ class Job():
         :returns: bool
         """
         self.logger.debug("Check time between backups for %s", self.name)
-        with closing(shelve.open(os.path.join(self.backup_log_dir, 'time.db'))) as timebase:
-            try:
-                last = timebase[self.name]
-            except KeyError:
-                # Not yet stored
-                # Run the first backup
-                self.logger.debug("%s: first backup", self.name)
-                return True
+        last = self._get_state().last_backup(self.name)
+        if last is None:
+            # Not yet stored
+            # Run the first backup
+            self.logger.debug("%s: first backup", self.name)
+            return True
 
         # Calculate the difference
         self.logger.debug("now= %s", datetime.datetime.now())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+
+
+class FileDispatcher(logging.Handler):
+    """
+    Write each record in the log file of its logger.
+
+    A file (rotated at midnight) is opened when its first record comes.
+    Used by the thread of the QueueListener only.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self._lock = threading.Lock()
+        # path: number of rotated files kept
+        self.backup_counts = {}
+        # path: TimedRotatingFileHandler
+        self.handlers = {}
+
+    def register(self, path, backup_count):
+        """
+        Declare a log file
+
+        :param path: log file path
+        :param backup_count: number of rotated files kept
+        """
+        with self._lock:
+            self.backup_counts.setdefault(path, backup_count)
+
+    def emit(self, record):
+        handler = self.handlers.get(record.log_path)
+        if handler is None:
+            with self._lock:
+                backup_count = self.backup_counts[record.log_path]
+            handler = logging.handlers.TimedRotatingFileHandler(record.log_path,
+                                                                when='midnight',
+                                                                interval=1,
+                                                                backupCount=backup_count,
+                                                                encoding=None,
+                                                                delay=True,
+                                                                utc=False)
+            self.handlers[record.log_path] = handler
+        handler.handle(record)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        self.handlers = {}
+        logging.Handler.close(self)
+
+
+class FileQueueHandler(logging.handlers.QueueHandler):
+    """
+    Send the records of a logger to the thread writing the log files
+
+    :param log_queue: queue read by the QueueListener
+    :param path: log file path
+    """
+    def __init__(self, log_queue, path):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.path = path
+
+    def prepare(self, record):
+        # The message is formatted here, the file handler writes it as is
+        record = logging.handlers.QueueHandler.prepare(self, record)
+        record.log_path = self.path
+        return record
+
+    def flush(self):
+        flush()
+
+
+_queue = queue.SimpleQueue()
+_dispatcher = FileDispatcher()
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def add_file_handler(logger, path, backup_count=30, formatter=None):
+    """
+    Write the records of a logger in a file, rotated at midnight.
+
+    The file is written by a thread: logging does not wait for the disk.
+    It is opened when the first record comes.
+    A logger gets one handler per file, whatever the number of calls.
+
+    :param logger: logger
+    :param path: log file path
+    :param backup_count: number of rotated files kept
+    :param formatter: formatter of the records, None for the message only
+    :returns: handler
+    """
+    global _listener
+    path = os.path.abspath(path)
+    for handler in logger.handlers:
+        if isinstance(handler, FileQueueHandler) and handler.path == path:
+            return handler
+    _dispatcher.register(path, backup_count)
+    handler = FileQueueHandler(_queue, path)
+    if formatter is not None:
+        handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    with _listener_lock:
+        if _listener is None:
+            _listener = logging.handlers.QueueListener(_queue, _dispatcher)
+            _listener.start()
+    return handler
+
+
+def flush():
+    """
+    Wait until the queued records are written
+    """
+    with _listener_lock:
+        if _listener is not None:
+            # stop() writes the records already queued
+            _listener.stop()
+            _listener.start()
+
+
+def _shutdown():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+    _dispatcher.close()
+
+
+atexit.register(_shutdown)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import re
+import logging
+
+# Value of the status gauges
+STATUS = {'success': 0, 'partial': 1, 'failed': 2}
+
+
+class MetricsSink:
+    """
+    Receiver of the measures of the runs and of the jobs.
+
+    This one drops them: subclass it to send them elsewhere
+    (see :class:`TextfileSink`).
+    """
+    def record_job(self, name, measures):
+        """
+        Record the measures of a job at its end
+
+        :param name: job name
+        :type name: string
+        :param measures: status ('success', 'partial', 'failed'),
+            returncode, bytes, duration and phases (seconds),
+            counters (subprocesses, ssh_roundtrips), period (seconds),
+            timestamp (end of the job) and last_success (timestamp or None)
+        :type measures: dict
+        """
+        pass
+
+    def record_run(self, measures):
+        """
+        Record the measures of a run at its end
+
+        :param measures: status ('ok', 'cancelled', 'error'), duration,
+            jobs (number of due jobs) and timestamp (end of the run)
+        :type measures: dict
+        """
+        pass
+
+
+def _escape(value):
+    """ Escape a label value """
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format(metrics):
+    """
+    Return metrics in the Prometheus text format
+
+    :param metrics: list of (name, help, labels, value),
+        the samples of a name are consecutive
+    :returns: string
+    """
+    lines = []
+    previous = None
+    for name, text, labels, value in metrics:
+        if value is None:
+            continue
+        if name != previous:
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s gauge' % name)
+            previous = name
+        sample = name
+        if labels:
+            sample += '{%s}' % ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                        for key in sorted(labels))
+        lines.append('%s %s' % (sample, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+class TextfileSink(MetricsSink):
+    """
+    Write the measures for the textfile collector of node_exporter.
+
+    Each job has its own file (vitalus_job_<name>.prom),
+    so that the jobs not run keep their last values,
+    and the run writes vitalus.prom.
+    The files are replaced atomically.
+
+    :param directory: directory read by the collector
+        (--collector.textfile.directory)
+    :type directory: string
+
+    .. note::
+        An overdue job can be detected with
+        time() - vitalus_job_last_success_timestamp_seconds > 2 * vitalus_job_period_seconds
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.logger = logging.getLogger('Vitalus.TextfileSink')
+
+    def _write(self, filename, content):
+        path = os.path.join(self.directory, filename)
+        try:
+            with open(path + '.tmp', 'w') as prom:
+                prom.write(content)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.warning('Could not write %s: %s', path, e)
+
+    def job_filename(self, name):
+        """
+        Return the file name of the measures of a job
+        """
+        return 'vitalus_job_%s.prom' % re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+    def record_job(self, name, measures):
+        job = {'job': name}
+        metrics = [('vitalus_job_status', 'Status of the last run (0 success, 1 partial, 2 failed)',
+                    job, STATUS[measures['status']]),
+                   ('vitalus_job_returncode', 'Return code of rsync in the last run',
+                    job, measures.get('returncode')),
+                   ('vitalus_job_bytes', 'Bytes written in the destination by the last run',
+                    job, measures.get('bytes')),
+                   ('vitalus_job_duration_seconds', 'Duration of the last run',
+                    job, measures['duration'])]
+        for phase in sorted(measures['phases']):
+            metrics.append(('vitalus_job_phase_seconds', 'Duration of a phase of the last run',
+                            dict(job, phase=phase), measures['phases'][phase]))
+        metrics += [('vitalus_job_subprocesses', 'Subprocesses spawned by the last run',
+                     job, measures['counters']['subprocesses']),
+                    ('vitalus_job_ssh_roundtrips', 'SSH round-trips of the last run',
+                     job, measures['counters']['ssh_roundtrips']),
+                    ('vitalus_job_period_seconds', 'Min duration between two backups',
+                     job, measures.get('period')),
+                    ('vitalus_job_last_run_timestamp_seconds', 'End of the last run',
+                     job, measures['timestamp']),
+                    ('vitalus_job_last_success_timestamp_seconds', 'End of the last backup',
+                     job, measures.get('last_success'))]
+        self._write(self.job_filename(name), _format(metrics))
+
+    def record_run(self, measures):
+        metrics = [('vitalus_run_success', 'The last run ended normally (1) or not (0)',
+                    {}, measures['status'] == 'ok'),
+                   ('vitalus_run_duration_seconds', 'Duration of the last run',
+                    {}, measures['duration']),
+                   ('vitalus_run_jobs', 'Jobs due in the last run',
+                    {}, measures['jobs']),
+                   ('vitalus_run_timestamp_seconds', 'End of the last run',
+                    {}, measures['timestamp'])]
+        self._write('vitalus.prom', _format(metrics))
@@ -18,15 +18,25 @@
 
 import os
 #import psutil
+import json
+import time
+import asyncio
+import contextlib
 import subprocess
-import shutil
 import datetime
 import logging
 
 import Vitalus.utils as utils
+from Vitalus import agent
+from Vitalus.rsyncparser import RsyncOutputParser
+from Vitalus import tuning
+from Vitalus import history
+from Vitalus.index import SourceIndex
+from Vitalus.trace import ChildCPU
 from Vitalus.job import Target
 from Vitalus.job import TARGETError
 from Vitalus.job import Job
+from Vitalus.job import get_job_logger
 
 
 class RsyncJob(Job):
@@ -55,6 +65,33 @@ class RsyncJob(Job):
     :type guid: tuple
     :param filter: Rsync filters
     :type filter: list
+    :param timeout: max duration of the transfer (in seconds), None for no limit
+    :type timeout: float
+    :param ssh_pool: SSH connections shared between jobs, None to not share them
+    :type ssh_pool: :class:`Vitalus.ssh.SSHPool`
+    :param stats: store for the statistics of the transfers, None to not record them
+    :type stats: :class:`Vitalus.stats.StatsStore`
+    :param shards: number of rsync processes sharing the transfer
+    :type shards: int
+    :param mirrors: other destinations receiving the same backup
+    :type mirrors: list
+    :param tuner: choose the transfer options from the past runs, None for the usual options
+    :type tuner: :class:`Vitalus.tuning.AutoTuner`
+    :param retention: policy of Vitalus.history deciding which snapshots are kept,
+        None for AgePolicy(duration, keep)
+    :param space_check: check the free space before the transfer, None to skip it.
+        dict: margin (the estimated delta is multiplied by it), min_free (bytes),
+        prune (delete the oldest snapshots instead of aborting),
+        dry_run (without history, estimate the delta with rsync --dry-run)
+    :type space_check: dict
+    :param fingerprint: skip the transfer if the source is unchanged
+        since the last successful backup
+    :type fingerprint: bool
+    :param incremental: transfer only the paths changed since the last
+        successful backup, found with an index of the source
+    :type incremental: bool
+    :param full_pass: with incremental, days between two full transfers
+    :type full_pass: float
 
 
     .. note::
@@ -63,10 +100,51 @@ class RsyncJob(Job):
         or a ssh login joined to the path by a : character.
 
         if uid or gid are None, files owner are not changed
+
+        With shards > 1, the top-level entries of the source are
+        split between concurrent rsync processes (rsync --relative).
+        Anchored filter rules (starting with /) then apply to the
+        path relative to the source.
+
+        With mirrors, the source is read once: the delta is recorded
+        with rsync --write-batch and applied to each mirror with
+        rsync --read-batch. Each mirror keeps its own snapshots.
+        Shards are not used in this case.
+
+        With fingerprint, the metadata of the source is hashed before
+        the transfer (see :func:`Vitalus.agent.op_fingerprint`).
+        If the hash and the settings of the transfer (source, filters,
+        owner) are the ones of the last successful backup and this
+        backup is still the last one in the destination, rsync is not run
+        and no snapshot is created.
+
+        With incremental, a local source is compared to its index
+        (log_dir/name.index.db, see :class:`Vitalus.index.SourceIndex`)
+        and rsync receives only the changed and deleted paths (--files-from).
+        The unchanged files of the last backup are hardlinked in the new
+        snapshot first (see :func:`Vitalus.agent.op_link_tree`).
+        The whole source is transferred if the last backup is not the one
+        of the index, if the source, the filters or the owner changed,
+        every full_pass days, or with mirrors or shards.
+        rsync must support --delete-missing-args (3.1.0).
     """
 
+    # Max duration (in seconds) of the SSH commands used for bookkeeping
+    ssh_timeout = 300
+    # Max duration (in seconds) of the deletion of the trash over SSH,
+    # the next run resumes it
+    purge_timeout = 3600
+    # Max duration (in seconds) of the SSH commands walking a whole tree
+    tree_timeout = 4 * 3600
+    # Lines of the rsync output are written in the log by chunks
+    log_chunk = 500
+    # Max length of a line of the rsync output
+    line_limit = 1024 * 1024
+
     def __init__(self, log_dir, destination, name, source, period, snapshot,
-                 duration, keep, force, guid, filter):
+                 duration, keep, force, guid, filter, timeout=None, ssh_pool=None,
+                 stats=None, shards=1, mirrors=(), tuner=None, retention=None,
+                 space_check=None, fingerprint=False, incremental=False, full_pass=7):
 
         self.name = name
         self.source = Target(source)
@@ -75,7 +153,37 @@ class RsyncJob(Job):
         self.snapshot = snapshot
         self.duration = duration
         self.keep = keep
+        if retention is None:
+            retention = history.AgePolicy(duration, keep)
+        self.retention = retention
+        self.space_check = space_check
+        # Free space of a SSH destination, from the listing
+        self.free_space = None
+        # Bytes to write in the destination, if known (mirrors)
+        self.expected_delta = None
         self.filter = filter
+        self.timeout = timeout
+        self.ssh_pool = ssh_pool
+        self.stats = stats
+        self.shards = shards
+        # Duration of each phase of the run (seconds)
+        self.phases = {}
+        # CPU time of rsync (seconds), None if unknown
+        self.cpu = 0
+        # Subprocesses spawned and SSH round-trips of the run
+        self.counters = {'subprocesses': 0, 'ssh_roundtrips': 0}
+        self.tuner = tuner
+        self.tuning = None
+        self.fingerprint = fingerprint
+        # Fingerprint of the source before the transfer
+        self.source_digest = None
+        self.incremental = incremental
+        self.full_pass = full_pass
+        # Index of the source, with incremental
+        self.index = None
+        self.index_full = False
+        # Paths transferred, None for the whole source
+        self.changes = None
 
         self.force = force
         self.now = datetime.datetime.now()
@@ -88,94 +196,600 @@ class RsyncJob(Job):
         self.logger = logging.getLogger('Vitalus.RsyncJob')
 
         # Logs specific to the rsync job
-        job_log = os.path.join(self.backup_log_dir, self.name + '.log')
-        self.job_logger = logging.getLogger(self.name)
-        log_rotator = logging.handlers.TimedRotatingFileHandler(job_log,
-                                                                when='midnight',
-                                                                interval=1,
-                                                                backupCount=30,
-                                                                encoding=None,
-                                                                delay=False,
-                                                                utc=False)
-        self.job_logger.addHandler(log_rotator)
-        self.job_logger.setLevel(logging.INFO)
+        self.job_logger = get_job_logger(self.backup_log_dir, self.name)
 
         # Set previous and current backup paths
         self.previous_backup_path = None  # will be detected later
         self.current_backup_path = None
+        # Content of the job directory, before the transfer
+        self.listing = []
+        # Snapshots recorded in the catalog of the destination
+        # (see agent.op_catalog()), None without history
+        self.catalog = None
+        # Snapshots in the trash of a SSH destination, None if unknown
+        self.trash = None
+
+        # Same job to the other destinations
+        self.mirrors = []
+        for mirror in mirrors:
+            mirror_job = RsyncJob(log_dir, mirror, name, source, period, snapshot,
+                                  duration, keep, force, guid, filter, timeout, ssh_pool,
+                                  retention=retention, space_check=space_check)
+            # Same snapshot name
+            mirror_job.now = self.now
+            mirror_job.current_date = self.current_date
+            mirror_job.track = '%s > %s' % (name, mirror)
+            self.mirrors.append(mirror_job)
 
-#    def _check_disk_usage(self):
-#        """
-#        Check the disk usage
-#        :raises TARGETError: if low disk space
-#        """
-#        if self.destination.is_local():
-#            #TODO, change the criterion
-#            pass
-#            #if psutil.disk_usage(self.destination)[2] < utils.get_folder_size(self.source):
-#            #    self.logger.critical("Low disk space: %s", self.destination)
-#            #    raise TARGETError('Low disk space on %s' % self.destination)
-#        elif self.destination.is_ssh():
-#            #TODO
-#            pass
-
-    def _delete_old_files(self, days=10, keep=10):
-        """
-        Delete old archives in the destination
-
-        :param days: delete files older than this value
-        :type days: int
-        :param keep: keep at least this amount of archives
-        :type keep: int
+    async def _estimate_delta(self):
         """
-        #TODO : review logs
+        Estimate the bytes written in the destination by the transfer:
+        the largest transfer of the last runs or rsync --dry-run.
+
+        :returns: int -- bytes, None if unknown
+        """
+        if self.expected_delta is not None:
+            return self.expected_delta
+        if self.stats is not None:
+            sizes = [run['total_transferred_file_size'] for run in self.stats.runs(self.name, 10)
+                     if run['returncode'] == 0 and run['total_transferred_file_size'] is not None]
+            if sizes:
+                return max(sizes)
+        if self.space_check['dry_run']:
+            # The destination is not prepared yet: compare with the path
+            # of the new snapshot, or with the one renamed into it
+            if self.snapshot is False and self.previous_backup_path is not None:
+                self.current_backup_path = self.previous_backup_path
+            else:
+                self.current_backup_path = self._backup_path()
+            returncode, output = await self._run_command(self._prepare_rsync_command() +
+                                                         ['--dry-run'])
+            return output.stats.get('total_transferred_file_size')
+        return None
+
+    async def _source_fingerprint(self):
+        """
+        Return the fingerprint of the source, None if it could not be computed
+
+        :returns: string
+        """
+        batch = [{'op': 'fingerprint', 'path': self.source.path}]
+        if self.source.is_local():
+            # The walk may be long, do not block the event loop
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, agent.execute, batch)
+        else:
+            results = await self._run_agent(batch, target=self.source,
+                                            timeout=self.tree_timeout)
+        if not results[0]['ok']:
+            self.logger.warning('No fingerprint of %s: %s', self.source.target,
+                                results[0]['error'])
+            return None
+        result = results[0]['result']
+        self.logger.debug('Fingerprint of %s: %s (%s files, %s directories)', self.source.target,
+                          result['digest'], result['files'], result['directories'])
+        return result['digest']
+
+    def _files_from_root(self):
+        """
+        Return the directory given to rsync with --files-from
+        and the prefix of the paths of the source in the backup
+
+        :returns: tuple -- (directory, prefix)
+        """
+        path = self.source.path
+        if path.endswith('/'):
+            # The content is copied
+            return path, ''
+        # The directory is copied
+        head, tail = os.path.split(path)
+        return os.path.join(head or '.', ''), tail + '/'
+
+    def _transfer_settings(self):
+        """
+        Return the settings of the transfer a backup depends on:
+        source, filters and owner of the files
+
+        :returns: string
+        """
+        return json.dumps([self.source.target, list(self.filter or ()),
+                           self.dest_uid, self.dest_gid])
+
+    async def _scan_source(self):
+        """
+        Compare the source to its index (see incremental)
+
+        :returns: :class:`Vitalus.index.Changes`, None for a full transfer
+        """
+        if not self.source.is_local() or self.mirrors or self.shards > 1:
+            self.logger.warning('No incremental transfer for %s: '
+                                'local source only, without mirrors nor shards', self.name)
+            return None
+        self.index = SourceIndex(os.path.join(self.backup_log_dir, self.name + '.index.db'))
+        info = self.index.info()
+        self.index_full = (info['snapshot'] is None or
+                           info['snapshot'] != self._last_snapshot() or
+                           info['settings'] != self._transfer_settings() or
+                           info['full_pass'] is None or
+                           time.time() - info['full_pass'] > self.full_pass * 86400)
+        try:
+            # The walk may be long, do not block the event loop
+            changes = await asyncio.get_running_loop().run_in_executor(
+                None, self.index.scan, self.source.path, not self.index_full)
+        except OSError as e:
+            self.logger.warning('Could not scan %s: %s', self.source.target, e)
+            self.index.close()
+            self.index = None
+            return None
+        if self.index_full:
+            self.logger.info('Full transfer of %s', self.name)
+            return None
+        self.logger.info('%s: %i changed and %i deleted entries out of %i', self.name,
+                         len(changes.changed), len(changes.deleted), changes.entries)
+        return changes
+
+    async def _prepare_incremental(self, changes):
+        """
+        Hardlink the unchanged files of the last backup in the new snapshot
+        and write the paths to transfer
+
+        :param changes: :class:`Vitalus.index.Changes`
+        :returns: string -- path of the list of paths (rsync --files-from)
+        """
+        prefix = self._files_from_root()[1]
+        if self.snapshot is True:
+            batch = [{'op': 'link_tree', 'src': self.previous_backup_path,
+                      'dst': self.current_backup_path,
+                      'skip': [prefix + path for path in changes.unlinked()]}]
+            if self.destination.is_local():
+                results = await asyncio.get_running_loop().run_in_executor(
+                    None, agent.execute, batch)
+            else:
+                results = await self._run_agent(batch, timeout=self.tree_timeout)
+            if not results[0]['ok']:
+                raise TARGETError('Could not link %s in %s: %s' % (self.previous_backup_path,
+                                                                   self.current_backup_path,
+                                                                   results[0]['error']))
+            self.logger.debug('%s files linked for %s', results[0]['result'], self.name)
+        files_from = os.path.join(self.backup_log_dir, self.name + '.files')
+        with open(files_from, 'wb') as paths:
+            for path in changes.paths():
+                paths.write(os.fsencode(prefix + path) + b'\0')
+        return files_from
+
+    def _last_snapshot(self):
+        """
+        Return the name of the last backup in the destination,
+        before the transfer, None if there is none
+
+        :returns: string
+        """
+        if self.snapshot is None:
+            # The job directory is the backup
+            return self.name if self.listing else None
+        if self.previous_backup_path is None:
+            return None
+        return os.path.basename(self.previous_backup_path)
+
+    def _source_unchanged(self):
+        """
+        Return True if the source, the last backup and the settings
+        of the transfer are the ones of the last successful backup
+        (see fingerprint)
+
+        :returns: bool
+        """
+        if self.source_digest is None:
+            return False
+        known = self._get_state().fingerprint(self.name)
+        return (known is not None and known['digest'] == self.source_digest and
+                known['snapshot'] == self._last_snapshot() and
+                known['settings'] == self._transfer_settings())
+
+    async def _get_free_space(self):
+        """
+        Return the free space of the destination (bytes)
+        """
+        path = os.path.join(self.destination.path, self.name)
+        if self.destination.is_local():
+            return agent.op_statvfs(path)['free']
+        results = await self._run_agent([{'op': 'statvfs', 'path': path}])
+        if not results[0]['ok']:
+            raise TARGETError('Could not get the free space of %s' % self.destination.target)
+        return results[0]['result']['free']
+
+    async def _check_disk_usage(self):
+        """
+        Check the free space of the destination before the transfer.
+        If prune is set, the oldest snapshots are deleted
+        (but the last one) until there is enough space.
+
+        :raises: TARGETError -- if low disk space
+        """
+        delta = await self._estimate_delta()
+        needed = (delta or 0) * self.space_check['margin'] + self.space_check['min_free']
+        free = self.free_space
+        if free is None:
+            free = await self._get_free_space()
+        self.logger.debug('Free space for %s: %s, needed: %s', self.name, free, needed)
 
         path = os.path.join(self.destination.path, self.name)
+        while free < needed:
+            # The last snapshot is the base of the transfer
+            candidates = history.Snapshots(self.listing).names[:-1]
+            if self.snapshot is None or not self.space_check['prune'] or candidates == []:
+                self.logger.critical('Low disk space on %s: %i bytes free, %i needed',
+                                     self.destination.target, free, needed)
+                raise TARGETError('Low disk space on %s' % self.destination.target)
+            oldest = candidates[0]
+            self.logger.warning('Low disk space on %s, delete %s',
+                                self.destination.target, oldest)
+            # Immediately, not in the trash
+            batch = [{'op': 'rmtree', 'paths': [os.path.join(path, oldest)]},
+                     {'op': 'statvfs', 'path': path}]
+            if self.destination.is_local():
+                results = await asyncio.get_running_loop().run_in_executor(
+                    None, agent.execute, batch)
+            else:
+                results = await self._run_agent(batch, timeout=self.tree_timeout)
+            if not results[0]['ok'] or results[0]['result'] or not results[1]['ok']:
+                raise TARGETError('Low disk space on %s, could not delete %s' %
+                                  (self.destination.target, oldest))
+            self.listing.remove(oldest)
+            if self.catalog is not None:
+                self.catalog = [entry for entry in self.catalog if entry['name'] != oldest]
+            free = results[1]['result']['free']
 
-        self.destination.check_availability()
+    async def disk_usage(self):
+        """
+        Return the disk usage of the job in the destination,
+        the files shared by several snapshots are counted once.
+        The sizes of the directories are cached in the destination (.usage.db).
+
+        :returns: dict -- size (bytes), allocated (bytes on disk) and files
+        :raises: TARGETError -- if the destination is not available
+        """
+        path = os.path.join(self.destination.path, self.name)
+        cache = os.path.join(self.destination.path, '.usage.db')
+        await self.destination.check_availability_async()
         if self.destination.is_local():
-            filenames = os.listdir(path)
-        elif self.destination.is_ssh():
-                command = ['ssh', '-t', self.destination.login, 'ls', '-1', path]
-                self.logger.debug('SSH ls command: ' + str(command))
-                process = subprocess.Popen(command, bufsize=4096, stdout=subprocess.PIPE)
-                stdout, stderr = process.communicate()
-                filenames = stdout.decode()
-                filenames = filenames.split('\n')
-                filenames = [x.strip('\r') for x in filenames if x != '']
-        else:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, agent.op_usage, path, cache)
+        await self._connect()
+        results = await self._run_agent([{'op': 'usage', 'path': path, 'cache': cache}],
+                                        timeout=self.purge_timeout)
+        if not results[0]['ok']:
+            raise TARGETError('Could not get the disk usage of %s on %s' %
+                              (path, self.destination.target))
+        return results[0]['result']
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        """
+        Measure the duration of a phase of the run
+
+        :param name: phase name
+        """
+        start = time.monotonic()
+        try:
+            with self._span(name, 'phase'):
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def _trace_process(self, command, process, start):
+        """
+        Record the span of a subprocess on its own track, if traced
+
+        :param command: command
+        :param process: terminated process
+        :param start: start (see Tracer.now())
+        """
+        if self.tracer is None:
             return
+        name = os.path.basename(command[0])
+        track = '%s: %s [%s]' % (self.track or self.name, name, process.pid)
+        self.tracer.complete(name, track, start, category='subprocess',
+                             args={'command': ' '.join(command)[:200],
+                                   'returncode': process.returncode})
+
+    def _ssh_command(self, *args, tty=True, target=None):
+        """
+        Return a ssh command to run on the destination
+
+        :param args: remote command
+        :param tty: request a tty
+        :param target: run on this target instead of the destination
+        :returns: list
+        """
+        if target is None:
+            target = self.destination
+        if self.ssh_pool is not None:
+            return self.ssh_pool.command(target.login, *args, tty=tty)
+        if tty:
+            return ['ssh', '-t', target.login] + list(args)
+        return ['ssh', target.login] + list(args)
+
+    async def _run_agent(self, batch, target=None, timeout=None):
+        """
+        Run a batch of operations on the destination host
+        with the agent, in a single SSH round-trip.
+
+        :param batch: list of operations (see :mod:`Vitalus.agent`)
+        :param target: run on this target instead of the destination
+        :param timeout: max duration (seconds), None for ssh_timeout
+        :returns: list of results
+        :raises: TARGETError -- if the agent could not be run
+        """
+        if target is None:
+            target = self.destination
+        command = self._ssh_command(*agent.remote_command(), tty=False, target=target)
+        # The catalog may be long
+        self.logger.debug('SSH agent batch: %s', [operation['op'] for operation in batch])
+        if timeout is None:
+            timeout = self.ssh_timeout
+        self.counters['ssh_roundtrips'] += 1
+        returncode, stdout, stderr = await self._communicate(command, timeout,
+                                                              input=json.dumps(batch).encode())
+        try:
+            results = json.loads(stdout.decode())
+        except ValueError:
+            raise TARGETError('Remote agent failed on %s (code %s): %s' %
+                              (target.target, returncode, stderr.decode().strip()))
+        for operation, result in zip(batch, results):
+            if not result['ok']:
+                self.logger.error('Remote %s failed on %s: %s', operation['op'],
+                                  target.target, result['error'])
+        self.logger.debug('SSH agent results: %s', results)
+        return results
+
+    async def _connect(self):
+        """
+        Open the shared SSH connections used by the job
+        """
+        if self.ssh_pool is None:
+            return
+        for target in (self.source, self.destination):
+            if target.is_ssh() and await self.ssh_pool.connect(target.login):
+                # The master ssh process
+                self.counters['subprocesses'] += 1
+                self.counters['ssh_roundtrips'] += 1
+
+    async def _communicate(self, command, timeout=None, input=None):
+        """
+        Run a command in a subprocess and wait for it.
+
+        :param command: Command: each element is a part of the command line
+        :type command: list
+        :param timeout: max duration (in seconds), None for no limit
+        :type timeout: float
+        :param input: data sent to stdin
+        :type input: bytes
+
+        :returns: tuple -- (returncode, stdout, stderr)
+        :raises: TARGETError -- if the command timed out
+
+        .. note::
+
+            If the coroutine is cancelled, the subprocess is killed.
+        """
+        if input is None:
+            stdin = subprocess.DEVNULL
+        else:
+            stdin = subprocess.PIPE
+        self.counters['subprocesses'] += 1
+        start = self.tracer.now() if self.tracer is not None else None
+        # Commands can be long (agent): do not log them in full
+        short_command = ' '.join(command)[:200]
+        with ChildCPU():
+            process = await asyncio.create_subprocess_exec(*command,
+                                                           stdin=stdin,
+                                                           stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+            except asyncio.TimeoutError:
+                self.logger.error('Command timed out after %s seconds: %s',
+                                  timeout, short_command)
+                await utils.kill(process)
+                raise TARGETError('Command timed out: %s' % short_command)
+            except asyncio.CancelledError:
+                self.logger.warning('Command cancelled: %s', short_command)
+                await utils.kill(process)
+                raise
+            finally:
+                self._trace_process(command, process, start)
+        return process.returncode, stdout, stderr
+
+    def _snapshot_names(self):
+        """
+        Return the snapshots in the destination after the transfer,
+        from the listing done by _get_last_backup()
+
+        :returns: list
+        """
+        filenames = list(self.listing)
+        if self.snapshot is False and self.previous_backup_path is not None:
+            # renamed by _prepare_destination()
+            filenames.remove(os.path.basename(self.previous_backup_path))
+        if self.snapshot is True or self.snapshot is False:
+            filenames.append(os.path.basename(self.current_backup_path))
+        return filenames
+
+    def _catalog_entries(self, deleted, returncode, output):
+        """
+        Return the entries of the catalog after this run
+
+        :param deleted: deleted snapshots
+        :param returncode: rsync return code
+        :param output: RsyncOutputParser
+        :returns: list
+        """
+        removed = set(deleted)
+        if self.snapshot is False and self.previous_backup_path is not None:
+            removed.add(os.path.basename(self.previous_backup_path))
+        entries = [entry for entry in self.catalog if entry['name'] not in removed]
+        entries.append({'name': os.path.basename(self.current_backup_path),
+                        'time': time.time(),
+                        'complete': returncode == 0,
+                        # Only the changed files with incremental
+                        'size': (output.stats.get('total_file_size')
+                                 if self.changes is None else None)})
+        entries.sort(key=lambda entry: entry['name'])
+        return entries
+
+    def _trash_path(self):
+        """
+        Return the trash directory of the job in the destination
+        """
+        return os.path.join(self.destination.path, '.trash', self.name)
+
+    async def _delete_old_files(self):
+        """
+        Move old archives to the trash in a local destination,
+        according to the retention policy.
+        They are deleted by purge_trash().
+
+        :returns: list -- deleted archives
+
+        .. note::
+
+            For SSH destinations, see `_finalize_remote()`
+        """
+        #TODO : review logs
+
+        path = os.path.join(self.destination.path, self.name)
+
+        await self.destination.check_availability_async()
+        filenames = self._snapshot_names()
 
-        to_delete = utils.get_older_files(filenames, days, keep)
+        kept, to_delete = history.Snapshots(filenames).select(self.retention, self.now)
         self.logger.debug("Backups available %s ", filenames)
         self.logger.debug("Backups to delete %s ", to_delete)
 
-        self.destination.check_availability()
+        # Renaming is immediate, whatever the size of the archives
+        failed = agent.op_trash([os.path.join(path, element) for element in to_delete],
+                                self._trash_path())
+        deleted = []
+        for element in to_delete:
+            if os.path.join(path, element) in failed:
+                self.logger.error("Impossible to move %s to the trash", element)
+            else:
+                deleted.append(element)
+        return deleted
+
+    async def _write_local_catalog(self, deleted, returncode, output):
+        """
+        Write the catalog of a local destination
+
+        :param deleted: deleted snapshots
+        :param returncode: rsync return code
+        :param output: RsyncOutputParser
+        """
+        path = os.path.join(self.destination.path, self.name)
+        entries = self._catalog_entries(deleted, returncode, output)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, agent.op_write_catalog, path, entries)
+        except OSError as e:
+            self.logger.warning('Could not write the catalog of %s: %s', self.name, e)
+
+    async def _finalize_remote(self, returncode, output):
+        """
+        Delete old archives (according to the retention policy),
+        update the symlink and the catalog
+        on a SSH destination, in a single round-trip.
+
+        :param returncode: rsync return code
+        :param output: RsyncOutputParser
+        """
+        path = os.path.join(self.destination.path, self.name)
+
+        # The listing was done by _get_last_backup()
+        filenames = self._snapshot_names()
+
+        kept, to_delete = history.Snapshots(filenames).select(self.retention, self.now)
+        self.logger.debug("Backups available %s ", filenames)
+        self.logger.debug("Backups to delete %s ", to_delete)
+
+        batch = []
+        if to_delete:
+            batch.append({'op': 'trash',
+                          'paths': [os.path.join(path, element) for element in to_delete],
+                          'trash': self._trash_path()})
+        if self.snapshot is True or self.snapshot is False:
+            batch.append({'op': 'symlink',
+                          'target': os.path.basename(self.current_backup_path),
+                          'link': os.path.join(path, 'last')})
+            # Last change in the job directory
+            batch.append({'op': 'write_catalog', 'path': path,
+                          'entries': self._catalog_entries(to_delete, returncode, output)})
+        if batch == []:
+            return
+
+        await self.destination.check_availability_async()
+        results = await self._run_agent(batch)
+        failed = []
+        if to_delete:
+            if results[0]['ok']:
+                failed = [os.path.basename(element) for element in results[0]['result']]
+            else:
+                # e.g. the trash could not be created: nothing was moved
+                failed = list(to_delete)
+            for element in failed:
+                self.logger.error("Impossible to move %s to the trash", element)
+            self.trash = (self.trash or []) + [element for element in to_delete
+                                               if element not in failed]
+        if failed and self.catalog is not None:
+            # The catalog must list them
+            deleted = [element for element in to_delete if element not in failed]
+            await self._run_agent([{'op': 'write_catalog', 'path': path,
+                                    'entries': self._catalog_entries(deleted, returncode, output)}])
+
+    async def purge_trash(self, pause=0., unknown=True):
+        """
+        Delete the archives moved to the trash of the destination
+        and of the mirrors. An unavailable destination is skipped,
+        its trash is deleted by a next call.
+
+        :param pause: sleep (seconds) every agent.THROTTLE deleted files
+        :type pause: float
+        :param unknown: also connect to the SSH destinations
+            whose trash was not listed by this run
+        :type unknown: bool
+        """
+        for job in [self] + self.mirrors:
+            try:
+                await job._purge_trash(pause, unknown)
+            except TARGETError as e:
+                self.logger.warning(e)
+
+    async def _purge_trash(self, pause, unknown):
+        """
+        Delete the archives moved to the trash of the destination
+
+        :param pause: sleep (seconds) every agent.THROTTLE deleted files
+        :param unknown: purge even if the trash was not listed
+        """
+        trash = self._trash_path()
         if self.destination.is_local():
-            for element in to_delete:
-                self.logger.debug("Remove backup %s", element)
-                try:
-                    shutil.rmtree(os.path.join(path, element))
-                except OSError:
-                    self.logger.debug("Could not delete %s, try to chmod 644",
-                                      os.path.join(path, element))
-                    utils.r_chmod(os.path.join(path, element), 0o664)
-                    try:
-                        # try again
-                        shutil.rmtree(os.path.join(path, element))
-                    except OSError:
-                        self.logger.error("Impossible to delete %s (symlink?)",
-                                          os.path.join(path, element))
+            await self.destination.check_availability_async()
+            failed = await asyncio.get_running_loop().run_in_executor(
+                None, agent.op_purge, trash, pause)
         elif self.destination.is_ssh():
-            filepaths = [os.path.join(path, element) for element in to_delete]
-            if filepaths != []:
-                command = ['ssh', '-t', self.destination.login, 'rm', '-rf']
-                command.extend(filepaths)
-                self.logger.debug('SSH rm command: ' + str(command))
-                process = subprocess.Popen(command, bufsize=4096, stdout=subprocess.PIPE)
-                stdout, stderr = process.communicate()
+            # Known by the listing or moved by this run
+            if self.trash == [] or (self.trash is None and not unknown):
+                return
+            await self.destination.check_availability_async()
+            await self._connect()
+            results = await self._run_agent([{'op': 'purge', 'path': trash, 'pause': pause}],
+                                            timeout=self.purge_timeout)
+            failed = results[0]['result'] if results[0]['ok'] else []
+            self.trash = []
+        for element in failed:
+            self.logger.error("Impossible to delete %s", element)
 
-    def _get_last_backup(self):
+    async def _get_last_backup(self):
         """
         Get the last backup path
         Return None if not available
@@ -183,50 +797,72 @@ class RsyncJob(Job):
         :returns: string
         """
         path = os.path.join(self.destination.path, self.name)
-        self.destination.check_availability()
+        await self.destination.check_availability_async()
+        # Without history, the job directory is the backup: no catalog
+        if self.snapshot is None:
+            listing = {'op': 'listdir', 'path': path}
+        else:
+            listing = {'op': 'catalog', 'path': path}
         if self.destination.is_local():
-            if not os.path.isdir(path):
-                return None
-            #filenames = [os.path.join(path, el) for el in os.listdir(path)]
-            filenames = os.listdir(path)
+            # Listing may be slow (e.g. USB disks), do not block the event loop
+            result = await asyncio.get_running_loop().run_in_executor(
+                None, agent.execute, [listing])
+            result = result[0]
+            if not result['ok']:
+                raise TARGETError('Could not list %s: %s' % (path, result['error']))
+            result = result['result']
         elif self.destination.is_ssh():
-            # First, create at least the target if does not exists
-            command = ['ssh', '-t', self.destination.login, 'mkdir', '-p', path]
-            self.logger.debug('SSH mkdir command: ' + str(command))
-            process = subprocess.Popen(command, bufsize=4096, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            self.logger.debug('SSH mkdir result: ' + stdout.decode())
-
-            command = ['ssh', '-t', self.destination.login, 'ls', '-1', path]
-            self.logger.debug('SSH ls command: ' + str(command))
-            process = subprocess.Popen(command, bufsize=4096, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            filenames = stdout.decode()
-            filenames = filenames.split('\n')
-            filenames = [x.strip('\r') for x in filenames if x != '']
-
-        last = utils.get_last_file(filenames)
+            # Create at least the target if does not exists
+            # and list it in the same round-trip
+            # The trash left by a previous run is deleted by purge_trash()
+            results = await self._run_agent([{'op': 'mkdir', 'path': path}, listing,
+                                             {'op': 'listdir', 'path': self._trash_path()},
+                                             {'op': 'statvfs', 'path': path}])
+            if not results[1]['ok']:
+                raise TARGETError('Could not list %s on %s' % (path, self.destination.target))
+            result = results[1]['result']
+            if results[2]['ok']:
+                self.trash = results[2]['result']
+            if results[3]['ok']:
+                self.free_space = results[3]['result']['free']
+
+        if self.snapshot is None:
+            self.listing = result
+        else:
+            if result['rebuilt']:
+                self.logger.info('Catalog of %s rebuilt from the listing of %s',
+                                 self.name, self.destination.target)
+            self.catalog = result['entries']
+            self.listing = [entry['name'] for entry in self.catalog]
+
+        last = utils.get_last_file(self.listing)
         if last is not None:
             last = os.path.join(path, last)
         self.logger.debug('_get_last_backup returns: %s', last)
         return last
 
-    def _prepare_destination(self):
+    def _backup_path(self):
+        """
+        Return the path of the current backup in the destination
+
+        :returns: string
+        """
+        if self.snapshot is True or self.snapshot is False:
+            return os.path.join(self.destination.path, self.name, str(self.current_date))
+        elif self.snapshot is None:
+            return os.path.join(self.destination.path, self.name)
+        else:
+            raise ValueError('Wrong snapshot value (True, False or None)')
+
+    async def _prepare_destination(self):
         """
         Prepare the destination to receive a backup:
         Create dirs
         """
-        self.destination.check_availability()
+        await self.destination.check_availability_async()
 
         # Define current backup path
-        if self.snapshot is True:
-            self.current_backup_path = os.path.join(self.destination.path, self.name, str(self.current_date))
-        elif self.snapshot is False:
-            self.current_backup_path = os.path.join(self.destination.path, self.name, str(self.current_date))
-        elif self.snapshot is None:
-            self.current_backup_path = os.path.join(self.destination.path, self.name)
-        else:
-            raise ValueError('Wrong snapshot value (True, False or None)')
+        self.current_backup_path = self._backup_path()
 
         # Make dirs
         if self.destination.is_local():
@@ -243,36 +879,80 @@ class RsyncJob(Job):
                 if not os.path.exists(self.current_backup_path):
                     os.makedirs(self.current_backup_path, exist_ok=True)
         elif self.destination.is_ssh():
-            # Create dirs
-            command = ['ssh', '-t', self.destination.login, 'mkdir', '-p', self.current_backup_path]
-            self.logger.debug('SSH mkdir command: ' + str(command))
-            process = subprocess.Popen(command, bufsize=4096, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            self.logger.debug('SSH mkdir result: ' + stdout.decode())
+            # The job directory was created by _get_last_backup()
+            # and rsync creates the last component of the path.
+            if self.snapshot is False and self.previous_backup_path is not None:
+                # Move dir to set the new date in the path
+                results = await self._run_agent([{'op': 'rename',
+                                                  'src': self.previous_backup_path,
+                                                  'dst': self.current_backup_path}])
+                if not results[0]['ok']:
+                    raise TARGETError('Could not rename %s on %s' %
+                                      (self.previous_backup_path, self.destination.target))
 
-    def _prepare_rsync_command(self):
+    def _prepare_rsync_command(self, sources=None, recursive=True,
+                               write_batch=None, read_batch=None, files_from=None):
         """
         Compose the rsync command
+
+        :param sources: transfer these paths of the source (rsync --relative)
+            instead of the whole source
+        :type sources: list
+        :param recursive: if False, only the first level of the directories
+            is transferred (rsync --dirs)
+        :type recursive: bool
+        :param write_batch: record the delta in this file
+        :type write_batch: string
+        :param read_batch: apply the delta of this file instead of reading the source
+        :type read_batch: string
+        :param files_from: transfer only the paths listed in this file
+            (relative to the source, separated by null characters)
+        :type files_from: string
         """
         command = list()
         command.append('/usr/bin/rsync')
 
         # a: archive (recursivity, preserve rights and times...)
         # v: verbose
-        # h: human readable
+        # no-human-readable: exact numbers in the stats (parsed)
         # stat: file rate stats
         # delete: delete extraneous files from dest dirs
         # delete-excluded: also delete excluded files from dest dirs
         # L: turn symlinks to dir/file
-        command.append('-avh')
+        # itemize-changes: one line per change, parsed
+        if recursive:
+            command.append('-av')
+        else:
+            # -a without recursion
+            command.append('-lptgoDdv')
+        command.append('--no-human-readable')
         command.append('--stats')
-        command.append('--delete')
-        command.append('--delete-excluded')
+        command.append('--itemize-changes')
+        if files_from is None:
+            command.append('--delete')
+            command.append('--delete-excluded')
+        else:
+            # Not recursive: the listed paths only,
+            # the paths missing in the source are deleted
+            command.append('--files-from=' + files_from)
+            command.append('--from0')
+            command.append('--delete-missing-args')
+            command.append('--force')
         command.append('-L')
 
+        if self.tuning is not None:
+            # compression, whole-file, block-size chosen by the auto-tuner
+            command.extend(tuning.rsync_options(self.tuning))
         # z: compress the flux if transfert thought a network
-        if (self.source.is_ssh() or self.destination.is_ssh()):
+        elif (self.source.is_ssh() or self.destination.is_ssh()):
             command.append('-z')
+        # rsh: reuse the shared SSH connections
+        if (self.source.is_ssh() or self.destination.is_ssh()) and self.ssh_pool is not None:
+            command.append('--rsh=' + self.ssh_pool.rsync_shell())
+        if self.dest_uid and self.dest_gid:
+            # Owner of the destination files, set by the receiver
+            # (compared before --link-dest, no walk afterwards)
+            command.append('--chown=%s:%s' % (self.dest_uid, self.dest_gid))
         if self.snapshot and self.previous_backup_path is not None:
             # Even if it works for ttype==Dir
             # It fails for ttype=SSH
@@ -280,8 +960,19 @@ class RsyncJob(Job):
             path = os.path.basename(self.previous_backup_path)
             command.append('--link-dest=../' + path)
 
+        if write_batch is not None:
+            command.append('--write-batch=' + write_batch)
+
         # Add source and destination
-        command.append(self.source.target)
+        if read_batch is not None:
+            command.append('--read-batch=' + read_batch)
+        elif files_from is not None:
+            command.append(self._files_from_root()[0])
+        elif sources is None:
+            command.append(self.source.target)
+        else:
+            command.append('--relative')
+            command.extend(sources)
         if self.destination.is_ssh():
             full_dest = str(self.destination.login) + ':' + str(self.current_backup_path)
             command.append(full_dest)
@@ -298,107 +989,440 @@ class RsyncJob(Job):
         self.logger.debug("rsync command: %s", command)
         return command
 
-    def _run_command(self, command):
+    def _source_root(self):
+        """
+        Return the source path with a /./ marking
+        the root of the paths kept by rsync --relative
+
+        :returns: string
+        """
+        path = self.source.path
+        if path.endswith('/'):
+            # The content is copied
+            root = path + './'
+        else:
+            # The directory is copied
+            head, tail = os.path.split(path)
+            root = os.path.join(head, '.', tail) + '/'
+        if self.source.is_ssh():
+            root = self.source.login + ':' + root
+        return root
+
+    async def _source_entries(self):
+        """
+        Return the top-level entries of the source
+        with an estimation of their size
+
+        :returns: dict -- {name: weight}
+        """
+        if self.source.is_local():
+            if not os.path.isdir(self.source.path):
+                return {}
+            return await asyncio.get_running_loop().run_in_executor(
+                None, utils.estimate_entries, self.source.path)
+        results = await self._run_agent([{'op': 'listdir', 'path': self.source.path}],
+                                        target=self.source)
+        if not results[0]['ok']:
+            return {}
+        # The size is unknown
+        return dict((name, 1) for name in results[0]['result'])
+
+    async def _run_sharded(self):
+        """
+        Run the transfer with several rsync processes.
+
+        The top-level entries of the source are split in shards
+        of similar estimated sizes. A last non-recursive pass
+        removes the top-level entries deleted in the source.
+
+        :returns: tuple -- (return code, parser) combined for all processes
+        """
+        entries = await self._source_entries()
+        shards = utils.split_balanced(entries, self.shards)
+        shards = [shard for shard in shards if shard]
+        self.logger.debug('%s shards for %s: %s', len(shards), self.name, shards)
+        if len(shards) < 2:
+            return await self._run_command(self._prepare_rsync_command())
+
+        root = self._source_root()
+        commands = [self._prepare_rsync_command(sources=[root + name for name in shard])
+                    for shard in shards]
+        results = await asyncio.gather(*[self._run_command(command) for command in commands])
+        results.append(await self._run_command(self._prepare_rsync_command(sources=[root],
+                                                                           recursive=False)))
+
+        returncode = 0
+        output = RsyncOutputParser()
+        for shard_returncode, shard_output in results:
+            if shard_returncode != 0:
+                self.logger.warning('A rsync shard exited with code %s for %s',
+                                    shard_returncode, self.name)
+                if returncode == 0:
+                    returncode = shard_returncode
+            output.merge(shard_output)
+        return returncode, output
+
+    async def _run_command(self, command):
         """
         Run a command and log stderr+stdout in a dedicated log file.
 
+        Outputs are read line by line while the command runs
+        and stdout is parsed by :class:`Vitalus.rsyncparser.RsyncOutputParser`.
+
         :param command: Command: each element is a part of the command line
         :type command: list
 
+        :returns: tuple -- (return code, parser)
+        :raises: TARGETError -- if the command timed out
+
         .. note::
 
             Example of the command format
             command = ['/usr/bin/cp', '-r', '/home', '/tmp']
         """
-        # Run the command
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        parser = RsyncOutputParser()
+        start = self.tracer.now() if self.tracer is not None else None
+        self.counters['subprocesses'] += 1
+        if self.source.is_ssh() or self.destination.is_ssh():
+            # rsync session over SSH
+            self.counters['ssh_roundtrips'] += 1
+        with ChildCPU() as usage:
+            # C locale: the output is parsed
+            process = await asyncio.create_subprocess_exec(*command,
+                                                           stdin=subprocess.DEVNULL,
+                                                           stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE,
+                                                           limit=self.line_limit,
+                                                           env=dict(os.environ, LC_ALL='C'))
+            try:
+                await asyncio.wait_for(asyncio.gather(self._log_stream(process.stdout, parser),
+                                                      self._log_stream(process.stderr, None)),
+                                       self.timeout)
+                returncode = await process.wait()
+            except asyncio.TimeoutError:
+                self.logger.error('Command timed out after %s seconds: %s',
+                                  self.timeout, command)
+                await utils.kill(process)
+                raise TARGETError('Command timed out: %s' % ' '.join(command))
+            except asyncio.CancelledError:
+                self.logger.warning('Command cancelled: %s', command)
+                await utils.kill(process)
+                raise
+            finally:
+                self._trace_process(command, process, start)
+        # Unknown if other commands ran at the same time
+        if usage.cpu is None or self.cpu is None:
+            self.cpu = None
+        else:
+            self.cpu += usage.cpu
+        return returncode, parser
 
-        # Dump outputs in log files
-        log = stdout.decode()
-        self.job_logger.info(log)
+    async def _log_stream(self, stream, parser):
+        """
+        Write a stream in the job log, by chunks of lines.
 
-        if stderr != b'':
-            self.job_logger.info('Errors:')
-            self.job_logger.info(stderr.decode())
+        :param stream: stdout or stderr of the process
+        :param parser: parser fed with each line, None for stderr
+        """
+        chunk = []
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # Longer than line_limit: asyncio drops it
+                self.logger.warning('Line too long in the output of %s, skipped', self.name)
+                continue
+            if not line:
+                break
+            line = line.decode(errors='replace').rstrip('\r\n')
+            if parser is not None:
+                parser.feed(line)
+            else:
+                line = 'Errors: ' + line
+            chunk.append(line)
+            if len(chunk) >= self.log_chunk:
+                self.job_logger.info('\n'.join(chunk))
+                chunk = []
+        if chunk:
+            self.job_logger.info('\n'.join(chunk))
 
     def run(self, uid=None, gid=None):
         """
         Run the job.
         """
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        Run the job (coroutine).
+        """
         self.logger.debug('Start rsync job: %s', self.name)
-        #TODO rewriting and integration:
-        #self._check_disk_usage()
 
         try:
-            last_date = self._get_last_backup()
-            if last_date is None:
-                # It means that this is the first backup.
-                self.previous_backup_path = None
-            else:
-                #self.previous_backup_path = os.path.join(self.destination.path, self.name, str(last_date))
-                self.previous_backup_path = last_date
-
-            self.logger.debug("Previous backup path: %s", self.previous_backup_path)
-            self.logger.debug("Current backup path: %s", self.current_backup_path)
-
             if self._check_need_backup() or self.force:
                 self.job_logger.info('='*20 + str(self.now) + '='*20)
                 self.logger.debug('Start Backup: %s', self.name)
                 print(self.name)
+                self._emit('job_start', destination=self.destination.target)
 
-                # Prepare the destination
-                self._prepare_destination()
-                self.logger.debug("source path %s", self.source.target)
-                self.logger.debug("destination path %s", self.destination.target)
-                self.logger.debug("filter path %s", self.filter)
-
-                # Run rsync
-                command = self._prepare_rsync_command()
-                self._run_command(command)
+                # The delta is recorded once for all mirrors
+                batch = None
+                if self.mirrors:
+                    batch = os.path.join(self.backup_log_dir, self.name + '.batch')
+                returncode, output = await self._backup(write_batch=batch)
+                if returncode is None:
+                    # The last backup is up to date
+                    self._set_lastbackup_time()
+                    self._record_run('unchanged', 0)
+                    self._job_end('success', bytes=0, unchanged=True)
+                    return
+                # The mirrors receive the same delta
+                self.expected_delta = output.stats.get('total_transferred_file_size')
 
                 # Job done, update the time in the database
                 self._set_lastbackup_time()
+                status = 'success' if returncode == 0 else 'partial'
+                self._record_run(status, output.stats.get('total_transferred_file_size'))
+                self._job_end(status, returncode, output.stats.get('total_transferred_file_size'))
 
-                # Remove old snapshots
-                self._delete_old_files(days=self.duration, keep=self.keep)
-
-                # Create symlink
-                if self.snapshot is True or self.snapshot is False:
-                    last = os.path.join(self.destination.path, self.name, 'last')
-                    if self.destination.is_local():
-                        if os.path.islink(last):
-                            os.remove(last)
-                        os.chdir(os.path.dirname(self.current_backup_path))
-                        try:
-                            os.symlink(os.path.basename(self.current_backup_path), last)
-                        except FileExistsError:
-                            self.logger.warning('The symlink %s could not be created because a file exists', last)
-                        except AttributeError:
-                            self.logger.warning('Attribute error for symlink. Job: %s', self.name)
-                    elif self.destination.is_ssh():
-                        self.logger.warning('symlink for SSH not yet implemented')
-                        #TODO Create symlink
-
-                # UID/GID
-                if self.dest_uid and self.dest_gid:
-                    self._chown_destination(self.dest_uid, self.dest_gid)
-                elif (self.dest_uid and not self.dest_gid) or (not self.dest_uid and self.dest_gid):
-                    self.logger.error('uid or gid missing')
+                if self.stats is not None:
+                    self.stats.record(self.name, self.now, returncode, output.stats, self.phases,
+                                      self.cpu, self.tuning)
 
                 self.logger.info("Backup %s done", self.name)
+
+                mirrors_done = True
+                if self.mirrors:
+                    if returncode != 0:
+                        # The batch may be incomplete
+                        self.logger.warning('Full transfer to the mirrors of %s', self.name)
+                        mirrors_done = await self._run_mirrors(None)
+                    else:
+                        mirrors_done = await self._run_mirrors(batch)
+
+                # The next run compares the source to this one
+                if self.source_digest is not None and returncode == 0 and mirrors_done:
+                    self._get_state().set_fingerprint(self.name, self.source_digest,
+                                                      os.path.basename(self.current_backup_path),
+                                                      self._transfer_settings())
+                if self.index is not None and returncode == 0:
+                    self.index.commit(os.path.basename(self.current_backup_path),
+                                      self.index_full, self._transfer_settings())
         except TARGETError as e:
             self.logger.warning(e)
+            self._record_run('failed')
+            self._emit('error', message=str(e))
+            self._job_end('failed')
+        except Exception as e:
+            # Logged by the caller
+            self._emit('error', message='%s: %s' % (type(e).__name__, e))
+            self._job_end('failed')
+            raise
+        finally:
+            if self.index is not None:
+                self.index.close()
 
-    def _chown_destination(self, uid, gid):
+    def _job_end(self, status, returncode=None, bytes=None, unchanged=False):
         """
-        Change owner of files in destination
+        Write the job_end event and send the measures of the run
 
-        :param uid: user ID
-        :param gid: group ID
+        :param status: 'success', 'partial' or 'failed'
+        :param returncode: rsync return code
+        :param bytes: bytes written in the destination
+        :param unchanged: the source is unchanged, rsync was not run
         """
-        if self.destination.is_local():
-            self.logger.debug('chown %s %s for %s' % (uid, gid, self.current_backup_path))
-            utils.r_chown(self.current_backup_path, uid, gid)
-        elif self.destination.is_ssh():
-            self.logger.warning('chown for SSH not yet implemented')
+        duration = sum(self.phases.values())
+        self._emit('job_end', destination=self.destination.target, status=status,
+                   returncode=returncode, bytes=bytes, duration=duration,
+                   phases=self.phases, counters=self.counters, unchanged=unchanged)
+        if self.metrics is not None:
+            # The last backup is also updated by the partial runs
+            successes = [run['end'] for run in self._get_state().runs(self.name)
+                         if run['status'] in ('success', 'unchanged')]
+            self.metrics.record_job(self.name, {
+                'status': status, 'returncode': returncode, 'bytes': bytes,
+                'duration': duration, 'phases': self.phases, 'counters': self.counters,
+                'period': self.period, 'timestamp': time.time(),
+                'last_success': successes[-1].timestamp() if successes else None})
+
+    async def _backup(self, write_batch=None, read_batch=None):
+        """
+        Make a backup in the destination:
+        prepare the destination, transfer, remove old snapshots,
+        create the symlink.
+
+        :param write_batch: record the delta in this file (rsync --write-batch)
+        :param read_batch: apply the delta recorded in this file (rsync --read-batch)
+        instead of reading the source. If it fails, the source is read.
+        :returns: tuple -- (return code, parser),
+            (None, None) if the source is unchanged (see fingerprint)
+        :raises: TARGETError -- if the destination is not available
+        """
+        with self._phase('availability'):
+            # Probed at the start of the run for SSH
+            await self.destination.check_availability_async()
+        with self._phase('connect'):
+            await self._connect()
+        with self._phase('listing'):
+            last_date = await self._get_last_backup()
+        if last_date is None:
+            # It means that this is the first backup.
+            self.previous_backup_path = None
+        else:
+            #self.previous_backup_path = os.path.join(self.destination.path, self.name, str(last_date))
+            self.previous_backup_path = last_date
+
+        self.logger.debug("Previous backup path: %s", self.previous_backup_path)
+        self.logger.debug("Current backup path: %s", self.current_backup_path)
+
+        if self.fingerprint:
+            with self._phase('fingerprint'):
+                self.source_digest = await self._source_fingerprint()
+            if self._source_unchanged():
+                self.logger.info('Source of %s unchanged, no transfer', self.name)
+                return None, None
+            # Until this backup succeeds
+            self._get_state().set_fingerprint(self.name, None)
+
+        if self.incremental:
+            with self._phase('index'):
+                self.changes = await self._scan_source()
+
+        if self.space_check is not None:
+            with self._phase('space'):
+                await self._check_disk_usage()
+
+        # Prepare the destination
+        with self._phase('prepare'):
+            await self._prepare_destination()
+        files_from = None
+        if self.changes is not None:
+            with self._phase('link'):
+                files_from = await self._prepare_incremental(self.changes)
+        self.logger.debug("source path %s", self.source.target)
+        self.logger.debug("destination path %s", self.destination.target)
+        self.logger.debug("filter path %s", self.filter)
+
+        if self.tuner is not None:
+            network = self.source.is_ssh() or self.destination.is_ssh()
+            self.tuning = self.tuner.choose(self.name, network)
+            self.logger.debug('Transfer options of %s: %s', self.name, self.tuning)
+
+        async def transfer():
+            if read_batch is not None:
+                command = self._prepare_rsync_command(read_batch=read_batch)
+                returncode, output = await self._run_command(command)
+                if returncode != 0:
+                    # e.g. the destination differs from the one of the batch
+                    self.logger.warning('Batch not applied on %s (code %s), full transfer',
+                                        self.destination.target, returncode)
+                    command = self._prepare_rsync_command()
+                    returncode, output = await self._run_command(command)
+                return returncode, output
+            elif self.shards > 1 and write_batch is None:
+                return await self._run_sharded()
+            else:
+                command = self._prepare_rsync_command(write_batch=write_batch,
+                                                      files_from=files_from)
+                return await self._run_command(command)
+
+        # Run rsync
+        try:
+            with self._phase('transfer'):
+                returncode, output = await transfer()
+                if (returncode in tuning.REFUSED and self.tuning is not None and
+                        tuning.fallback(self.tuning) != self.tuning):
+                    # The remote rsync may not know the compression (rsync < 3.2)
+                    self.logger.warning('rsync exited with code %s for %s with %s, '
+                                        'retry with zlib', returncode, self.name,
+                                        self.tuning['compress'])
+                    self.tuning = tuning.fallback(self.tuning)
+                    returncode, output = await transfer()
+        finally:
+            # Also on a timeout or a cancellation
+            if files_from is not None:
+                os.remove(files_from)
+        if returncode != 0:
+            self.logger.warning('rsync exited with code %s for %s', returncode, self.name)
+        self.logger.debug('Changes: %s', output.changes)
+
+        if (self.dest_uid and not self.dest_gid) or (not self.dest_uid and self.dest_gid):
+            self.logger.error('uid or gid missing')
+
+        if self.destination.is_ssh():
+            # Remove old snapshots and create symlink
+            with self._phase('finalize'):
+                await self._finalize_remote(returncode, output)
+        else:
+            # Remove old snapshots
+            with self._phase('retention'):
+                deleted = await self._delete_old_files()
+
+            # Create symlink
+            if self.snapshot is True or self.snapshot is False:
+                with self._phase('symlink'):
+                    self._create_symlink()
+
+            # Last change in the job directory
+            if self.catalog is not None:
+                with self._phase('catalog'):
+                    await self._write_local_catalog(deleted, returncode, output)
+
+        return returncode, output
+
+    async def _run_mirrors(self, batch):
+        """
+        Backup to all mirrors concurrently.
+        A mirror failing does not stop the others.
+
+        :param batch: rsync batch file to apply, None to read the source
+        :returns: bool -- True if all mirrors succeeded
+        """
+        async def run_mirror(mirror):
+            # Same delta as this job
+            mirror.expected_delta = self.expected_delta
+            mirror.tracer = self.tracer
+            try:
+                returncode, output = await mirror._backup(read_batch=batch)
+                self.logger.info("Mirror %s of %s done", mirror.destination.target, self.name)
+                self._emit('mirror_end', destination=mirror.destination.target,
+                           status='success' if returncode == 0 else 'partial')
+                return returncode == 0
+            except TARGETError as e:
+                self.logger.warning(e)
+                self._emit('error', message=str(e))
+                self._emit('mirror_end', destination=mirror.destination.target, status='failed')
+                return False
+            except Exception as e:
+                # The other mirrors still read the batch
+                self.logger.exception('Exception raised in the mirror %s of %s',
+                                      mirror.destination.target, self.name)
+                self._emit('error', message='%s: %s' % (type(e).__name__, e))
+                self._emit('mirror_end', destination=mirror.destination.target, status='failed')
+                return False
+
+        try:
+            return all(await asyncio.gather(*[run_mirror(mirror) for mirror in self.mirrors]))
+        finally:
+            if batch is not None:
+                # rsync writes the batch and a script to apply it
+                for path in (batch, batch + '.sh'):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def _create_symlink(self):
+        """
+        Create the symlink 'last' to the current backup
+        in a local destination
+        """
+        last = os.path.join(self.destination.path, self.name, 'last')
+        if os.path.islink(last):
+            os.remove(last)
+        # The link is relative to its directory,
+        # no need to chdir (not thread safe)
+        try:
+            os.symlink(os.path.basename(self.current_backup_path), last)
+        except FileExistsError:
+            self.logger.warning('The symlink %s could not be created because a file exists', last)
+        except AttributeError:
+            self.logger.warning('Attribute error for symlink. Job: %s', self.name)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import re
+
+# Itemized change: YXcstpoguax path (see --itemize-changes in man rsync)
+ITEMIZE = re.compile(r'^([<>ch.*])([fdLDS])([.+?a-zA-Z ]{9,10}) (.+)$')
+DELETING = re.compile(r'^\*deleting +(.+)$')
+# Stats block: "Label: value ..."
+STAT = re.compile(r'^([A-Z][A-Za-z ]+): ([0-9.]+)')
+SUMMARY_SENT = re.compile(r'^sent ([0-9]+) bytes +received ([0-9]+) bytes')
+SUMMARY_SPEEDUP = re.compile(r'^total size is ([0-9]+) +speedup is ([0-9.]+)')
+
+
+def parse_number(value):
+    """
+    Convert a number printed by rsync --no-human-readable
+    in the C locale (exact counts, a period for the decimals)
+
+    :param value: number
+    :returns: int or float
+    """
+    if '.' in value:
+        return float(value)
+    return int(value)
+
+
+class RsyncOutputParser:
+    """
+    Parse the output of rsync --itemize-changes --stats line by line.
+
+    Only counters are kept, so the memory does not depend
+    on the number of files.
+
+    :attr changes: counters of itemized changes
+        (created, updated, deleted, attributes)
+    :attr stats: numbers of the --stats block,
+        named like the labels (e.g. 'total_bytes_sent')
+    """
+    def __init__(self):
+        self.changes = {'created': 0, 'updated': 0, 'deleted': 0, 'attributes': 0}
+        self.stats = {}
+
+    def feed(self, line):
+        """
+        Parse a line of stdout
+
+        :param line: a line, without the end of line
+        :type line: string
+        """
+        match = DELETING.match(line)
+        if match:
+            self.changes['deleted'] += 1
+            return
+        match = ITEMIZE.match(line)
+        if match:
+            update, ftype, attributes, path = match.groups()
+            if '+' in attributes:
+                self.changes['created'] += 1
+            elif update in '<>c':
+                self.changes['updated'] += 1
+            else:
+                self.changes['attributes'] += 1
+            return
+        match = STAT.match(line)
+        if match:
+            label, value = match.groups()
+            key = label.strip().lower().replace(' ', '_')
+            self.stats[key] = parse_number(value)
+            return
+        match = SUMMARY_SENT.match(line)
+        if match:
+            self.stats['sent'] = parse_number(match.group(1))
+            self.stats['received'] = parse_number(match.group(2))
+            return
+        match = SUMMARY_SPEEDUP.match(line)
+        if match:
+            self.stats['total_size'] = parse_number(match.group(1))
+            self.stats['speedup'] = parse_number(match.group(2))
+
+    def merge(self, other):
+        """
+        Add the counters of another parser
+        (e.g. several rsync processes for a single transfer)
+
+        :param other: RsyncOutputParser
+        """
+        for key, value in other.changes.items():
+            self.changes[key] += value
+        for key, value in other.stats.items():
+            if key == 'speedup':
+                continue
+            self.stats[key] = self.stats.get(key, 0) + value
+        # speedup: total size / (sent + received)
+        exchanged = self.stats.get('sent', 0) + self.stats.get('received', 0)
+        if 'total_size' in self.stats and exchanged:
+            self.stats['speedup'] = round(self.stats['total_size'] / exchanged, 2)
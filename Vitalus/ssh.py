@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import asyncio
+import fnmatch
+import logging
+import shutil
+import subprocess
+import tempfile
+
+import Vitalus.utils as utils
+from Vitalus.trace import ChildCPU
+
+
+def read_config(host, path='~/.ssh/config'):
+    """
+    Return the options of ~/.ssh/config applying to a host.
+
+    As ssh does, the first value found for an option is used.
+    Match and Include directives are not supported.
+
+    :param host: host name (as written in the target)
+    :param path: ssh config file
+    :returns: dict -- lowercase option names: values
+    """
+    options = {}
+    try:
+        with open(os.path.expanduser(path)) as config:
+            lines = config.readlines()
+    except (IOError, OSError):
+        return options
+
+    applies = True  # options before the first Host apply to all
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        if '=' in line.split()[0]:
+            key, value = line.split('=', 1)
+        else:
+            fields = line.split(None, 1)
+            if len(fields) < 2:
+                continue
+            key, value = fields
+        key = key.strip().lower()
+        value = value.strip().strip('"')
+        if key == 'host':
+            applies = _host_matches(host, value.split())
+        elif key == 'match':
+            applies = False
+        elif applies and key not in options:
+            options[key] = value
+    return options
+
+
+def _host_matches(host, patterns):
+    """
+    Return True if host matches the patterns of a Host line
+    """
+    matched = False
+    for pattern in patterns:
+        if pattern.startswith('!'):
+            if fnmatch.fnmatch(host, pattern[1:]):
+                return False
+        elif fnmatch.fnmatch(host, pattern):
+            matched = True
+    return matched
+
+
+class SSHPool:
+    """
+    Share a single SSH connection per login during a run.
+
+    A master connection (ControlMaster) is opened for each login
+    and all ssh commands (and rsync -e) go through it.
+
+    :param persist: the master exits after this idle time (seconds),
+    in case close() is never called
+    :type persist: int
+    :param timeout: max duration of the opening of a master (seconds)
+    :type timeout: int
+    """
+    def __init__(self, persist=600, timeout=30):
+        self.persist = persist
+        self.timeout = timeout
+        self.logger = logging.getLogger('Vitalus.SSHPool')
+        self.control_dir = None
+        self.masters = set()
+        self._locks = {}
+
+    def _control_path(self):
+        """
+        Return the control socket path pattern.
+        The directory is created on first use.
+        """
+        if self.control_dir is None:
+            # Short path: unix sockets are limited to ~100 chars
+            self.control_dir = tempfile.mkdtemp(prefix='vitalus-ssh-')
+        return os.path.join(self.control_dir, '%C')
+
+    def options(self):
+        """
+        Return ssh options to use the master connection.
+        If the master does not exist, ssh connects directly.
+
+        :returns: list
+        """
+        return ['-o', 'ControlMaster=no',
+                '-o', 'ControlPath=' + self._control_path()]
+
+    def command(self, login, *args, tty=True):
+        """
+        Return a ssh command using the master connection.
+
+        :param login: user@host
+        :param args: remote command
+        :param tty: request a tty
+        :returns: list
+        """
+        if tty:
+            return ['ssh'] + self.options() + ['-t', login] + list(args)
+        return ['ssh'] + self.options() + [login] + list(args)
+
+    def rsync_shell(self):
+        """
+        Return the remote shell for rsync -e
+
+        :returns: string
+        """
+        return ' '.join(['ssh'] + self.options())
+
+    async def connect(self, login):
+        """
+        Open the master connection for a login, if not already done.
+
+        :param login: user@host
+        :returns: bool -- True if a master ssh process was run
+        """
+        if login not in self._locks:
+            self._locks[login] = asyncio.Lock()
+        async with self._locks[login]:
+            if login in self.masters:
+                return False
+            # No password prompt: a host waiting for one would hold the lock
+            command = ['ssh', '-f', '-N',
+                       '-o', 'BatchMode=yes',
+                       '-o', 'ConnectTimeout=%i' % self.timeout,
+                       '-o', 'ControlMaster=yes',
+                       '-o', 'ControlPersist=%i' % self.persist,
+                       '-o', 'ControlPath=' + self._control_path(),
+                       login]
+            self.logger.debug('SSH master command: %s', command)
+            # The master runs in background and keeps its stdio:
+            # do not wait for pipes
+            with ChildCPU():
+                process = await asyncio.create_subprocess_exec(*command,
+                                                               stdin=subprocess.DEVNULL,
+                                                               stdout=subprocess.DEVNULL,
+                                                               stderr=subprocess.DEVNULL)
+                try:
+                    returncode = await asyncio.wait_for(process.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    self.logger.warning('SSH master connection to %s timed out', login)
+                    await utils.kill(process)
+                    returncode = None
+                except asyncio.CancelledError:
+                    await utils.kill(process)
+                    raise
+            if returncode == 0:
+                self.masters.add(login)
+            else:
+                self.logger.warning('SSH master connection to %s failed, '
+                                    'connecting without it', login)
+            return True
+
+    async def close(self):
+        """
+        Close all master connections.
+        """
+        for login in self.masters:
+            command = ['ssh', '-o', 'ControlPath=' + self._control_path(),
+                       '-O', 'exit', login]
+            self.logger.debug('SSH master exit command: %s', command)
+            with ChildCPU():
+                process = await asyncio.create_subprocess_exec(*command,
+                                                               stdin=subprocess.DEVNULL,
+                                                               stdout=subprocess.DEVNULL,
+                                                               stderr=subprocess.DEVNULL)
+                await process.wait()
+        self.masters = set()
+        self._locks = {}
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
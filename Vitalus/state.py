@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import sqlite3
+import logging
+import datetime
+import threading
+from contextlib import closing
+
+
+class StateStore:
+    """
+    State of the jobs (date of the last backup, history of the runs,
+    fingerprint of the source), stored in a sqlite database.
+
+    The database is opened once and shared by the jobs:
+    the writes are serialized and each one is a transaction.
+    The WAL journal lets other processes read it meanwhile.
+
+    :param path: database path
+    :type path: string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('Vitalus.StateStore')
+        self._lock = threading.Lock()
+        # Used by the jobs run in threads too
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS last_backup ('
+                            'job TEXT PRIMARY KEY, '
+                            'date TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                            'id INTEGER PRIMARY KEY, '
+                            'job TEXT NOT NULL, '
+                            'start TEXT NOT NULL, '
+                            'end TEXT NOT NULL, '
+                            'status TEXT, '
+                            'bytes INTEGER, '
+                            'duration REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS runs_job_start ON runs (job, start)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                            'job TEXT PRIMARY KEY, '
+                            'digest TEXT NOT NULL, '
+                            'snapshot TEXT NOT NULL, '
+                            'settings TEXT, '
+                            'date TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                            'key TEXT PRIMARY KEY, '
+                            'value TEXT)')
+        self._migrate(os.path.join(os.path.dirname(path), 'time.db'))
+
+    def _migrate(self, timebase):
+        """
+        Import the dates of the last backups of time.db (shelve),
+        used by the previous versions. The file is left as is.
+
+        :param timebase: path of time.db
+        """
+        with self._lock:
+            done = self.db.execute("SELECT value FROM meta WHERE key = 'time.db'").fetchone()
+        if done is not None:
+            return
+        # The files depend on the dbm module (time.db, time.db.dat...)
+        directory, name = os.path.split(timebase)
+        if any(filename.startswith(name) for filename in os.listdir(directory or '.')):
+            self.logger.info('Import %s', timebase)
+            import shelve
+            try:
+                with closing(shelve.open(timebase, flag='r')) as old:
+                    dates = [(job, date.isoformat()) for job, date in old.items()]
+            except Exception:
+                self.logger.exception('Could not import %s', timebase)
+                return
+            with self._lock, self.db:
+                self.db.executemany('INSERT OR IGNORE INTO last_backup VALUES (?, ?)', dates)
+        with self._lock, self.db:
+            self.db.execute("INSERT INTO meta VALUES ('time.db', 'imported')")
+
+    def close(self):
+        """
+        Close the database
+        """
+        with self._lock:
+            self.db.close()
+
+    def last_backup(self, job):
+        """
+        Return the date of the last backup of a job, None if never done
+
+        :param job: job name
+        :returns: datetime.datetime
+        """
+        with self._lock:
+            row = self.db.execute('SELECT date FROM last_backup WHERE job = ?',
+                                  (job,)).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.fromisoformat(row[0])
+
+    def last_backups(self):
+        """
+        Return the dates of the last backups of all jobs, in one query
+
+        :returns: dict -- job name: datetime.datetime
+        """
+        with self._lock:
+            rows = self.db.execute('SELECT job, date FROM last_backup').fetchall()
+        return {job: datetime.datetime.fromisoformat(date) for job, date in rows}
+
+    def set_last_backup(self, job, date):
+        """
+        Set the date of the last backup of a job
+
+        :param job: job name
+        :param date: date
+        :type date: datetime.datetime
+        """
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO last_backup VALUES (?, ?)',
+                            (job, date.isoformat()))
+
+    def record_run(self, job, start, end, status, bytes=None):
+        """
+        Record a run of a job
+
+        :param job: job name
+        :param start: start of the run
+        :type start: datetime.datetime
+        :param end: end of the run
+        :type end: datetime.datetime
+        :param status: e.g. 'success', 'partial', 'failed'
+        :type status: string
+        :param bytes: bytes written in the destination
+        :type bytes: int
+        """
+        with self._lock, self.db:
+            self.db.execute('INSERT INTO runs (job, start, end, status, bytes, duration) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (job, start.isoformat(), end.isoformat(), status, bytes,
+                             (end - start).total_seconds()))
+
+    def runs(self, job, limit=None):
+        """
+        Return the last runs of a job, the oldest first
+
+        :param job: job name
+        :param limit: max number of runs, None for all
+        :returns: list of dict (start, end, status, bytes, duration)
+        """
+        if limit is None:
+            limit = -1
+        with self._lock:
+            rows = self.db.execute('SELECT start, end, status, bytes, duration FROM runs '
+                                   'WHERE job = ? ORDER BY start DESC LIMIT ?',
+                                   (job, limit)).fetchall()
+        runs = []
+        for start, end, status, size, duration in reversed(rows):
+            runs.append({'start': datetime.datetime.fromisoformat(start),
+                         'end': datetime.datetime.fromisoformat(end),
+                         'status': status, 'bytes': size, 'duration': duration})
+        return runs
+
+    def fingerprint(self, job):
+        """
+        Return the fingerprint of the source of a job
+        at its last successful backup, None if unknown
+
+        :param job: job name
+        :returns: dict -- digest, snapshot (name of the backup),
+            settings (of the transfer) and date
+        """
+        with self._lock:
+            row = self.db.execute('SELECT digest, snapshot, settings, date FROM fingerprints '
+                                  'WHERE job = ?', (job,)).fetchone()
+        if row is None:
+            return None
+        return {'digest': row[0], 'snapshot': row[1], 'settings': row[2],
+                'date': datetime.datetime.fromisoformat(row[3])}
+
+    def set_fingerprint(self, job, digest, snapshot=None, settings=None):
+        """
+        Set the fingerprint of the source of a job
+
+        :param job: job name
+        :param digest: fingerprint (see :func:`Vitalus.agent.op_fingerprint`),
+            None to forget it
+        :param snapshot: name of the backup of this source
+        :param settings: settings of the transfer (e.g. filters),
+            the backup is up to date for these ones only
+        :type settings: string
+        """
+        with self._lock, self.db:
+            if digest is None:
+                self.db.execute('DELETE FROM fingerprints WHERE job = ?', (job,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)',
+                                (job, digest, snapshot, settings,
+                                 datetime.datetime.now().isoformat()))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import json
+import sqlite3
+import logging
+import datetime
+from contextlib import closing
+
+# Numbers of rsync --stats stored for each run
+# (keys of RsyncOutputParser.stats)
+FIELDS = ('number_of_files',
+          'number_of_created_files',
+          'number_of_deleted_files',
+          'number_of_regular_files_transferred',
+          'total_file_size',
+          'total_transferred_file_size',
+          'literal_data',
+          'matched_data',
+          'file_list_size',
+          'file_list_generation_time',
+          'file_list_transfer_time',
+          'total_bytes_sent',
+          'total_bytes_received',
+          'speedup',
+          )
+
+
+class StatsStore:
+    """
+    Statistics of the transfers, stored in a sqlite database.
+
+    Each run of a job records the numbers of rsync --stats,
+    the return code, the duration of each phase (seconds),
+    the CPU time of rsync (seconds) and the transfer options
+    chosen by :class:`Vitalus.tuning.AutoTuner`.
+
+    :param path: database path
+    :type path: string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('Vitalus.StatsStore')
+        with closing(self._connect()) as db, db:
+            columns = ', '.join('%s REAL' % field for field in FIELDS)
+            db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                       'id INTEGER PRIMARY KEY, '
+                       'job TEXT NOT NULL, '
+                       'date TEXT NOT NULL, '
+                       'returncode INTEGER, '
+                       'duration REAL, '
+                       'phases TEXT, '
+                       'cpu REAL, '
+                       'tuning TEXT, '
+                       '%s)' % columns)
+            db.execute('CREATE INDEX IF NOT EXISTS runs_job_date ON runs (job, date)')
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def record(self, job, date, returncode, stats, phases, cpu=None, tuning=None):
+        """
+        Record a run
+
+        :param job: job name
+        :type job: string
+        :param date: start of the run
+        :type date: datetime.datetime
+        :param returncode: rsync return code
+        :type returncode: int
+        :param stats: numbers of rsync --stats
+        :type stats: dict
+        :param phases: duration of each phase (seconds)
+        :type phases: dict
+        :param cpu: CPU time of rsync (seconds), None if unknown
+        :type cpu: float
+        :param tuning: transfer options chosen by the auto-tuner
+        :type tuning: dict
+        """
+        self.logger.debug('Record stats of %s: %s', job, stats)
+        names = ['job', 'date', 'returncode', 'duration', 'phases', 'cpu', 'tuning']
+        values = [job, date.isoformat(), returncode, sum(phases.values()),
+                  json.dumps(phases), cpu, json.dumps(tuning)]
+        for field in FIELDS:
+            if field in stats:
+                names.append(field)
+                values.append(stats[field])
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT INTO runs (%s) VALUES (%s)' %
+                       (', '.join(names), ', '.join('?' * len(names))), values)
+
+    def jobs(self):
+        """
+        Return the names of the jobs having statistics
+
+        :returns: list
+        """
+        with closing(self._connect()) as db:
+            return [row[0] for row in db.execute('SELECT DISTINCT job FROM runs ORDER BY job')]
+
+    def runs(self, job, limit=None):
+        """
+        Return the last runs of a job, the oldest first
+
+        :param job: job name
+        :param limit: max number of runs, None for all
+        :returns: list of dict
+        """
+        if limit is None:
+            limit = -1
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT * FROM runs WHERE job = ? '
+                              'ORDER BY date DESC LIMIT ?', (job, limit)).fetchall()
+        runs = []
+        for row in reversed(rows):
+            run = dict(row)
+            del run['id']
+            run['date'] = datetime.datetime.fromisoformat(run['date'])
+            run['phases'] = json.loads(run['phases'])
+            run['tuning'] = json.loads(run['tuning'] or 'null')
+            runs.append(run)
+        return runs
+
+    def trend(self, job, field, limit=30):
+        """
+        Return the evolution of a value for a job, the oldest first
+
+        :param job: job name
+        :param field: a name of FIELDS, 'duration' or a phase name
+        :param limit: max number of runs
+        :returns: list of (date, value)
+        """
+        trend = []
+        for run in self.runs(job, limit):
+            if field in run:
+                trend.append((run['date'], run[field]))
+            else:
+                trend.append((run['date'], run['phases'].get(field)))
+        return trend
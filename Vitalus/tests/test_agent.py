@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+import sys
+
+from Vitalus import agent
+
+
+class TestExecute(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_mkdir_listdir(self):
+        path = os.path.join(self.tmp, 'a', 'b')
+        results = agent.execute([{'op': 'mkdir', 'path': path},
+                                 {'op': 'listdir', 'path': os.path.join(self.tmp, 'a')}])
+        self.assertEqual(results, [{'ok': True, 'result': None},
+                                   {'ok': True, 'result': ['b']}])
+
+    def test_listdir_missing(self):
+        results = agent.execute([{'op': 'listdir', 'path': os.path.join(self.tmp, 'no')}])
+        self.assertEqual(results[0]['result'], [])
+
+    def test_error_does_not_stop_batch(self):
+        results = agent.execute([{'op': 'rename', 'src': os.path.join(self.tmp, 'no'),
+                                  'dst': os.path.join(self.tmp, 'yes')},
+                                 {'op': 'listdir', 'path': self.tmp}])
+        self.assertFalse(results[0]['ok'])
+        self.assertIn('FileNotFoundError', results[0]['error'])
+        self.assertTrue(results[1]['ok'])
+
+    def test_rmtree_symlink(self):
+        for name in ('old', 'new'):
+            os.makedirs(os.path.join(self.tmp, name, 'sub'))
+        last = os.path.join(self.tmp, 'last')
+        os.symlink('old', last)
+        results = agent.execute([{'op': 'rmtree', 'paths': [os.path.join(self.tmp, 'old')]},
+                                 {'op': 'symlink', 'target': 'new', 'link': last}])
+        self.assertEqual(results[0]['result'], [])
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['last', 'new'])
+        self.assertEqual(os.readlink(last), 'new')
+
+    def test_trash_purge(self):
+        trash = os.path.join(self.tmp, '.trash', 'job')
+        for name in ('old', 'older'):
+            os.makedirs(os.path.join(self.tmp, name, 'sub'))
+            open(os.path.join(self.tmp, name, 'sub', 'file'), 'w').close()
+        os.makedirs(os.path.join(trash, 'old'))
+        failed = agent.op_trash([os.path.join(self.tmp, 'old'), os.path.join(self.tmp, 'older'),
+                                 os.path.join(self.tmp, 'no')], trash)
+        self.assertEqual(failed, [os.path.join(self.tmp, 'no')])
+        self.assertEqual(sorted(os.listdir(trash)), ['old', 'old.1', 'older'])
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['.trash'])
+
+        self.assertEqual(agent.op_purge(trash, pause=0.001), [])
+        self.assertEqual(os.listdir(trash), [])
+
+    def test_purge_missing(self):
+        self.assertEqual(agent.op_purge(os.path.join(self.tmp, 'no')), [])
+
+    def _dirs_size(self):
+        return sum(os.stat(root).st_size
+                   for root, dirs, files in os.walk(os.path.join(self.tmp, 'tree')))
+
+    def test_usage(self):
+        cache = os.path.join(self.tmp, 'usage.db')
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.tmp, 'tree', name))
+        with open(os.path.join(self.tmp, 'tree', 'a', 'file'), 'w') as data:
+            data.write('x' * 1000)
+        # Same inode in another snapshot
+        os.link(os.path.join(self.tmp, 'tree', 'a', 'file'),
+                os.path.join(self.tmp, 'tree', 'b', 'file'))
+        usage = agent.op_usage(os.path.join(self.tmp, 'tree'), cache)
+        self.assertEqual(usage['size'], self._dirs_size() + 1000)
+        self.assertEqual(usage['files'], 2)
+        self.assertEqual(agent.op_usage(os.path.join(self.tmp, 'tree'), cache), usage)
+
+        # Modified directory: read again
+        shutil.rmtree(os.path.join(self.tmp, 'tree', 'a'))
+        with open(os.path.join(self.tmp, 'tree', 'b', 'new'), 'w') as data:
+            data.write('x' * 10)
+        usage = agent.op_usage(os.path.join(self.tmp, 'tree'), cache)
+        self.assertEqual(usage['size'], self._dirs_size() + 1010)
+        self.assertEqual(usage, agent.op_usage(os.path.join(self.tmp, 'tree')))
+
+    def test_usage_linked_later(self):
+        cache = os.path.join(self.tmp, 'usage.db')
+        os.makedirs(os.path.join(self.tmp, 'tree', 'a'))
+        with open(os.path.join(self.tmp, 'tree', 'a', 'file'), 'w') as data:
+            data.write('x' * 1000)
+        agent.op_usage(os.path.join(self.tmp, 'tree'), cache)
+        # Next snapshot (--link-dest), the directory a is unchanged
+        os.makedirs(os.path.join(self.tmp, 'tree', 'b'))
+        os.link(os.path.join(self.tmp, 'tree', 'a', 'file'),
+                os.path.join(self.tmp, 'tree', 'b', 'file'))
+        usage = agent.op_usage(os.path.join(self.tmp, 'tree'), cache)
+        self.assertEqual(usage['size'], self._dirs_size() + 1000)
+        self.assertEqual(usage, agent.op_usage(os.path.join(self.tmp, 'tree')))
+
+    def test_statvfs(self):
+        result = agent.op_statvfs(self.tmp)
+        self.assertTrue(0 <= result['free'] <= result['total'])
+        # Not created yet
+        self.assertEqual(agent.op_statvfs(os.path.join(self.tmp, 'job', 'sub'))['total'],
+                         result['total'])
+
+    def test_fingerprint(self):
+        tree = os.path.join(self.tmp, 'tree')
+        os.makedirs(os.path.join(tree, 'a', 'b', 'c'))
+        deep = os.path.join(tree, 'a', 'b', 'c', 'file')
+        with open(deep, 'w') as data:
+            data.write('x')
+        # A loop, walked once
+        os.symlink('..', os.path.join(tree, 'a', 'up'))
+        fingerprint = agent.op_fingerprint(tree)
+        self.assertEqual(fingerprint['files'], 1)
+        self.assertEqual(fingerprint['directories'], 4)
+        self.assertEqual(agent.op_fingerprint(tree, workers=1), fingerprint)
+
+        # Same size and mtime
+        os.utime(deep, ns=(0, 0))
+        changed = agent.op_fingerprint(tree)['digest']
+        self.assertNotEqual(changed, fingerprint['digest'])
+        with open(deep, 'w') as data:
+            data.write('y')
+        os.utime(deep, ns=(0, 0))
+        self.assertEqual(agent.op_fingerprint(tree)['digest'], changed)
+        os.chmod(deep, 0o600)
+        self.assertNotEqual(agent.op_fingerprint(tree)['digest'], changed)
+
+    def test_fingerprint_unreadable(self):
+        self.assertFalse(agent.execute([{'op': 'fingerprint',
+                                         'path': os.path.join(self.tmp, 'no')}])[0]['ok'])
+
+    def test_link_tree(self):
+        previous = os.path.join(self.tmp, 'previous')
+        os.makedirs(os.path.join(previous, 'a', 'b'))
+        os.makedirs(os.path.join(previous, 'old', 'c'))
+        for name in ('a/kept', 'a/changed', 'old/c/file'):
+            with open(os.path.join(previous, name), 'w') as data:
+                data.write(name)
+        os.utime(os.path.join(previous, 'a'), (0, 0))
+        current = os.path.join(self.tmp, 'current')
+        linked = agent.op_link_tree(previous, current, skip=['a/changed', 'old'])
+        self.assertEqual(linked, 1)
+        self.assertEqual(sorted(os.listdir(current)), ['a'])
+        self.assertEqual(sorted(os.listdir(os.path.join(current, 'a'))), ['b', 'kept'])
+        self.assertTrue(os.path.samefile(os.path.join(previous, 'a', 'kept'),
+                                         os.path.join(current, 'a', 'kept')))
+        self.assertEqual(os.stat(os.path.join(current, 'a')).st_mtime, 0)
+
+    def test_catalog(self):
+        for name in ('2013-01-01_00h00m00s', '2013-01-02_00h00m00s'):
+            os.makedirs(os.path.join(self.tmp, name))
+        os.symlink('2013-01-02_00h00m00s', os.path.join(self.tmp, 'last'))
+        # No catalog: listing
+        result = agent.op_catalog(self.tmp)
+        self.assertTrue(result['rebuilt'])
+        self.assertEqual([entry['name'] for entry in result['entries']],
+                         ['2013-01-01_00h00m00s', '2013-01-02_00h00m00s'])
+        self.assertIsNone(result['entries'][0]['complete'])
+
+        entries = [{'name': '2013-01-01_00h00m00s', 'time': 1., 'complete': True, 'size': 10},
+                   {'name': '2013-01-02_00h00m00s', 'time': 2., 'complete': False, 'size': 3}]
+        agent.op_write_catalog(self.tmp, entries)
+        self.assertEqual(agent.op_catalog(self.tmp), {'entries': entries, 'rebuilt': False})
+
+        # Modified directory: the catalog is stale
+        os.makedirs(os.path.join(self.tmp, '2013-01-03_00h00m00s'))
+        shutil.rmtree(os.path.join(self.tmp, '2013-01-01_00h00m00s'))
+        result = agent.op_catalog(self.tmp)
+        self.assertTrue(result['rebuilt'])
+        self.assertEqual(result['entries'][0], entries[1])
+        self.assertEqual(result['entries'][1]['name'], '2013-01-03_00h00m00s')
+
+    def test_catalog_missing(self):
+        result = agent.op_catalog(os.path.join(self.tmp, 'no'))
+        self.assertEqual(result, {'entries': [], 'rebuilt': False})
+
+    def test_remote_command(self):
+        # Run the command as the remote shell would do
+        command = ' '.join(agent.remote_command()).replace('python3', sys.executable, 1)
+        batch = [{'op': 'listdir', 'path': self.tmp}]
+        result = subprocess.run(['sh', '-c', command], input=json.dumps(batch).encode(),
+                                stdout=subprocess.PIPE, check=True)
+        self.assertEqual(json.loads(result.stdout.decode()),
+                         [{'ok': True, 'result': []}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import datetime
+import unittest
+
+from Vitalus.events import EventLog, Summary, format_report
+
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'events.jsonl')
+        self.events = EventLog(self.path)
+        self.today = datetime.date.today()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, day, event, **fields):
+        record = {'time': day.isoformat() + 'T12:00:00', 'event': event}
+        record.update(fields)
+        with open(self.path, 'a') as events:
+            events.write(json.dumps(record) + '\n')
+
+    def test_emit(self):
+        self.events.emit('run_start', version='0.4.2', jobs=['a'])
+        self.events.emit('job_end', job='a', status='success', bytes=10)
+        with open(self.path) as events:
+            records = [json.loads(line) for line in events]
+        self.assertEqual([record['event'] for record in records], ['run_start', 'job_end'])
+        self.assertEqual(records[1]['bytes'], 10)
+        self.assertIn('time', records[0])
+
+    def test_incremental(self):
+        self.write(self.today, 'run_start')
+        self.write(self.today, 'job_end', job='a', status='success', bytes=100, duration=2.)
+        self.assertEqual(Summary(self.path).update(), 2)
+        # New events only, an incomplete line is left for the next update
+        self.write(self.today, 'job_end', job='a', status='failed')
+        with open(self.path, 'a') as events:
+            events.write('{"time": "%s' % self.today)
+        summary = Summary(self.path)
+        self.assertEqual(summary.update(), 1)
+        with open(self.path, 'a') as events:
+            events.write('T13:00:00", "event": "run_end", "status": "ok"}\n')
+        self.assertEqual(summary.update(), 1)
+        report = Summary(self.path).report()
+        self.assertEqual(report['runs'], 1)
+        self.assertEqual(report['ok'], 1)
+        self.assertEqual(report['jobs']['a']['success'], 1)
+        self.assertEqual(report['jobs']['a']['failed'], 1)
+        self.assertEqual(report['jobs']['a']['bytes'], 100)
+
+    def test_truncated(self):
+        self.write(self.today, 'run_start')
+        self.write(self.today, 'run_start')
+        Summary(self.path).update()
+        os.remove(self.path)
+        self.write(self.today, 'already_running')
+        summary = Summary(self.path)
+        self.assertEqual(summary.update(), 1)
+        self.assertEqual(summary.report()['already_running'], 1)
+
+    def test_report_days(self):
+        for days in range(10):
+            self.write(self.today - datetime.timedelta(days=days), 'job_end',
+                       job='a', status='success', bytes=1)
+        self.write(self.today, 'job_end', job='a', status='success', bytes=0, unchanged=True)
+        self.write(self.today - datetime.timedelta(days=3), 'error', job='a', message='unreachable')
+        summary = Summary(self.path)
+        summary.update()
+        self.assertEqual(summary.report(1)['jobs']['a']['success'], 2)
+        self.assertEqual(summary.report(1)['jobs']['a']['unchanged'], 1)
+        week = summary.report(7)
+        self.assertEqual(week['jobs']['a']['bytes'], 7)
+        self.assertEqual(week['errors'], {'a: unreachable': 1})
+        text = format_report(week)
+        self.assertIn('a: 8 done', text)
+        self.assertIn('(1 unchanged)', text)
+        self.assertIn('a: unreachable: 1 time(s)', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
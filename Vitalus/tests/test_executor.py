@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import asyncio
+import tempfile
+import threading
+import time
+
+from Vitalus.job import Target
+from Vitalus.executor import JobExecutor
+from Vitalus.executor import resource_keys
+
+
+class FakeJob():
+
+    def __init__(self, name, source, destination, fail=False):
+        self.name = name
+        self.source = Target(source)
+        self.destination = Target(destination)
+        self.fail = fail
+        self.done = False
+
+    def run(self):
+        time.sleep(0.01)
+        if self.fail:
+            raise RuntimeError('failure')
+        self.done = True
+
+
+class CountingJob(FakeJob):
+
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def run(self):
+        with self.lock:
+            CountingJob.running += 1
+            CountingJob.max_running = max(CountingJob.max_running,
+                                          CountingJob.running)
+        time.sleep(0.05)
+        with self.lock:
+            CountingJob.running -= 1
+        self.done = True
+
+
+class AsyncJob(FakeJob):
+
+    def run(self):
+        raise AssertionError('run_async() must be used')
+
+    async def run_async(self):
+        await asyncio.sleep(0.01)
+        self.done = True
+
+
+class TestResourceKeys(unittest.TestCase):
+
+    def test_ssh_destination(self):
+        job = FakeJob('a', tempfile.gettempdir(), 'fr@sciunto.org:/backup')
+        keys = resource_keys(job)
+        self.assertEqual(keys['host'], 'ssh:sciunto.org')
+
+    def test_ssh_source(self):
+        job = FakeJob('a', 'fr@sciunto.org:.', tempfile.gettempdir())
+        keys = resource_keys(job)
+        self.assertEqual(keys['device'], 'ssh:sciunto.org')
+
+    def test_local(self):
+        tmp = tempfile.gettempdir()
+        job = FakeJob('a', tmp, tmp)
+        keys = resource_keys(job)
+        self.assertTrue(keys['host'].startswith('local:'))
+        self.assertTrue(keys['device'].startswith('local:'))
+
+    def test_custom_job(self):
+        self.assertEqual(resource_keys(object()), {})
+
+
+class TestJobExecutor(unittest.TestCase):
+
+    def setUp(self):
+        CountingJob.running = 0
+        CountingJob.max_running = 0
+
+    def test_wrong_limit(self):
+        with self.assertRaises(ValueError):
+            JobExecutor(max_workers=0)
+
+    def test_failure_isolated(self):
+        tmp = tempfile.gettempdir()
+        jobs = [FakeJob('a', tmp, tmp, fail=True), FakeJob('b', tmp, tmp)]
+        JobExecutor(max_workers=2, host_limit=2, device_limit=2).run(jobs)
+        self.assertFalse(jobs[0].done)
+        self.assertTrue(jobs[1].done)
+
+    def test_async_job(self):
+        tmp = tempfile.gettempdir()
+        jobs = [AsyncJob('a', tmp, tmp), FakeJob('b', tmp, tmp)]
+        JobExecutor().run(jobs)
+        self.assertTrue(all(job.done for job in jobs))
+
+    def test_same_host_serialized(self):
+        jobs = [CountingJob(str(i), 'fr@host%i.org:.' % i, 'fr@sciunto.org:/b')
+                for i in range(4)]
+        JobExecutor(max_workers=4, host_limit=1, device_limit=4).run(jobs)
+        self.assertTrue(all(job.done for job in jobs))
+        self.assertEqual(CountingJob.max_running, 1)
+
+    def test_independent_jobs_overlap(self):
+        jobs = [CountingJob(str(i), 'fr@src%i.org:.' % i, 'fr@dst%i.org:/b' % i)
+                for i in range(4)]
+        JobExecutor(max_workers=4).run(jobs)
+        self.assertTrue(all(job.done for job in jobs))
+        self.assertGreater(CountingJob.max_running, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,10 @@ from random import shuffle
 
 from Vitalus.history import older
 from Vitalus.history import older_keepmin
+from Vitalus.history import Snapshots
+from Vitalus.history import AgePolicy
+from Vitalus.history import GFSPolicy
+from Vitalus.history import LogarithmicPolicy
 
 
 class TestOlder(unittest.TestCase):
@@ -122,3 +126,84 @@ class TestOlderKeep(unittest.TestCase):
         shuffle(file_list)
         result = older_keepmin(file_list, days=0, keep=10)
         self.assertEqual(result, expected_list)
+
+
+def hourly(now, hours):
+    return [(now - datetime.timedelta(hours=hour)).strftime("%Y-%m-%d_%Hh%Mm%Ss")
+            for hour in range(hours)]
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2013, 3, 6, 12, 0, 0)
+
+    def test_parse(self):
+        file_list = hourly(self.now, 30)
+        shuffle(file_list)
+        snapshots = Snapshots(file_list + ['last', 'foo', '2013-02-30_10h00m00s',
+                                           '2013-01-01_24h00m00s', '2013-01-01_10h00m00s.tmp'])
+        self.assertEqual(snapshots.names, sorted(hourly(self.now, 30)))
+        self.assertEqual(snapshots.times[-1] - snapshots.times[0], 29 * 3600)
+
+    def test_last(self):
+        self.assertEqual(Snapshots(hourly(self.now, 5)).last(), '2013-03-06_12h00m00s')
+        self.assertIsNone(Snapshots(['last']).last())
+
+    def test_older(self):
+        snapshots = Snapshots(hourly(self.now, 72))
+        self.assertEqual(snapshots.older(2, now=self.now), sorted(hourly(self.now, 72))[:24])
+
+    def test_age_policy(self):
+        keep, delete = Snapshots(hourly(self.now, 72)).select(AgePolicy(days=1, keep=30), self.now)
+        self.assertEqual(len(keep), 30)
+        self.assertEqual(len(delete), 42)
+        self.assertEqual(keep[-1], '2013-03-06_12h00m00s')
+
+    def test_gfs_policy(self):
+        snapshots = Snapshots(hourly(self.now, 24 * 100))
+        keep, delete = snapshots.select(GFSPolicy(hourly=2, daily=3, weekly=2, monthly=3, keep=0),
+                                        self.now)
+        self.assertEqual(keep, ['2013-01-31_23h00m00s',
+                                '2013-02-28_23h00m00s',
+                                '2013-03-03_23h00m00s',  # sunday
+                                '2013-03-04_23h00m00s',
+                                '2013-03-05_23h00m00s',
+                                '2013-03-06_11h00m00s',
+                                '2013-03-06_12h00m00s'])
+        self.assertEqual(len(keep) + len(delete), len(snapshots))
+
+    def test_gfs_policy_gap(self):
+        # Days without snapshots are skipped
+        file_list = ['2013-03-06_10h00m00s', '2013-03-06_08h00m00s',
+                     '2013-02-01_10h00m00s', '2013-01-15_10h00m00s']
+        keep, delete = Snapshots(file_list).select(GFSPolicy(daily=3, weekly=0, monthly=0),
+                                                   self.now)
+        self.assertEqual(keep, ['2013-01-15_10h00m00s', '2013-02-01_10h00m00s',
+                                '2013-03-06_10h00m00s'])
+
+    def test_logarithmic_policy(self):
+        keep, delete = Snapshots(hourly(self.now, 100)).select(LogarithmicPolicy(period=1, keep=1),
+                                                               self.now)
+        # The oldest snapshot of intervals of 1, 1, 2, 4, 8, 16, 32, 64 hours
+        self.assertEqual(keep, ['2013-03-02_09h00m00s', '2013-03-03_20h00m00s',
+                                '2013-03-05_04h00m00s', '2013-03-05_20h00m00s',
+                                '2013-03-06_04h00m00s', '2013-03-06_08h00m00s',
+                                '2013-03-06_10h00m00s', '2013-03-06_11h00m00s',
+                                '2013-03-06_12h00m00s'])
+        self.assertEqual(keep[-1], '2013-03-06_12h00m00s')
+
+    def test_wrong_policy_value(self):
+        with self.assertRaises(ValueError):
+            GFSPolicy(daily=-1)
+        with self.assertRaises(ValueError):
+            LogarithmicPolicy(period=0)
+
+    def test_scale(self):
+        snapshots = Snapshots(hourly(self.now, 24 * 365 * 5))
+        keep, delete = snapshots.select(GFSPolicy(hourly=24, daily=7, weekly=4, monthly=12,
+                                                  yearly=5), self.now)
+        # Some snapshots are the last of several buckets
+        self.assertEqual(len(keep), 44)
+        self.assertEqual(keep[0], '2009-12-31_23h00m00s')
+
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Vitalus.index import SourceIndex
+
+
+class TestSourceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source')
+        os.makedirs(os.path.join(self.source, 'a', 'b'))
+        os.makedirs(os.path.join(self.source, 'c', 'd'))
+        for name in ('a/file', 'a/b/file', 'c/d/file'):
+            self.write(name, 'x')
+        self.index = SourceIndex(os.path.join(self.tmp, 'index.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), 'w') as data:
+            data.write(content)
+
+    def test_first_scan(self):
+        self.assertEqual(self.index.info(),
+                         {'snapshot': None, 'settings': None, 'full_pass': None})
+        changes = self.index.scan(self.source, collect=False)
+        self.assertEqual(changes.entries, 7)
+        self.assertEqual(changes.changed, [])
+        self.index.commit('2013-01-01_00h00m00s', full=True, settings='source')
+        info = self.index.info()
+        self.assertEqual(info['snapshot'], '2013-01-01_00h00m00s')
+        self.assertEqual(info['settings'], 'source')
+        self.assertIsNotNone(info['full_pass'])
+        changes = self.index.scan(self.source)
+        self.assertEqual((changes.changed, changes.deleted), ([], []))
+
+    def test_changes(self):
+        self.index.scan(self.source, collect=False)
+        self.index.commit('2013-01-01_00h00m00s', full=True)
+        self.write('a/b/file', 'yy')
+        self.write('a/new', 'z')
+        # A directory replaced by a file
+        shutil.rmtree(os.path.join(self.source, 'c'))
+        self.write('c', 'file')
+        changes = self.index.scan(self.source)
+        # The mtime of a changed
+        self.assertEqual(changes.changed, ['a', 'a/b/file', 'a/new', 'c'])
+        self.assertEqual(changes.directories, {'a'})
+        self.assertEqual(changes.deleted, ['c'])
+        self.assertEqual(changes.paths(), ['a', 'a/b/file', 'a/new', 'c'])
+        # The directories are not linked
+        self.assertEqual(changes.unlinked(), ['a/b/file', 'a/new', 'c'])
+
+        # Not committed: the same changes
+        self.assertEqual(self.index.scan(self.source).changed, changes.changed)
+        self.index.commit('2013-01-02_00h00m00s')
+        self.assertEqual(self.index.info()['snapshot'], '2013-01-02_00h00m00s')
+        rows = self.index.db.execute('SELECT path FROM dirs ORDER BY path').fetchall()
+        self.assertEqual(rows, [('',), ('a',), ('a/b',)])
+
+        os.remove(os.path.join(self.source, 'c'))
+        changes = self.index.scan(self.source)
+        self.assertEqual(changes.changed, [])
+        self.assertEqual(changes.paths(), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
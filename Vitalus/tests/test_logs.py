@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+from Vitalus import logs
+
+
+class TestFileHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'job.log')
+        self.logger = logging.getLogger('test_logs')
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        logs.flush()
+        shutil.rmtree(self.tmp)
+
+    def test_once_per_file(self):
+        handler = logs.add_file_handler(self.logger, self.path)
+        self.assertIs(logs.add_file_handler(self.logger, self.path), handler)
+        other = logs.add_file_handler(self.logger, os.path.join(self.tmp, 'other.log'))
+        self.assertIsNot(other, handler)
+        self.assertEqual(len(self.logger.handlers), 2)
+
+    def test_lazy(self):
+        logs.add_file_handler(self.logger, self.path)
+        logs.flush()
+        self.assertFalse(os.path.exists(self.path))
+        self.logger.info('first %s', 'line')
+        self.logger.info('second line')
+        logs.flush()
+        with open(self.path) as log:
+            self.assertEqual(log.read(), 'first line\nsecond line\n')
+
+    def test_formatter(self):
+        logs.add_file_handler(self.logger, self.path,
+                              formatter=logging.Formatter('%(levelname)s %(message)s'))
+        self.logger.warning('disk full')
+        for handler in self.logger.handlers:
+            handler.flush()
+        with open(self.path) as log:
+            self.assertEqual(log.read(), 'WARNING disk full\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from Vitalus.metrics import TextfileSink
+
+
+class TestTextfileSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.sink = TextfileSink(self.tmp)
+        self.measures = {'status': 'partial', 'returncode': 23, 'bytes': None,
+                         'duration': 3., 'phases': {'transfer': 2., 'listing': 1.},
+                         'counters': {'subprocesses': 2, 'ssh_roundtrips': 1},
+                         'period': 3600, 'timestamp': 1000., 'last_success': 500.}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, filename):
+        with open(os.path.join(self.tmp, filename)) as prom:
+            return prom.read().splitlines()
+
+    def test_job(self):
+        self.sink.record_job('docs', self.measures)
+        lines = self.read('vitalus_job_docs.prom')
+        self.assertIn('vitalus_job_status{job="docs"} 1.0', lines)
+        self.assertIn('vitalus_job_phase_seconds{job="docs",phase="listing"} 1.0', lines)
+        self.assertIn('vitalus_job_ssh_roundtrips{job="docs"} 1.0', lines)
+        self.assertIn('vitalus_job_last_success_timestamp_seconds{job="docs"} 500.0', lines)
+        # Unknown values are not written
+        self.assertFalse([line for line in lines if line.startswith('vitalus_job_bytes')])
+        # One HELP per metric
+        self.assertEqual(lines.count('# TYPE vitalus_job_phase_seconds gauge'), 1)
+
+    def test_job_name(self):
+        self.sink.record_job('my "docs"/a', self.measures)
+        lines = self.read('vitalus_job_my__docs__a.prom')
+        self.assertIn(r'vitalus_job_status{job="my \"docs\"/a"} 1.0', lines)
+
+    def test_run(self):
+        self.sink.record_run({'status': 'ok', 'duration': 10., 'jobs': 2, 'timestamp': 1000.})
+        lines = self.read('vitalus.prom')
+        self.assertIn('vitalus_run_success 1.0', lines)
+        self.assertIn('vitalus_run_jobs 2.0', lines)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['vitalus.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
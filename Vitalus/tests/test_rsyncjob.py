@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 import tempfile
+import asyncio
+import shutil
+import socket
+import datetime
 
 from Vitalus.job import Target
 from Vitalus.job import TARGETError
+from Vitalus.job import AvailabilityCache
+from Vitalus.rsyncjob import RsyncJob
+from Vitalus.rsyncparser import RsyncOutputParser
+from Vitalus.stats import StatsStore
+from Vitalus.state import StateStore
 
 
 class TestTarget(unittest.TestCase):
@@ -60,5 +70,353 @@ class TestTarget(unittest.TestCase):
         self.assertRaises(TARGETError, lambda: target.check_availability())
 
 
+class TestAvailabilityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.open_address = self.server.getsockname()
+        # Nothing listens on this port
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.closed_address = sock.getsockname()
+        sock.close()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_available(self):
+        cache = AvailabilityCache()
+        self.assertTrue(cache.is_available(self.open_address))
+        self.assertFalse(cache.is_available(self.closed_address))
+
+    def test_cached(self):
+        cache = AvailabilityCache(ttl=60)
+        self.assertTrue(cache.is_available(self.open_address))
+        self.server.close()
+        self.assertTrue(cache.is_available(self.open_address))
+
+    def test_expired(self):
+        cache = AvailabilityCache(ttl=0)
+        self.assertTrue(cache.is_available(self.open_address))
+        self.server.close()
+        self.assertFalse(cache.is_available(self.open_address))
+
+    def test_available_async(self):
+        cache = AvailabilityCache(ttl=0)
+        self.assertTrue(asyncio.run(cache.is_available_async(self.open_address)))
+        self.assertFalse(asyncio.run(cache.is_available_async(self.closed_address)))
+
+    def test_probe_all(self):
+        cache = AvailabilityCache()
+        asyncio.run(cache.probe_all([self.open_address, self.closed_address]))
+        self.server.close()
+        self.assertTrue(cache.is_available(self.open_address))
+        self.assertFalse(cache.is_available(self.closed_address))
+
+
+class TestSourceRoot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _root(self, source):
+        job = RsyncJob(self.tmp, self.tmp, 'test', source, 0,
+                       True, 10, 10, False, (None, None), None)
+        return job._source_root()
+
+    def test_directory(self):
+        self.assertEqual(self._root('/home/fr/docs'), '/home/fr/./docs/')
+
+    def test_content(self):
+        self.assertEqual(self._root('/home/fr/docs/'), '/home/fr/docs/./')
+
+    def test_ssh(self):
+        self.assertEqual(self._root('fr@sciunto.org:docs'), 'fr@sciunto.org:./docs/')
+
+
+class TestRsyncCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.job = RsyncJob(self.tmp, self.tmp, 'test', '/home/fr/docs', 0,
+                            True, 10, 10, False, (None, None), None,
+                            mirrors=['fr@sciunto.org:/backup'])
+        self.job.current_backup_path = os.path.join(self.tmp, 'test', 'now')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_mirrors(self):
+        self.assertEqual(len(self.job.mirrors), 1)
+        mirror = self.job.mirrors[0]
+        self.assertTrue(mirror.destination.is_ssh())
+        self.assertEqual(mirror.current_date, self.job.current_date)
+
+    def test_write_batch(self):
+        command = self.job._prepare_rsync_command(write_batch='/tmp/batch')
+        self.assertIn('--write-batch=/tmp/batch', command)
+        self.assertIn('/home/fr/docs', command)
+
+    def test_read_batch(self):
+        command = self.job._prepare_rsync_command(read_batch='/tmp/batch')
+        self.assertIn('--read-batch=/tmp/batch', command)
+        self.assertNotIn('/home/fr/docs', command)
+        self.assertEqual(command[-1], self.job.current_backup_path)
+
+    def test_files_from(self):
+        command = self.job._prepare_rsync_command(files_from='/tmp/files')
+        self.assertIn('--files-from=/tmp/files', command)
+        self.assertIn('--delete-missing-args', command)
+        self.assertNotIn('--delete', command)
+        # The paths start with docs/
+        self.assertEqual(self.job._files_from_root(), ('/home/fr/', 'docs/'))
+        self.assertEqual(command[-2:], ['/home/fr/', self.job.current_backup_path])
+
+    def test_chown(self):
+        self.assertFalse([arg for arg in self.job._prepare_rsync_command()
+                          if arg.startswith('--chown')])
+        self.job.dest_uid, self.job.dest_gid = 1000, 100
+        self.assertIn('--chown=1000:100', self.job._prepare_rsync_command())
+
+
+class TestMirrors(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.job = RsyncJob(self.tmp, self.tmp, 'test', self.tmp, 0,
+                            True, 10, 10, False, (None, None), None,
+                            mirrors=[os.path.join(self.tmp, 'm1'), os.path.join(self.tmp, 'm2')])
+        self.batch = os.path.join(self.tmp, 'test.batch')
+        open(self.batch, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_failing_mirror(self):
+        batches = []
+
+        async def fail(read_batch=None):
+            raise OSError('No space left on device')
+
+        async def backup(read_batch=None):
+            await asyncio.sleep(0.05)
+            batches.append(os.path.exists(read_batch))
+            return 0, RsyncOutputParser()
+        self.job.mirrors[0]._backup = fail
+        self.job.mirrors[1]._backup = backup
+        self.assertFalse(asyncio.run(self.job._run_mirrors(self.batch)))
+        # The other mirror read the batch, removed afterwards
+        self.assertEqual(batches, [True])
+        self.assertFalse(os.path.exists(self.batch))
+
+
+class TestCommunicate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.job = RsyncJob(self.tmp, self.tmp, 'test', self.tmp, 0,
+                            True, 10, 10, False, (None, None), None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_output(self):
+        result = asyncio.run(self.job._communicate(['echo', 'foo']))
+        self.assertEqual(result, (0, b'foo\n', b''))
+        self.assertEqual(self.job.counters['subprocesses'], 1)
+
+    def test_timeout(self):
+        with self.assertRaises(TARGETError):
+            asyncio.run(self.job._communicate(['sleep', '10'], timeout=0.1))
+
+    def test_run_command_streaming(self):
+        self.job.log_chunk = 2
+        command = ['sh', '-c', 'echo ">f+++++++++ a"; echo ">f+++++++++ b"; '
+                               'echo ">f+++++++++ c"; echo oops >&2; exit 3']
+        returncode, parser = asyncio.run(self.job._run_command(command))
+        self.assertEqual(returncode, 3)
+        self.assertEqual(parser.changes['created'], 3)
+        for handler in self.job.job_logger.handlers:
+            handler.flush()
+        with open(os.path.join(self.tmp, 'test.log')) as log:
+            content = log.read()
+        self.assertIn('>f+++++++++ c', content)
+        self.assertIn('Errors: oops', content)
+        # Local rsync
+        self.assertEqual(self.job.counters, {'subprocesses': 1, 'ssh_roundtrips': 0})
+
+    def test_last_success(self):
+        measures = {}
+
+        class Sink:
+            def record_job(self, name, values):
+                measures.update(values)
+
+        self.job.metrics = Sink()
+        state = self.job._get_state()
+        success = datetime.datetime(2013, 1, 1, 1)
+        state.record_run('test', datetime.datetime(2013, 1, 1), success, 'success')
+        state.record_run('test', datetime.datetime(2013, 1, 2),
+                         datetime.datetime(2013, 1, 2, 1), 'partial')
+        state.set_last_backup('test', datetime.datetime(2013, 1, 2))
+        self.job._job_end('partial', 23)
+        self.assertEqual(measures['last_success'], success.timestamp())
+
+    def test_cancel(self):
+        async def cancel():
+            task = asyncio.ensure_future(self.job._communicate(['sleep', '10']))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await task
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(cancel())
+
+
+class TestFinalizeRemote(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # Retention: 1 day, at least 1 snapshot
+        self.job = RsyncJob(self.tmp, 'fr@sciunto.org:/backup', 'test', self.tmp, 0,
+                            True, 1, 1, False, (None, None), None)
+        Target.availability._set(self.job.destination.address(), True)
+        self.names = ['2013-01-0%i_00h00m00s' % day for day in (1, 2)]
+        self.job.listing = list(self.names)
+        self.job.catalog = [{'name': name, 'time': 0, 'complete': True, 'size': None}
+                            for name in self.names]
+        self.job.current_backup_path = '/backup/test/' + self.job.current_date
+        self.batches = []
+
+        async def run_agent(batch, target=None, timeout=None):
+            self.batches.append(batch)
+            return [{'ok': False, 'error': 'Permission denied'} if operation['op'] == 'trash'
+                    else {'ok': True, 'result': None} for operation in batch]
+        self.job._run_agent = run_agent
+
+    def tearDown(self):
+        Target.availability.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_trash_failed(self):
+        asyncio.run(self.job._finalize_remote(0, RsyncOutputParser()))
+        # Nothing moved: the catalog still lists the old snapshots
+        catalog = self.batches[-1][-1]
+        self.assertEqual(catalog['op'], 'write_catalog')
+        self.assertEqual([entry['name'] for entry in catalog['entries']],
+                         self.names + [self.job.current_date])
+        self.assertFalse(self.job.trash)
+
+
+class TestCheckDiskUsage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.stats = StatsStore(os.path.join(self.tmp, 'stats.db'))
+        self.names = ['2013-01-0%i_00h00m00s' % day for day in (1, 2, 3)]
+        for name in self.names:
+            os.makedirs(os.path.join(self.tmp, 'test', name))
+        self.job = RsyncJob(self.tmp, self.tmp, 'test', self.tmp, 0,
+                            True, 10, 10, False, (None, None), None, stats=self.stats,
+                            space_check={'margin': 1.2, 'min_free': 0,
+                                         'prune': False, 'dry_run': False})
+        self.job.listing = list(self.names)
+        self.stats.record('test', self.job.now, 0, {'total_transferred_file_size': 1000}, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_enough_space(self):
+        self.job.free_space = 1201
+        asyncio.run(self.job._check_disk_usage())
+
+    def test_low_space(self):
+        self.job.free_space = 1000
+        with self.assertRaises(TARGETError):
+            asyncio.run(self.job._check_disk_usage())
+
+    def test_no_history(self):
+        self.job.stats = None
+        self.job.free_space = 0
+        asyncio.run(self.job._check_disk_usage())
+
+    def test_dry_run(self):
+        # First backup: the destination is not prepared yet
+        self.job.stats = None
+        self.job.space_check['dry_run'] = True
+        commands = []
+
+        async def run_command(command):
+            commands.append(command)
+            return 0, RsyncOutputParser()
+        self.job._run_command = run_command
+        self.job.free_space = 2**70
+        asyncio.run(self.job._check_disk_usage())
+        self.assertIn('--dry-run', commands[0])
+        self.assertIn(os.path.join(self.tmp, 'test', str(self.job.current_date)), commands[0])
+
+    def test_prune(self):
+        self.job.space_check['prune'] = True
+        self.job.space_check['min_free'] = 2**70
+        self.job.free_space = 0
+        # The last snapshot is never deleted
+        with self.assertRaises(TARGETError):
+            asyncio.run(self.job._check_disk_usage())
+        self.assertEqual(self.job.listing, self.names[-1:])
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'test')), self.names[-1:])
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'source')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        with open(os.path.join(self.source, 'sub', 'file'), 'w') as data:
+            data.write('x')
+        self.snapshot = '2013-01-01_00h00m00s'
+        os.makedirs(os.path.join(self.tmp, 'dest', 'test', self.snapshot))
+        self.job = RsyncJob(self.tmp, os.path.join(self.tmp, 'dest'), 'test', self.source, 0,
+                            True, 10, 10, False, (None, None), None, fingerprint=True)
+        self.job.state = StateStore(os.path.join(self.tmp, 'state.db'))
+
+    def tearDown(self):
+        self.job.state.close()
+        shutil.rmtree(self.tmp)
+
+    def test_unchanged(self):
+        digest = asyncio.run(self.job._source_fingerprint())
+        self.job.state.set_fingerprint('test', digest, self.snapshot,
+                                       self.job._transfer_settings())
+        self.assertEqual(asyncio.run(self.job._backup()), (None, None))
+        self.assertIn('fingerprint', self.job.phases)
+        # No new snapshot
+        self.assertEqual(os.listdir(os.path.join(self.tmp, 'dest', 'test')), [self.snapshot])
+
+    def test_changed(self):
+        self.job.source_digest = asyncio.run(self.job._source_fingerprint())
+        self.job.previous_backup_path = os.path.join(self.tmp, 'dest', 'test', self.snapshot)
+        self.assertFalse(self.job._source_unchanged())
+        self.job.state.set_fingerprint('test', self.job.source_digest, self.snapshot,
+                                       self.job._transfer_settings())
+        self.assertTrue(self.job._source_unchanged())
+        # New filters, to apply
+        self.job.filter = ['- *.tmp']
+        self.assertFalse(self.job._source_unchanged())
+        self.job.filter = None
+        # Another last backup (e.g. partial)
+        self.job.previous_backup_path += '_other'
+        self.assertFalse(self.job._source_unchanged())
+        self.job.previous_backup_path = os.path.join(self.tmp, 'dest', 'test', self.snapshot)
+        # New file deep in the source
+        open(os.path.join(self.source, 'sub', 'new'), 'w').close()
+        self.job.source_digest = asyncio.run(self.job._source_fingerprint())
+        self.assertFalse(self.job._source_unchanged())
+
+
 if __name__ == '__main__':
     unittest.main()
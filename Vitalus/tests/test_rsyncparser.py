@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from Vitalus.rsyncparser import RsyncOutputParser
+from Vitalus.rsyncparser import parse_number
+
+OUTPUT = """sending incremental file list
+.d..t...... ./
+>f+++++++++ new.txt
+cd+++++++++ newdir/
+>f.st...... changed.txt
+.f....og... owner.txt
+*deleting   old.txt
+cL+++++++++ link -> new.txt
+
+Number of files: 1234 (reg: 1000, dir: 234)
+Number of created files: 3 (reg: 1, dir: 1, link: 1)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 2
+Total file size: 1500123456 bytes
+Total transferred file size: 12345678 bytes
+Literal data: 2001234 bytes
+Matched data: 10344444 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 2100321
+Total bytes received: 1234
+
+sent 2100321 bytes  received 1234 bytes  4203110.00 bytes/sec
+total size is 1500123456  speedup is 713.82
+"""
+
+
+class TestParseNumber(unittest.TestCase):
+
+    def test_integer(self):
+        self.assertEqual(parse_number('5368709121'), 5368709121)
+
+    def test_float(self):
+        self.assertEqual(parse_number('0.001'), 0.001)
+
+
+class TestRsyncOutputParser(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = RsyncOutputParser()
+        for line in OUTPUT.splitlines():
+            self.parser.feed(line)
+
+    def test_changes(self):
+        self.assertEqual(self.parser.changes, {'created': 3, 'updated': 1,
+                                               'deleted': 1, 'attributes': 2})
+
+    def test_stats(self):
+        stats = self.parser.stats
+        self.assertEqual(stats['number_of_files'], 1234)
+        self.assertEqual(stats['number_of_regular_files_transferred'], 2)
+        self.assertEqual(stats['total_transferred_file_size'], 12345678)
+        self.assertEqual(stats['literal_data'], 2001234)
+        self.assertEqual(stats['matched_data'], 10344444)
+        self.assertEqual(stats['total_bytes_received'], 1234)
+        self.assertEqual(stats['file_list_generation_time'], 0.001)
+
+    def test_summary(self):
+        self.assertEqual(self.parser.stats['sent'], 2100321)
+        self.assertEqual(self.parser.stats['speedup'], 713.82)
+
+
+class TestMerge(unittest.TestCase):
+
+    def test_merge(self):
+        first = RsyncOutputParser()
+        second = RsyncOutputParser()
+        for line in OUTPUT.splitlines():
+            first.feed(line)
+            second.feed(line)
+        first.merge(second)
+        self.assertEqual(first.changes['created'], 6)
+        self.assertEqual(first.stats['number_of_files'], 2468)
+        self.assertEqual(first.stats['speedup'], 713.82)
+
+
+if __name__ == '__main__':
+    unittest.main()
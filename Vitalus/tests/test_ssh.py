@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+import asyncio
+import tempfile
+import shutil
+
+from Vitalus.ssh import SSHPool
+from Vitalus.ssh import read_config
+
+
+class TestSSHPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SSHPool()
+
+    def tearDown(self):
+        asyncio.run(self.pool.close())
+
+    def test_command(self):
+        command = self.pool.command('fr@sciunto.org', 'ls', '-1', '/tmp')
+        self.assertEqual(command[0], 'ssh')
+        self.assertEqual(command[-4:], ['fr@sciunto.org', 'ls', '-1', '/tmp'])
+        self.assertIn('ControlMaster=no', command)
+
+    def test_same_control_path(self):
+        command = self.pool.command('fr@sciunto.org', 'ls')
+        self.assertIn(self.pool.options()[-1], command)
+        self.assertIn(self.pool.options()[-1], self.pool.rsync_shell())
+
+    def test_close_removes_control_dir(self):
+        self.pool.options()
+        control_dir = self.pool.control_dir
+        self.assertTrue(os.path.isdir(control_dir))
+        asyncio.run(self.pool.close())
+        self.assertFalse(os.path.exists(control_dir))
+
+    def test_connect_timeout(self):
+        # ssh hanging, e.g. on a password prompt
+        bin_dir = tempfile.mkdtemp()
+        with open(os.path.join(bin_dir, 'ssh'), 'w') as script:
+            script.write('#!/bin/sh\nexec sleep 10\n')
+        os.chmod(os.path.join(bin_dir, 'ssh'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            self.pool.timeout = 0.2
+            self.assertTrue(asyncio.run(asyncio.wait_for(self.pool.connect('fr@sciunto.org'), 5)))
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(bin_dir)
+        self.assertEqual(self.pool.masters, set())
+
+    def test_connect_once(self):
+        self.pool.masters.add('fr@sciunto.org')
+        self.assertFalse(asyncio.run(self.pool.connect('fr@sciunto.org')))
+
+
+class TestReadConfig(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as config:
+            config.write("""
+# comment
+Host backup
+    HostName backup.sciunto.org
+    Port 2222
+
+Host *.sciunto.org !www.sciunto.org
+    Port=2200
+    User fr
+
+Host *
+    Port 22
+    ServerAliveInterval 60
+""")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_alias(self):
+        config = read_config('backup', self.path)
+        self.assertEqual(config['hostname'], 'backup.sciunto.org')
+        self.assertEqual(config['port'], '2222')
+        self.assertEqual(config['serveraliveinterval'], '60')
+
+    def test_pattern(self):
+        config = read_config('ftp.sciunto.org', self.path)
+        self.assertEqual(config['port'], '2200')
+        self.assertEqual(config['user'], 'fr')
+
+    def test_negated_pattern(self):
+        config = read_config('www.sciunto.org', self.path)
+        self.assertEqual(config['port'], '22')
+
+    def test_missing_file(self):
+        self.assertEqual(read_config('backup', self.path + 'missing'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shelve
+import shutil
+import tempfile
+import datetime
+import threading
+import unittest
+
+from Vitalus.state import StateStore
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.date = datetime.datetime(2013, 1, 10, 12, 30)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_last_backup(self):
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+        self.assertIsNone(state.last_backup('job'))
+        state.set_last_backup('job', self.date)
+        state.set_last_backup('job', self.date + datetime.timedelta(hours=1))
+        state.close()
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+        self.assertEqual(state.last_backup('job'), self.date + datetime.timedelta(hours=1))
+
+    def test_runs(self):
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+        for hour in range(3):
+            start = self.date + datetime.timedelta(hours=hour)
+            state.record_run('job', start, start + datetime.timedelta(seconds=30),
+                             'success', 100 * hour)
+        state.record_run('other', self.date, self.date, 'failed')
+        runs = state.runs('job', limit=2)
+        self.assertEqual([run['bytes'] for run in runs], [100, 200])
+        self.assertEqual(runs[-1]['duration'], 30.)
+        self.assertEqual(state.runs('other')[0]['status'], 'failed')
+
+    def test_fingerprint(self):
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+        self.assertIsNone(state.fingerprint('job'))
+        state.set_fingerprint('job', 'abc', '2013-01-10_12h30m00s', '["src"]')
+        fingerprint = state.fingerprint('job')
+        self.assertEqual(fingerprint['digest'], 'abc')
+        self.assertEqual(fingerprint['snapshot'], '2013-01-10_12h30m00s')
+        self.assertEqual(fingerprint['settings'], '["src"]')
+        state.set_fingerprint('job', None)
+        self.assertIsNone(state.fingerprint('job'))
+
+    def test_concurrent_writers(self):
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+
+        def write(name):
+            for number in range(50):
+                state.record_run(name, self.date, self.date, 'success', number)
+                state.set_last_backup(name, self.date)
+        threads = [threading.Thread(target=write, args=('job%i' % i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(4):
+            self.assertEqual(len(state.runs('job%i' % i)), 50)
+
+    def test_migrate_time_db(self):
+        with shelve.open(os.path.join(self.tmp, 'time.db')) as timebase:
+            timebase['job'] = self.date
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+        self.assertEqual(state.last_backup('job'), self.date)
+        # Imported once
+        state.set_last_backup('job', self.date + datetime.timedelta(days=1))
+        state.close()
+        state = StateStore(os.path.join(self.tmp, 'state.db'))
+        self.assertEqual(state.last_backup('job'), self.date + datetime.timedelta(days=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
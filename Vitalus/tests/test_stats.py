@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+from Vitalus.stats import StatsStore
+
+
+class TestStatsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = StatsStore(os.path.join(self.tmp, 'stats.db'))
+        self.now = datetime.datetime(2013, 1, 10)
+        for day in range(5):
+            date = self.now - datetime.timedelta(days=day)
+            self.store.record('job', date, 0,
+                              {'total_bytes_sent': 100 * day, 'speedup': 1.5,
+                               'unknown': 3},
+                              {'transfer': float(day), 'listing': 1.})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_jobs(self):
+        self.store.record('other', self.now, 23, {}, {})
+        self.assertEqual(self.store.jobs(), ['job', 'other'])
+
+    def test_runs(self):
+        runs = self.store.runs('job')
+        self.assertEqual(len(runs), 5)
+        self.assertEqual(runs[-1]['date'], self.now)
+        self.assertEqual(runs[-1]['duration'], 1.)
+        self.assertEqual(runs[-1]['phases'], {'transfer': 0., 'listing': 1.})
+        self.assertEqual(runs[-1]['returncode'], 0)
+
+    def test_runs_limit(self):
+        runs = self.store.runs('job', limit=2)
+        self.assertEqual([run['date'] for run in runs],
+                         [self.now - datetime.timedelta(days=1), self.now])
+
+    def test_trend(self):
+        trend = self.store.trend('job', 'total_bytes_sent', limit=3)
+        self.assertEqual([value for date, value in trend], [200, 100, 0])
+
+    def test_trend_phase(self):
+        trend = self.store.trend('job', 'transfer', limit=2)
+        self.assertEqual([value for date, value in trend], [1., 0.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+import sys
+
+from Vitalus.trace import Tracer
+from Vitalus.trace import ChildCPU
+from Vitalus.executor import JobExecutor
+
+
+class FakeJob:
+
+    def __init__(self, name):
+        self.name = name
+
+    def run(self):
+        pass
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'trace.json')
+        self.tracer = Tracer(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self):
+        with open(self.path) as trace:
+            events = json.load(trace)['traceEvents']
+        tracks = {event['tid']: event['args']['name'] for event in events
+                  if event['name'] == 'thread_name'}
+        spans = [(tracks[event['tid']], event['name'], event) for event in events
+                 if event['ph'] == 'X']
+        return spans
+
+    def test_spans(self):
+        with self.tracer.span('job', 'docs', 'job'):
+            with self.tracer.span('transfer', 'docs', 'phase', files=3) as args:
+                args['returncode'] = 0
+        self.tracer.write()
+        spans = self.read()
+        self.assertEqual([(track, name) for track, name, event in spans],
+                         [('docs', 'transfer'), ('docs', 'job')])
+        transfer, job = spans[0][2], spans[1][2]
+        self.assertEqual(transfer['args'], {'files': 3, 'returncode': 0})
+        # Nested
+        self.assertTrue(job['ts'] <= transfer['ts'])
+        self.assertTrue(transfer['ts'] + transfer['dur'] <= job['ts'] + job['dur'])
+
+    def test_executor(self):
+        executor = JobExecutor(max_workers=1)
+        executor.tracer = self.tracer
+        executor.run([FakeJob('a'), FakeJob('b')])
+        self.tracer.write()
+        spans = [(track, name) for track, name, event in self.read()]
+        self.assertEqual(sorted(spans), [('a', 'job'), ('a', 'wait'), ('b', 'job'), ('b', 'wait')])
+
+
+class TestChildCPU(unittest.TestCase):
+
+    def _busy(self):
+        return subprocess.Popen([sys.executable, '-c', 'sum(range(10 ** 6))'])
+
+    def test_alone(self):
+        with ChildCPU() as usage:
+            self._busy().wait()
+        self.assertGreater(usage.cpu, 0)
+
+    def test_overlap(self):
+        with ChildCPU() as first:
+            with ChildCPU() as second:
+                self._busy().wait()
+            self._busy().wait()
+        self.assertIsNone(first.cpu)
+        self.assertIsNone(second.cpu)
+        # Known again once alone
+        with ChildCPU() as usage:
+            self._busy().wait()
+        self.assertIsNotNone(usage.cpu)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+from Vitalus.stats import StatsStore
+from Vitalus import tuning
+from Vitalus.tuning import AutoTuner
+
+
+class TestAutoTuner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = StatsStore(os.path.join(self.tmp, 'stats.db'))
+        self.tuner = AutoTuner(self.store)
+        self.now = datetime.datetime(2013, 1, 10)
+        self.compressors = tuning._compressors
+        tuning._compressors = ['zstd', 'lz4', 'zlibx', 'zlib', 'none']
+
+    def tearDown(self):
+        tuning._compressors = self.compressors
+        shutil.rmtree(self.tmp)
+
+    def _record(self, sent, literal, transfer, cpu=0.1, size=1000, files=10):
+        for day in range(3):
+            self.store.record('job', self.now - datetime.timedelta(days=day), 0,
+                              {'total_bytes_sent': sent, 'total_bytes_received': 0,
+                               'literal_data': literal, 'total_file_size': size,
+                               'number_of_files': files},
+                              {'transfer': transfer}, cpu * transfer)
+
+    def test_local(self):
+        choice = self.tuner.choose('job', False)
+        self.assertTrue(choice['whole_file'])
+        self.assertIsNone(choice['compress'])
+
+    def test_no_history(self):
+        choice = self.tuner.choose('job', True)
+        self.assertEqual(choice['compress'], 'zlib')
+        self.assertEqual(tuning.rsync_options(choice), ['-z'])
+
+    def test_slow_link(self):
+        self._record(sent=1e5, literal=1e6, transfer=1.)
+        choice = self.tuner.choose('job', True)
+        self.assertEqual(choice['compress'], 'zstd')
+        self.assertEqual(choice['level'], 10)
+
+    def test_cpu_bound(self):
+        self._record(sent=1e5, literal=1e6, transfer=1., cpu=0.95)
+        choice = self.tuner.choose('job', True)
+        self.assertEqual(choice['level'], 1)
+
+    def test_incompressible(self):
+        self._record(sent=1e7, literal=1e7, transfer=1.)
+        choice = self.tuner.choose('job', True)
+        self.assertIsNone(choice['compress'])
+        self.assertFalse(choice['whole_file'])
+
+    def test_fast_link(self):
+        self._record(sent=1e9, literal=1e9, transfer=2., size=1e11, files=10)
+        choice = self.tuner.choose('job', True)
+        self.assertTrue(choice['whole_file'])
+        self.assertEqual(choice['block_size'], tuning.MAX_BLOCK_SIZE)
+
+    def test_fallback(self):
+        self._record(sent=1e5, literal=1e6, transfer=1.)
+        choice = tuning.fallback(self.tuner.choose('job', True))
+        self.assertEqual((choice['compress'], choice['level'], choice['refused']),
+                         ('zlib', 9, 'zstd'))
+        self.assertEqual(tuning.rsync_options(choice), ['-z', '--compress-level=9'])
+        self.assertEqual(tuning.fallback(choice), choice)
+        # Not chosen again
+        self.store.record('job', self.now + datetime.timedelta(days=1), 0,
+                          {'total_bytes_sent': 1e5, 'total_bytes_received': 0,
+                           'literal_data': 1e6}, {'transfer': 1.}, 0.1, choice)
+        self.assertEqual(self.tuner.choose('job', True)['compress'], 'zlib')
+
+    def test_rsync_options(self):
+        choice = {'compress': 'zstd', 'level': 3, 'whole_file': True,
+                  'block_size': None, 'reason': ''}
+        self.assertEqual(tuning.rsync_options(choice),
+                         ['-z', '--compress-choice=zstd', '--compress-level=3',
+                          '--whole-file'])
+
+
+if __name__ == '__main__':
+    unittest.main()
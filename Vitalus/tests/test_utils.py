@@ -4,7 +4,16 @@
 
 from Vitalus.utils import get_older_files
 from Vitalus.utils import get_last_file
-
+from Vitalus.utils import split_balanced
+from Vitalus.utils import estimate_entries
+from Vitalus.utils import r_chmod
+from Vitalus.utils import r_chown
+from Vitalus.agent import set_metadata
+
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
 import datetime
 
@@ -134,3 +143,75 @@ class TestOlderFiles(unittest.TestCase):
 
         result = get_older_files(file_list, days=0, keep=10)
         self.assertEqual(result, expected_list)
+
+
+class TestSplitBalanced(unittest.TestCase):
+
+    def test_balanced(self):
+        weights = {'big': 10, 'a': 4, 'b': 3, 'c': 3, 'd': 1}
+        groups = split_balanced(weights, 2)
+        totals = sorted(sum(weights[x] for x in group) for group in groups)
+        self.assertEqual(totals, [10, 11])
+
+    def test_more_groups_than_items(self):
+        groups = split_balanced({'a': 1}, 3)
+        self.assertEqual(groups, [['a'], [], []])
+
+
+class TestEstimateEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'dir', 'sub'))
+        for name in ('dir/f1', 'dir/sub/f2', 'file'):
+            open(os.path.join(self.tmp, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_count(self):
+        self.assertEqual(estimate_entries(self.tmp), {'dir': 4, 'file': 1})
+
+    def test_budget(self):
+        self.assertEqual(estimate_entries(self.tmp, budget=2), {'dir': 2, 'file': 1})
+
+
+class TestSetMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # Deeper than the recursion limit of python
+        self.deep = self.tmp
+        for level in range(1100):
+            self.deep = os.path.join(self.deep, 'd')
+            os.mkdir(self.deep)
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.tmp, name))
+        open(os.path.join(self.tmp, 'a', 'file'), 'w').close()
+        os.link(os.path.join(self.tmp, 'a', 'file'), os.path.join(self.tmp, 'b', 'file'))
+        os.symlink('/', os.path.join(self.tmp, 'b', 'link'))
+
+    def tearDown(self):
+        # shutil.rmtree is recursive
+        subprocess.run(['rm', '-rf', self.tmp])
+
+    def test_chmod(self):
+        r_chmod(self.tmp, 0o700)
+        self.assertEqual(os.stat(self.deep).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(os.path.join(self.tmp, 'b', 'file')).st_mode & 0o777, 0o700)
+        # The target of the symlink is not changed
+        self.assertNotEqual(os.stat('/').st_mode & 0o777, 0o700)
+
+    def test_skip_unchanged(self):
+        # root, 1100 dirs, a, b, one file (hardlinked) but not the symlink
+        self.assertEqual(set_metadata(self.tmp, mode=0o750), 1104)
+        self.assertEqual(set_metadata(self.tmp, mode=0o750), 0)
+
+    def test_chown_unchanged(self):
+        r_chown(self.tmp, os.getuid(), os.getgid())
+        self.assertEqual(set_metadata(self.tmp, os.getuid(), os.getgid()), 0)
+
+    def test_missing(self):
+        with self.assertRaises(OSError):
+            set_metadata(os.path.join(self.tmp, 'no'), mode=0o700)
+
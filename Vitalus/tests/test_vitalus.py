@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+from Vitalus.vitalus import Vitalus
+from Vitalus.vitalus import JobSpec
+
+
+class TestJobSpec(unittest.TestCase):
+
+    def test_is_due(self):
+        now = datetime.datetime(2013, 1, 10, 12)
+        spec = JobSpec('job', 3600, None)
+        self.assertTrue(spec.is_due(None, now))
+        self.assertTrue(spec.is_due(now - datetime.timedelta(hours=2), now))
+        self.assertFalse(spec.is_due(now - datetime.timedelta(minutes=30), now))
+        # Unknown period
+        self.assertTrue(JobSpec('job', None, None).is_due(now, now))
+
+
+class TestDueJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log_dir = os.path.join(self.tmp, 'log')
+        self.source = os.path.join(self.tmp, 'source')
+        os.mkdir(self.source)
+        self.vitalus = Vitalus(log_path=self.log_dir)
+        self.vitalus.set_destination(os.path.join(self.tmp, 'dest'))
+        self.vitalus.add_rsyncjob('recent', self.source, period=1)
+        self.vitalus.add_rsyncjob('old', self.source, period=1)
+        self.vitalus.add_rsyncjob('new', self.source, period=1)
+        now = datetime.datetime.now()
+        self.vitalus.state.set_last_backup('recent', now - datetime.timedelta(minutes=10))
+        self.vitalus.state.set_last_backup('old', now - datetime.timedelta(hours=2))
+
+    def tearDown(self):
+        self.vitalus.state.close()
+        shutil.rmtree(self.tmp)
+
+    def test_due_jobs(self):
+        self.assertEqual(self.vitalus.due_jobs(), ['old', 'new'])
+        self.vitalus.force = True
+        self.assertEqual(self.vitalus.due_jobs(), ['recent', 'old', 'new'])
+
+    def test_duplicate(self):
+        self.vitalus.add_rsyncjob('old', self.source, period=5)
+        self.assertEqual(len(self.vitalus.specs), 3)
+
+    def test_nothing_due(self):
+        self.vitalus.state.set_last_backup('old', datetime.datetime.now())
+        self.vitalus.state.set_last_backup('new', datetime.datetime.now())
+        self.vitalus.run()
+        # The jobs are not built, no pidfile, no log
+        self.assertEqual(self.vitalus.jobs, [])
+        self.assertEqual(self.vitalus.specs[0].job, None)
+        self.assertEqual(sorted(os.listdir(self.log_dir)),
+                         sorted(name for name in os.listdir(self.log_dir)
+                                if name.startswith('state.db')))
+
+    def test_build_jobs(self):
+        jobs = self.vitalus._build_jobs(self.vitalus.due_jobs())
+        self.assertEqual([job.name for job in jobs], ['old', 'new'])
+        self.assertIs(jobs[0].state, self.vitalus.state)
+        self.assertIs(jobs[0].ssh_pool, self.vitalus.ssh_pool)
+        # Built once
+        self.assertIs(self.vitalus._build_jobs(['old'])[0], jobs[0])
+        self.assertEqual(len(self.vitalus._build_jobs()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
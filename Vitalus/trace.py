@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import os
+import json
+import time
+import logging
+import resource
+import threading
+import contextlib
+
+
+def children_cpu():
+    """
+    Return the CPU time (user + system) of the terminated children
+
+    :returns: float -- seconds
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class ChildCPU:
+    """
+    Measure the CPU time of a subprocess, run in this context,
+    with the difference of children_cpu().
+
+    The difference also counts the subprocesses terminated meanwhile:
+    if another subprocess ran at the same time, the time is unknown (None).
+    Every subprocess must be run in such a context.
+
+    Example::
+
+        with ChildCPU() as usage:
+            subprocess.run(command)
+        usage.cpu
+    """
+    _lock = threading.Lock()
+    # Subprocesses running and started
+    _running = 0
+    _started = 0
+
+    def __init__(self):
+        # CPU time (seconds), known at the exit of the context
+        self.cpu = None
+        self._alone = False
+        self._number = None
+        self._start = None
+
+    def __enter__(self):
+        with ChildCPU._lock:
+            self._alone = ChildCPU._running == 0
+            ChildCPU._running += 1
+            ChildCPU._started += 1
+            self._number = ChildCPU._started
+            self._start = children_cpu()
+        return self
+
+    def __exit__(self, *exc_info):
+        with ChildCPU._lock:
+            ChildCPU._running -= 1
+            # Nothing running at the start, nothing started since
+            if self._alone and ChildCPU._started == self._number:
+                self.cpu = children_cpu() - self._start
+        return False
+
+
+class Tracer:
+    """
+    Record the spans of a run (run, jobs, phases, subprocesses)
+    and write them in the Chrome trace event format,
+    readable by chrome://tracing or Perfetto.
+
+    The spans are drawn on tracks: one for the run,
+    one per job and one per subprocess.
+
+    :param path: trace file path
+    :type path: string
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('Vitalus.Tracer')
+        self.pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events = []
+        # track name: tid
+        self._tracks = {}
+
+    def now(self):
+        """
+        Return the current time of the trace
+
+        :returns: float -- microseconds
+        """
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def track(self, name):
+        """
+        Return the id of a track, created if needed
+
+        :param name: track name
+        :returns: int
+        """
+        with self._lock:
+            if name not in self._tracks:
+                tid = len(self._tracks) + 1
+                self._tracks[name] = tid
+                self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                                     'tid': tid, 'args': {'name': name}})
+                self._events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': self.pid,
+                                     'tid': tid, 'args': {'sort_index': tid}})
+            return self._tracks[name]
+
+    def complete(self, name, track, start, end=None, category='vitalus', args=None):
+        """
+        Record a span
+
+        :param name: span name
+        :param track: track name
+        :param start: start (see now())
+        :param end: end (see now()), None for now
+        :param category: category of the span
+        :param args: values shown with the span
+        :type args: dict
+        """
+        if end is None:
+            end = self.now()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid,
+                 'tid': self.track(track), 'ts': start, 'dur': end - start}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, track, category='vitalus', **args):
+        """
+        Record the span of a block
+
+        :param name: span name
+        :param track: track name
+        :param category: category of the span
+        :param args: values shown with the span
+        :returns: dict -- args, can be completed in the block
+        """
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.complete(name, track, start, category=category, args=args)
+
+    def write(self):
+        """
+        Write the trace file
+        """
+        with self._lock:
+            events = list(self._events)
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0,
+                       'args': {'name': 'Vitalus'}})
+        self.logger.debug('Write %i trace events in %s', len(events), self.path)
+        with open(self.path + '.tmp', 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+        os.replace(self.path + '.tmp', self.path)
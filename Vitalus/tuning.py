@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+import re
+import logging
+import subprocess
+
+from Vitalus.trace import ChildCPU
+
+logger = logging.getLogger('Vitalus.tuning')
+
+# Above this throughput (bytes/s), the link is fast (LAN):
+# compression costs more CPU than it saves time
+FAST_LINK = 30e6
+# Above this throughput, the network is faster than reading
+# both sides for the delta: send whole files
+VERY_FAST_LINK = 100e6
+# Below this throughput, compress as much as possible
+SLOW_LINK = 1e6
+# Sent/literal ratio above which data is considered incompressible
+INCOMPRESSIBLE = 0.9
+# Part of the transfer time spent by rsync on CPU above which
+# it is considered CPU bound
+CPU_BOUND = 0.8
+# Average file size above which the largest block size is used
+LARGE_FILES = 1e9
+MAX_BLOCK_SIZE = 131072
+# rsync exit codes of an option refused by the remote rsync:
+# syntax or usage error, protocol incompatibility, action not supported
+REFUSED = (1, 2, 4)
+
+_compressors = None
+
+
+def compressors():
+    """
+    Return the compression algorithms supported by the local rsync
+
+    :returns: list -- e.g. ['zstd', 'lz4', 'zlibx', 'zlib', 'none']
+    """
+    global _compressors
+    if _compressors is None:
+        try:
+            with ChildCPU():
+                output = subprocess.run(['/usr/bin/rsync', '--version'],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL).stdout
+        except OSError:
+            output = b''
+        match = re.search(r'Compress list:\s*\n\s*(.+)', output.decode(errors='replace'))
+        if match:
+            _compressors = match.group(1).split()
+        else:
+            # rsync < 3.2
+            _compressors = ['zlib']
+    return _compressors
+
+
+class AutoTuner:
+    """
+    Choose the transfer options of a job from its past runs.
+
+    The throughput of the link, the compressibility of the data
+    and the CPU time of rsync are read in the statistics of the
+    last runs. Without enough runs, the usual options are kept.
+
+    :param stats: statistics of the transfers
+    :type stats: :class:`Vitalus.stats.StatsStore`
+    :param history: number of runs considered
+    :type history: int
+    """
+    def __init__(self, stats, history=10):
+        self.stats = stats
+        self.history = history
+
+    def _measure(self, name):
+        """
+        Return the medians of the measures of the last runs, None if not enough runs
+
+        :returns: dict -- throughput, compression ratio, CPU ratio, file size
+        """
+        runs = [run for run in self.stats.runs(name, self.history)
+                if run['returncode'] == 0 and run['phases'].get('transfer')]
+        if len(runs) < 2:
+            return None
+
+        def median(values):
+            values = sorted(value for value in values if value is not None)
+            if values == []:
+                return None
+            return values[len(values) // 2]
+
+        exchanged = [(run['total_bytes_sent'] or 0) + (run['total_bytes_received'] or 0)
+                     for run in runs]
+        return {'throughput': median(value / run['phases']['transfer']
+                                     for value, run in zip(exchanged, runs)),
+                'compression': median(run['total_bytes_sent'] / run['literal_data']
+                                      for run in runs
+                                      if run['literal_data'] and run['total_bytes_sent']),
+                'cpu': median(run['cpu'] / run['phases']['transfer']
+                              for run in runs if run['cpu'] is not None),
+                'file_size': median(run['total_file_size'] / run['number_of_files']
+                                    for run in runs
+                                    if run['number_of_files'] and run['total_file_size']),
+                }
+
+    def choose(self, name, network):
+        """
+        Choose the transfer options of a job
+
+        :param name: job name
+        :param network: True if the source or the destination is remote
+        :returns: dict -- compress (None or algorithm), level, whole_file,
+            block_size, reason and refused (algorithm refused by the
+            remote rsync, see :func:`fallback`)
+        """
+        choice = {'compress': None, 'level': None, 'whole_file': False,
+                  'block_size': None, 'reason': '', 'refused': None}
+        if not network:
+            # Delta transfer reads both sides for nothing
+            choice['whole_file'] = True
+            choice['reason'] = 'local copy'
+            return choice
+
+        measures = self._measure(name)
+        if measures is None:
+            choice['compress'] = 'zlib'
+            choice['reason'] = 'not enough runs'
+            return choice
+
+        reasons = []
+        throughput = measures['throughput']
+        if measures['file_size'] is not None and measures['file_size'] > LARGE_FILES:
+            choice['block_size'] = MAX_BLOCK_SIZE
+            reasons.append('large files')
+        if throughput is not None and throughput > VERY_FAST_LINK:
+            choice['whole_file'] = True
+            reasons.append('very fast link')
+        elif throughput is not None and throughput > FAST_LINK:
+            reasons.append('fast link')
+        elif measures['compression'] is not None and measures['compression'] > INCOMPRESSIBLE:
+            reasons.append('incompressible data')
+        else:
+            # Refused by the remote rsync in the last runs
+            refused = set(run['tuning']['refused'] for run in self.stats.runs(name, self.history)
+                          if run['tuning'] is not None)
+            algorithms = [algorithm for algorithm in compressors() if algorithm not in refused]
+            choice['compress'] = 'zstd' if 'zstd' in algorithms else 'zlib'
+            if throughput is not None and throughput < SLOW_LINK:
+                # CPU is cheap compared to the link
+                choice['level'] = 9 if choice['compress'] == 'zlib' else 10
+                reasons.append('slow link')
+            else:
+                choice['level'] = 1
+                reasons.append('medium link')
+            if measures['cpu'] is not None and measures['cpu'] > CPU_BOUND:
+                choice['level'] = 1
+                reasons.append('CPU bound')
+        choice['reason'] = ', '.join(reasons)
+        logger.debug('Tuning of %s: %s (measures: %s)', name, choice, measures)
+        return choice
+
+
+def fallback(choice):
+    """
+    Return a choice of AutoTuner.choose() with the compression
+    supported by all rsync versions (zlib), for a remote rsync
+    refusing the chosen one
+
+    :param choice: dict
+    :returns: dict
+    """
+    if choice['compress'] in (None, 'zlib'):
+        return choice
+    choice = dict(choice)
+    # Not chosen again by AutoTuner.choose()
+    choice['refused'] = choice['compress']
+    choice['compress'] = 'zlib'
+    if choice['level'] is not None:
+        choice['level'] = min(choice['level'], 9)
+    choice['reason'] += ', fallback to zlib'
+    return choice
+
+
+def rsync_options(choice):
+    """
+    Return the rsync options of a choice of AutoTuner.choose()
+
+    :param choice: dict
+    :returns: list
+    """
+    options = []
+    if choice['compress'] is not None:
+        options.append('-z')
+        if choice['compress'] != 'zlib':
+            options.append('--compress-choice=' + choice['compress'])
+        if choice['level'] is not None:
+            options.append('--compress-level=%i' % choice['level'])
+    if choice['whole_file']:
+        options.append('--whole-file')
+    if choice['block_size'] is not None:
+        options.append('--block-size=%i' % choice['block_size'])
+    return options
@@ -20,7 +20,6 @@ import tarfile
 import os.path
 import os
 import logging
-import datetime
 
 logger = logging.getLogger('Vitalus.utils')
 
@@ -31,15 +30,12 @@ def r_chmod(path, mode):
 
         :param path: path
         :param mode: mode
+
+        .. note::
+            See :func:`Vitalus.agent.set_metadata`
         """
-        os.chmod(path, mode)
-        for item in os.listdir(path):
-            itempath = os.path.join(path, item)
-            if os.path.isfile(itempath):
-                os.chmod(itempath, mode)
-            elif os.path.isdir(itempath):
-                os.chmod(itempath, mode)
-                r_chmod(itempath, mode)
+        from Vitalus import agent
+        agent.set_metadata(path, mode=mode)
 
 
 def r_chown(path, uid, gid):
@@ -49,15 +45,12 @@ def r_chown(path, uid, gid):
         :param path: path
         :param uid: user ID
         :param gid: group ID
+
+        .. note::
+            See :func:`Vitalus.agent.set_metadata`
         """
-        os.chown(path, uid, gid)
-        for item in os.listdir(path):
-            itempath = os.path.join(path, item)
-            if os.path.isfile(itempath):
-                os.chown(itempath, uid, gid)
-            elif os.path.isdir(itempath):
-                os.chown(itempath, uid, gid)
-                r_chown(itempath, uid, gid)
+        from Vitalus import agent
+        agent.set_metadata(path, uid, gid)
 
 
 def compress(path):
@@ -72,17 +65,59 @@ def compress(path):
 
 def get_folder_size(path):
     """
-    Get the size of the content in path
+    Get the size of the content in path,
+    files with several links are counted once
+
+    .. note::
+        See :func:`Vitalus.agent.op_usage`
+    """
+    from Vitalus import agent
+    return agent.op_usage(path)['size']
+
+
+def estimate_entries(path, budget=10000):
+    """
+    Estimate the size of each entry of a directory
+    by counting the files below it.
+    The count stops at budget entries per entry.
+
+    :param path: directory
+    :param budget: max number of files counted per entry
+    :returns: dict -- {name: count}
+    """
+    entries = {}
+    for entry in os.scandir(path):
+        count = 1
+        if entry.is_dir(follow_symlinks=False):
+            stack = [entry.path]
+            while stack and count < budget:
+                try:
+                    for item in os.scandir(stack.pop()):
+                        count += 1
+                        if item.is_dir(follow_symlinks=False):
+                            stack.append(item.path)
+                except OSError:
+                    pass
+        entries[entry.name] = min(count, budget)
+    return entries
+
+
+def split_balanced(weights, number):
+    """
+    Split items in groups of similar total weight
+    (largest items first, each in the lightest group).
+
+    :param weights: dict -- {item: weight}
+    :param number: number of groups
+    :returns: list of lists
     """
-    size = 0
-    for item in os.walk(path):
-        for file in item[2]:
-            try:
-                size += os.path.getsize(os.path.join(item[0], file))
-            except:
-                logger.error("Impossible to get size of: %s",
-                             os.path.join(item[0], file))
-    return size
+    groups = [[] for i in range(number)]
+    totals = [0] * number
+    for item in sorted(weights, key=lambda x: (-weights[x], x)):
+        lightest = totals.index(min(totals))
+        groups[lightest].append(item)
+        totals[lightest] += weights[item]
+    return groups
 
 
 def get_last_file(file_list):
@@ -93,20 +128,8 @@ def get_last_file(file_list):
 
     :return: filename
     """
-    if file_list == []:
-        return None
-
-    last_date = datetime.datetime(1, 1, 1, 0, 0)
-    last = None
-    for afile in file_list:
-        try:
-            date = datetime.datetime.strptime(afile, '%Y-%m-%d_%Hh%Mm%Ss')
-        except ValueError:
-            continue
-        if date > last_date:
-            last_date = date
-            last = afile
-    return last
+    from Vitalus import history
+    return history.Snapshots(file_list).last()
 
 
 def get_older_files(file_list, days=5, keep=10):
@@ -115,3 +138,18 @@ def get_older_files(file_list, days=5, keep=10):
     """
     from Vitalus import history
     return history.older_keepmin(file_list, days=days, keep=keep)
+
+
+async def kill(process):
+    """
+    Kill an asyncio subprocess and reap it.
+
+    :param process: subprocess, may be terminated
+    :type process: asyncio.subprocess.Process
+    """
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
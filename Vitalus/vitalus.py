@@ -17,17 +17,50 @@
 # Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
 
 import os
-try:
-    import psutil
-except ImportError:
-    psutil = None
-#import signal
-import logging, logging.handlers
 import sys
+import time
+import logging
+import datetime
+import contextlib
 
 from Vitalus import __version__
-from Vitalus.rsyncjob import RsyncJob
-from Vitalus.job import TARGETError
+from Vitalus.state import StateStore
+
+# The other modules (asyncio, the jobs...) are imported
+# when a job is due, see Vitalus.due_jobs()
+
+
+class JobSpec:
+    """
+    A job declared by add_rsyncjob() or add_customjob(),
+    built when it is due.
+
+    :param name: job name
+    :type name: string
+    :param period: min duration between two backups (seconds),
+        None if unknown (always due)
+    :type period: float
+    :param build: function returning the job
+    """
+    def __init__(self, name, period, build):
+        self.name = name
+        self.period = period
+        self.build = build
+        self.job = None
+
+    def is_due(self, last, now):
+        """
+        Return True if the job must run
+
+        :param last: date of the last backup, None if never done
+        :type last: datetime.datetime
+        :param now: current date
+        :type now: datetime.datetime
+        :returns: bool
+        """
+        if self.period is None or last is None:
+            return True
+        return (now - last).total_seconds() > self.period
 
 
 class Vitalus:
@@ -41,35 +74,70 @@ class Vitalus:
     :param force: if True, do not perform timebase check.
     All jobs will be run.
     :type force: bool
+    :param trace: write the spans of the runs (jobs, phases, subprocesses)
+        in this file, in the Chrome trace event format. None to not trace.
+    :type trace: string
 
     """
-    def __init__(self, log_path='~/.backup', log_rotation=30, force=False):
+    def __init__(self, log_path='~/.backup', log_rotation=30, force=False, trace=None):
         # Variables
+        self.specs = []
         self.jobs = []
         self.terminate = False
         self.destination = None
+        self.mirrors = ()
         self.force = force
+        # See set_concurrency()
+        self.concurrency = (1, 1, 1)
+        self.executor = None
+        # Created with the jobs, see _build_jobs()
+        self.ssh_pool = None
+        self.stats = None
+        # Events of the runs, see _start()
+        self.events = None
+        # See set_metrics()
+        self.metrics = None
+        self.tracer = None
+        if trace is not None:
+            from Vitalus.trace import Tracer
+            self.tracer = Tracer(os.path.expanduser(trace))
+        # Deletion of the old snapshots, see set_trash()
+        self.purge = True
+        self.purge_pause = 0.
+        # See set_space_check()
+        self.space_check = {'margin': 1.2, 'min_free': 0, 'prune': False, 'dry_run': False}
 
         # Logging
         self.backup_log_dir = os.path.expanduser(log_path)
         if not os.path.isdir(self.backup_log_dir):
             os.makedirs(self.backup_log_dir)
+        self.log_rotation = log_rotation
         self.pidfilename = os.path.join(self.backup_log_dir, 'backup.pid')
+        # Last backups and runs of the jobs (imports time.db)
+        self.state = StateStore(os.path.join(self.backup_log_dir, 'state.db'))
 
         self.logger = logging.getLogger('Vitalus')
+        self.logger.setLevel(logging.INFO)
+        # The log file, the pidfile and the priority are set
+        # when a job is due, see _start()
+        self.started = False
+        #signal.signal(signal.SIGTERM, self._signal_handler)
+
+    def _start(self):
+        """
+        Prepare the run of jobs: log file, pidfile and priority
+        """
+        if self.started:
+            return
+        from Vitalus import logs
+        from Vitalus.events import EventLog, EVENTS
+
         LOG_PATH = os.path.join(self.backup_log_dir, 'backup.log')
-        # Add the log message handler to the logger
-        log_rotator = logging.handlers.TimedRotatingFileHandler(LOG_PATH,
-                                                                when='midnight',
-                                                                interval=1,
-                                                                backupCount=log_rotation,
-                                                                encoding=None,
-                                                                delay=False,
-                                                                utc=False)
+        # Add the log message handler to the logger (once per file)
         formatter = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s')
-        log_rotator.setFormatter(formatter)
-        self.logger.addHandler(log_rotator)
-        self.logger.setLevel(logging.INFO)
+        logs.add_file_handler(self.logger, LOG_PATH, self.log_rotation, formatter)
+        # Machine-readable events, see Vitalus.events.Summary
+        self.events = EventLog(os.path.join(self.backup_log_dir, EVENTS))
 
         # Create a pidfile
         self._create_pidfile()
@@ -77,8 +145,8 @@ class Vitalus:
         #Priority
         self._set_process_low_priority()
 
+        self.started = True
         self.logger.info('Vitalus %s starts...' % __version__)
-        #signal.signal(signal.SIGTERM, self._signal_handler)
 
     def set_log_level(self, level='INFO'):
         """
@@ -121,6 +189,7 @@ class Vitalus:
             if os.path.exists("/proc/%s" % old_pd):
                 # Yes
                 self.logger.info('An instance is already running, exiting')
+                self.events.emit('already_running')
                 sys.exit(0)
             else:
                 # No
@@ -138,7 +207,11 @@ class Vitalus:
     def _set_process_high_priority(self):
         """ Change nice/ionice"""
         self.logger.debug('Set high priority')
-        if psutil and psutil.IOPRIO_CLASS_NONE:
+        try:
+            import psutil
+        except ImportError:
+            return
+        if psutil.IOPRIO_CLASS_NONE:
             # ionice
             p = psutil.Process(os.getpid())
             p.set_ionice(psutil.IOPRIO_CLASS_NONE, value=0)
@@ -148,30 +221,122 @@ class Vitalus:
     def _set_process_low_priority(self):
         """ Change nice/ionice"""
         self.logger.debug('Set low priority')
-        if psutil and psutil.IOPRIO_CLASS_NONE:
+        try:
+            import psutil
+        except ImportError:
+            return
+        if psutil.IOPRIO_CLASS_NONE:
             # ionice
             p = psutil.Process(os.getpid())
             p.set_ionice(psutil.IOPRIO_CLASS_IDLE)
             # nice
             p.nice = 15
 
-    def set_destination(self, destination, guid=(None, None)):
+    def set_concurrency(self, max_workers=1, host_limit=1, device_limit=1):
+        """ Set how many jobs can run at the same time
+
+        :param max_workers: max number of jobs running at the same time
+        :type max_workers: int
+        :param host_limit: max number of jobs writing to the same destination host
+        :type host_limit: int
+        :param device_limit: max number of jobs reading the same source device
+        :type device_limit: int
+
+        .. note::
+            A local destination is identified by its device.
+            A SSH source is identified by its host.
+        """
+        self.logger.debug("Set concurrency: %s workers, %s per host, %s per device",
+                          max_workers, host_limit, device_limit)
+        self.concurrency = (max_workers, host_limit, device_limit)
+
+    def set_trash(self, purge=True, pause=0.):
+        """ Set how old snapshots are deleted.
+        They are moved to a trash (.trash in the destination) during the jobs,
+        and deleted afterwards.
+
+        :param purge: delete the trash at the end of run(), after all jobs
+        :type purge: bool
+        :param pause: sleep (seconds) every 1000 deleted files, to throttle the deletion
+        :type pause: float
+
+        .. note::
+            With purge=False, the trash can be deleted by purge_trash()
+            in another script, e.g. at night.
+        """
+        self.logger.debug("Set trash: purge %s, pause %s", purge, pause)
+        self.purge = purge
+        self.purge_pause = pause
+
+    def set_space_check(self, enabled=True, margin=1.2, min_free=0, prune=False, dry_run=False):
+        """ Set the check of the free space of the destination before each transfer.
+        The bytes written by the transfer are estimated from the previous runs.
+
+        :param enabled: check the free space
+        :type enabled: bool
+        :param margin: the estimated bytes are multiplied by this value
+        :type margin: float
+        :param min_free: bytes to keep free in the destination
+        :type min_free: int
+        :param prune: delete the oldest snapshots (but the last one) instead of
+            aborting the job when the space is too low
+        :type prune: bool
+        :param dry_run: estimate with rsync --dry-run when the job has no history
+            (the source is read twice)
+        :type dry_run: bool
+
+        .. note::
+            Applies to the jobs added afterwards.
+        """
+        self.logger.debug("Set space check: %s, margin %s, min free %s, prune %s, dry run %s",
+                          enabled, margin, min_free, prune, dry_run)
+        if enabled:
+            self.space_check = {'margin': margin, 'min_free': min_free,
+                                'prune': prune, 'dry_run': dry_run}
+        else:
+            self.space_check = None
+
+    def set_metrics(self, sink):
+        """ Send the measures of the runs and of the jobs
+        (duration of each phase, subprocesses, SSH round-trips, last backup...)
+        to a sink.
+
+        :param sink: e.g. TextfileSink('/var/lib/node_exporter/textfile')
+            for the textfile collector of node_exporter
+        :type sink: :class:`Vitalus.metrics.MetricsSink`
+
+        .. note::
+            Applies to the jobs built afterwards.
+        """
+        self.logger.debug("Set metrics: %s", sink)
+        self.metrics = sink
+
+    def set_destination(self, destination, guid=(None, None), mirrors=()):
         """ Set the destination of the backup
         if uid or gid are None, files owner are not changed
 
         :param destination: destination path
         :type destination: string
-        :param guid: (uid, gid) for destination
+        :param guid: (uid, gid) for destination, set by rsync --chown
+            (rsync >= 3.1.0, run as root on the destination)
         :type guid: tuple
+        :param mirrors: other destinations receiving the same backups
+        :type mirrors: list
 
+        .. note::
+            The sources are read once for the destination and the mirrors.
+            Each mirror keeps its own snapshots.
         """
         self.logger.debug("Set destination: %s", destination)
         self.destination = destination
         self.guid = guid
+        self.mirrors = mirrors
 
     #TODO: filter -> *filter ?
     def add_rsyncjob(self, name, source, period=24, history=False,
-                     duration=50, keep=10, filter=None):
+                     duration=50, keep=10, filter=None, timeout=None, shards=1,
+                     autotune=False, retention=None, fingerprint=False,
+                     incremental=False, full_pass=7):
         """ Add a rsync job.
 
         :param name: backup label
@@ -191,6 +356,20 @@ class Vitalus:
         :type keep: int
         :param filter: filters
         :type filter: tuple
+        :param timeout: max duration of the transfer (seconds), None for no limit
+        :type timeout: float
+        :param shards: number of concurrent rsync processes for this source
+        :type shards: int
+        :param autotune: choose compression, whole-file and block size from the past runs
+        :type autotune: bool
+        :param retention: snapshots to keep, a policy of Vitalus.history
+            (AgePolicy, GFSPolicy, LogarithmicPolicy), None to use duration and keep
+        :param fingerprint: skip the transfer if the source is unchanged
+        :type fingerprint: bool
+        :param incremental: transfer only the changed paths of a local source
+        :type incremental: bool
+        :param full_pass: with incremental, days between two full transfers
+        :type full_pass: float
 
         :raises: ValueError -- if destination if not set
 
@@ -202,24 +381,54 @@ class Vitalus:
             This is a feature.
             It leaves you the possibility to switch on/off the history.
             If you don't want the date in the path, set the value to None.
+
+            shards: for sources with many files, the top-level entries
+            are split between several rsync processes.
+
+            autotune: the transfer options chosen for each run are
+            recorded in the statistics (see StatsStore.runs()).
+
+            retention: e.g. GFSPolicy(hourly=24, daily=7, weekly=4, monthly=12)
+            keeps the last snapshot of the last 24 hours, 7 days, 4 weeks
+            and 12 months. duration and keep are ignored.
+
+            fingerprint: for sources rarely modified (photos, archives),
+            the metadata of the source (names, sizes, mtimes, inodes)
+            is hashed before the transfer. If nothing changed since the
+            last successful backup, rsync is not run and no snapshot
+            is created, even with force. The walk reads no file content.
+
+            incremental: for local sources with many files, an index of
+            the source (log_path/name.index.db) gives the paths changed
+            since the last backup and only those are given to rsync.
+            The snapshots stay complete. Every full_pass days, the whole
+            source is transferred, e.g. to apply changed filters.
         """
-        if name in self.jobs:
+        if name in [spec.name for spec in self.specs]:
             self.logger.critical("%s already present in the job list. Job's name should be uniq.", name)
             return
 
         if self.destination:
             period_in_seconds = period * 3600
             self.logger.debug("add rsync job: %s", name)
-            try:
-                self.jobs.append(RsyncJob(self.backup_log_dir, self.destination, name, source,
-                                          period_in_seconds,
-                                          history, duration, keep, self.force,
-                                          self.guid, filter))
-            except TARGETError as e:
-                # We abort this job
-                self.logger.error(e)
-            except:
-                self.logger.exception('Exception raised in add_job()')
+            # The settings of the destination when the job is added
+            destination, guid, mirrors = self.destination, self.guid, self.mirrors
+            space_check, force = self.space_check, self.force
+
+            def build():
+                from Vitalus.rsyncjob import RsyncJob
+                from Vitalus.tuning import AutoTuner
+                tuner = None
+                if autotune:
+                    tuner = AutoTuner(self.stats)
+                return RsyncJob(self.backup_log_dir, destination, name, source,
+                                period_in_seconds,
+                                history, duration, keep, force,
+                                guid, filter, timeout,
+                                self.ssh_pool, self.stats, shards,
+                                mirrors, tuner, retention,
+                                space_check, fingerprint, incremental, full_pass)
+            self.specs.append(JobSpec(name, period_in_seconds, build))
         else:
             raise ValueError('Destination not set')
 
@@ -240,31 +449,230 @@ class Vitalus:
             git-annex repository can be synchronized by writting
             a proper class to use git-annex features.
         """
-        if name in self.jobs:
+        if name in [spec.name for spec in self.specs]:
             self.logger.critical("%s already present in the job list. Job's name should be uniq.", name)
             return
 
         if self.destination:
             self.logger.debug("add custom job: %s", name)
-            try:
-                self.jobs.append(job(self.backup_log_dir, self.destination, name, *args))
-            except TARGETError as e:
-                # We abort this job
-                self.logger.error(e)
-            except:
-                self.logger.exception('Exception raised in add_job()')
+            destination = self.destination
+
+            def build():
+                return job(self.backup_log_dir, destination, name, *args)
+            # The period is unknown: the job checks it
+            self.specs.append(JobSpec(name, None, build))
         else:
             raise ValueError('Destination not set')
 
-    def run(self):
-        """ Run all jobs """
+    def due_jobs(self):
+        """ Return the names of the jobs to run now.
+        The dates of the last backups are read at once,
+        the jobs are not built.
+
+        :returns: list
+        """
+        if self.force:
+            return [spec.name for spec in self.specs]
+        last_backups = self.state.last_backups()
+        now = datetime.datetime.now()
+        return [spec.name for spec in self.specs
+                if spec.is_due(last_backups.get(spec.name), now)]
+
+    def _build_jobs(self, names=None):
+        """ Build the jobs declared by add_rsyncjob() and add_customjob()
+
+        :param names: names of the jobs to build, None for all
+        :returns: list -- the jobs, in the order they were added
+        """
+        from Vitalus.job import TARGETError
+        from Vitalus.ssh import SSHPool
+        from Vitalus.stats import StatsStore
+        if self.ssh_pool is None:
+            self.ssh_pool = SSHPool()
+        if self.stats is None:
+            # Statistics of the transfers, see StatsStore.trend()
+            self.stats = StatsStore(os.path.join(self.backup_log_dir, 'stats.db'))
+
+        jobs = []
+        for spec in self.specs:
+            if names is not None and spec.name not in names:
+                continue
+            if spec.job is None and spec.build is not None:
+                self.logger.debug("Build job: %s", spec.name)
+                try:
+                    spec.job = spec.build()
+                    # Job subclasses share the state store
+                    spec.job.state = self.state
+                    spec.job.events = self.events
+                    spec.job.metrics = self.metrics
+                    spec.job.tracer = self.tracer
+                except TARGETError as e:
+                    # We abort this job
+                    self.logger.error(e)
+                    spec.build = None
+                except:
+                    self.logger.exception('Exception raised in add_job()')
+                    spec.build = None
+            if spec.job is not None:
+                jobs.append(spec.job)
+        self.jobs = [spec.job for spec in self.specs if spec.job is not None]
+        return jobs
+
+    def _span(self, name, **args):
+        """ Return a context manager recording the span of a block
+        on the track of the run, if traced
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext(args)
+        return self.tracer.span(name, 'run', 'run', **args)
+
+    async def run_async(self, due=None):
+        """ Run the due jobs (coroutine)
+
+        :param due: names of the due jobs, None to compute them (see due_jobs())
+        :type due: list
+
+        .. note::
+            If the coroutine is cancelled, running subprocesses are killed.
+        """
+        if due is None:
+            due = self.due_jobs()
+        if due == []:
+            # Nothing is written: cron can call it often
+            return
+        import asyncio
+        from Vitalus import logs
+        from Vitalus.job import Target
+        from Vitalus.executor import JobExecutor
+        from Vitalus.trace import children_cpu
+        if self.tracer is not None:
+            trace_start = self.tracer.now()
+        cpu_start = (time.process_time(), children_cpu())
+        with self._span('start'):
+            self._start()
+        self.events.emit('run_start', version=__version__, jobs=due)
+        start = time.monotonic()
+        status = 'error'
         try:
-            for job in self.jobs:
-                job.run()
+            with self._span('build'):
+                jobs = self._build_jobs(due)
+            # Probe all SSH hosts at once
+            addresses = []
+            for job in jobs:
+                targets = [getattr(job, 'source', None), getattr(job, 'destination', None)]
+                targets.extend(mirror.destination for mirror in getattr(job, 'mirrors', []))
+                for target in targets:
+                    if isinstance(target, Target) and target.is_ssh():
+                        addresses.append(target.address())
+            with self._span('probe', hosts=len(set(addresses))):
+                await Target.availability.probe_all(addresses)
+
+            self.executor = JobExecutor(*self.concurrency)
+            self.executor.tracer = self.tracer
+            with self._span('jobs'):
+                await self.executor.run_async(jobs)
+            if self.purge:
+                # SSH destinations of the jobs not run are not listed
+                with self._span('purge'):
+                    await self.purge_trash_async(unknown=False)
             self._release_pidfile()
             self.logger.info('The script exited gracefully')
+            status = 'ok'
+        except asyncio.CancelledError:
+            self.logger.warning('Run cancelled')
+            status = 'cancelled'
+            raise
         except:
             self.logger.exception('Exception raised in run()')
+        finally:
+            # Shut down the shared SSH connections
+            with self._span('ssh close'):
+                await self.ssh_pool.close()
+            self.events.emit('run_end', status=status, duration=time.monotonic() - start)
+            if self.metrics is not None:
+                self.metrics.record_run({'status': status, 'duration': time.monotonic() - start,
+                                         'jobs': len(due), 'timestamp': time.time()})
+            # Write the logs of the jobs
+            with self._span('log flush'):
+                logs.flush()
+            if self.tracer is not None:
+                # CPU time of Vitalus and of the terminated subprocesses
+                self.tracer.complete('run', 'run', trace_start, category='run',
+                                     args={'status': status, 'jobs': due,
+                                           'cpu': time.process_time() - cpu_start[0],
+                                           'children_cpu': children_cpu() - cpu_start[1]})
+                self.tracer.write()
+
+    def run(self):
+        """ Run the due jobs
+
+        .. note::
+            When no job is due, it returns at once: no log,
+            no pidfile and the jobs are not built.
+        """
+        due = self.due_jobs()
+        if due == []:
+            return
+        import asyncio
+        asyncio.run(self.run_async(due))
+
+    async def disk_usage_async(self):
+        """ Return the disk usage of each job in the destination (coroutine)
+
+        :returns: dict -- job name: usage (see RsyncJob.disk_usage())
+        """
+        from Vitalus.job import TARGETError
+        usage = {}
+        for job in self._build_jobs():
+            if hasattr(job, 'disk_usage'):
+                try:
+                    usage[job.name] = await job.disk_usage()
+                except TARGETError as e:
+                    self.logger.warning(e)
+        return usage
+
+    def disk_usage(self):
+        """ Return the disk usage of each job in the destination,
+        the files shared by several snapshots are counted once.
+
+        :returns: dict -- job name: usage (size, allocated and files)
+        """
+        import asyncio
+
+        async def usage():
+            try:
+                return await self.disk_usage_async()
+            finally:
+                await self.ssh_pool.close()
+        return asyncio.run(usage())
+
+    async def purge_trash_async(self, unknown=True):
+        """ Delete the old snapshots moved to the trash by the jobs (coroutine)
+
+        :param unknown: also connect to the SSH destinations not listed by the jobs
+        :type unknown: bool
+
+        .. note::
+            The trash left by an interrupted run is also deleted.
+            Only the jobs already built are considered (see purge_trash()).
+        """
+        for job in self.jobs:
+            if hasattr(job, 'purge_trash'):
+                await job.purge_trash(self.purge_pause, unknown)
+
+    def purge_trash(self):
+        """ Delete the old snapshots moved to the trash by the jobs """
+        import asyncio
+        self._start()
+        self._build_jobs()
+
+        async def purge():
+            try:
+                await self.purge_trash_async()
+                self._release_pidfile()
+            finally:
+                await self.ssh_pool.close()
+        asyncio.run(purge())
 
 if __name__ == '__main__':
     #An example...
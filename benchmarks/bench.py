@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+"""
+Benchmarks of Vitalus, see benchmarks/README.md
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import argparse
+import datetime
+import tempfile
+import contextlib
+import subprocess
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import trees
+from Vitalus import history
+from Vitalus.history import FORMAT
+from Vitalus import utils
+from Vitalus.job import Target
+from Vitalus.rsyncjob import RsyncJob
+from Vitalus.vitalus import Vitalus
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+# Login of the SSH destinations, see bin/ssh
+SSH_LOGIN = 'bench@localhost'
+
+# Shared by the benchmarks: the loggers of the jobs are global
+LOG_DIR = None
+
+# name: (function(workdir, scale) returning (setup, run[, check]), default repeat)
+BENCHMARKS = {}
+
+
+def benchmark(name, repeat=5):
+    """
+    Register a benchmark.
+
+    The function prepares the data and returns two functions:
+    setup() is called before each measure (not timed),
+    run(state) is timed, state being the value returned by setup().
+    A third function check(state) may follow: it is called after
+    each measure (not timed) and raises if the run went wrong.
+    """
+    def register(function):
+        BENCHMARKS[name] = (function, repeat)
+        return function
+    return register
+
+
+def _scaled(value, scale):
+    return max(1, int(value * scale))
+
+
+def _quiet_run(vitalus):
+    """ Run, without the job names printed by the jobs """
+    with contextlib.redirect_stdout(io.StringIO()):
+        vitalus.run()
+
+
+def _next_second():
+    """ Wait for a new snapshot name (one per second) """
+    time.sleep(1 - datetime.datetime.now().microsecond / 1e6)
+
+
+def _new_job(destination, name, source='/nonexistent', keep=1, duration=0):
+    return RsyncJob(LOG_DIR, destination, name, source, 0,
+                    True, duration, keep, True, (None, None), None)
+
+
+# Hot spots
+
+@benchmark('history.older_keepmin', repeat=10)
+def bench_older_keepmin(workdir, scale):
+    names = trees.snapshot_names(_scaled(100000, scale))
+
+    def run(state):
+        history.older_keepmin(names, days=30, keep=10)
+    return None, run
+
+
+@benchmark('utils.get_last_file', repeat=10)
+def bench_get_last_file(workdir, scale):
+    names = trees.snapshot_names(_scaled(100000, scale)) + ['last']
+
+    def run(state):
+        utils.get_last_file(names)
+    return None, run
+
+
+@benchmark('utils.r_chown')
+def bench_r_chown(workdir, scale):
+    root = os.path.join(workdir, 'chown')
+    trees.tiny_files(root, _scaled(20000, scale))
+    trees.deep_tree(os.path.join(root, 'deep'), _scaled(200, scale))
+
+    def run(state):
+        # Same owner: the walk and the stats, no change
+        utils.r_chown(root, os.getuid(), os.getgid())
+    return None, run
+
+
+@benchmark('utils.get_folder_size')
+def bench_get_folder_size(workdir, scale):
+    job_dir = os.path.join(workdir, 'size', 'job')
+    trees.snapshot_history(job_dir, _scaled(20, scale), _scaled(5000, scale))
+
+    def run(state):
+        utils.get_folder_size(job_dir)
+    return None, run
+
+
+@benchmark('RsyncJob._delete_old_files')
+def bench_delete_old_files(workdir, scale):
+    destination = os.path.join(workdir, 'delete')
+    snapshots = _scaled(200, scale)
+    files = _scaled(50, scale)
+    counter = [0]
+
+    def setup():
+        # A new job each time: the snapshots are moved away by the run
+        counter[0] += 1
+        name = 'job%i' % counter[0]
+        trees.snapshot_history(os.path.join(destination, name), snapshots, files)
+        job = _new_job(destination, name)
+        asyncio.run(job._get_last_backup())
+        asyncio.run(job._prepare_destination())
+        return job
+
+    def run(job):
+        asyncio.run(job._delete_old_files())
+    return setup, run
+
+
+@benchmark('RsyncJob.purge_trash')
+def bench_purge_trash(workdir, scale):
+    destination = os.path.join(workdir, 'purge')
+    snapshots = _scaled(20, scale)
+    files = _scaled(2000, scale)
+    counter = [0]
+
+    def setup():
+        counter[0] += 1
+        name = 'job%i' % counter[0]
+        trees.snapshot_history(os.path.join(destination, name), snapshots, files)
+        job = _new_job(destination, name)
+        asyncio.run(job._get_last_backup())
+        asyncio.run(job._prepare_destination())
+        asyncio.run(job._delete_old_files())
+        return job
+
+    def run(job):
+        asyncio.run(job.purge_trash())
+    return setup, run
+
+
+# Full runs
+
+def _vitalus(workdir, destination, sources, history=True, force=True, period=0):
+    vitalus = Vitalus(log_path=LOG_DIR, force=force)
+    vitalus.set_destination(destination)
+    for name, source in sources:
+        vitalus.add_rsyncjob(name, source, period=period, history=history, keep=3, duration=0)
+    return vitalus
+
+
+def _check_run(vitalus, path, name, since):
+    """
+    Check that a job succeeded and made its snapshot:
+    Vitalus.run() logs the errors, it does not raise them
+
+    :param path: local path of the destination
+    :param since: date before the run
+    """
+    runs = vitalus.state.runs(name, 1)
+    if runs == [] or runs[-1]['start'] < since:
+        raise RuntimeError('Job %s not run' % name)
+    if runs[-1]['status'] != 'success':
+        raise RuntimeError('Job %s ended with the status %s' % (name, runs[-1]['status']))
+    snapshot = os.path.join(path, name, runs[-1]['start'].strftime(FORMAT))
+    if not os.path.isdir(snapshot):
+        raise RuntimeError('No snapshot %s' % snapshot)
+
+
+def full_run(name, create, ssh=False):
+    """
+    Register two benchmarks of Vitalus.run() for a job: the first copy
+    of the source, and a run with nothing to transfer.
+    Each run is checked (status and snapshot).
+
+    :param name: beginning of the benchmark names
+    :param create: function(root, scale) creating the source
+    :param ssh: use a SSH destination (see bin/ssh)
+    """
+    def prepare(workdir, source, path):
+        # A local destination must exist
+        os.makedirs(path, exist_ok=True)
+        _next_second()
+        target = '%s:%s' % (SSH_LOGIN, path) if ssh else path
+        return _vitalus(workdir, target, [('job', source)]), path, datetime.datetime.now()
+
+    def run(state):
+        _quiet_run(state[0])
+
+    def check(state):
+        _check_run(state[0], state[1], 'job', state[2])
+
+    def first_copy(workdir, scale):
+        source = os.path.join(workdir, 'src')
+        create(source, scale)
+        counter = [0]
+
+        def setup():
+            # A new destination each time: everything is copied
+            counter[0] += 1
+            return prepare(workdir, source, os.path.join(workdir, 'dst%i' % counter[0]))
+        return setup, run, check
+
+    def no_change(workdir, scale):
+        source = os.path.join(workdir, 'src')
+        create(source, scale)
+        path = os.path.join(workdir, 'dst')
+        # First copy, not measured
+        state = prepare(workdir, source, path)
+        run(state)
+        check(state)
+
+        def setup():
+            return prepare(workdir, source, path)
+        return setup, run, check
+
+    benchmark(name + ', first copy', repeat=3)(first_copy)
+    benchmark(name + ', no change', repeat=3)(no_change)
+
+
+full_run('Vitalus.run local tiny files',
+         lambda root, scale: trees.tiny_files(root, _scaled(20000, scale)))
+full_run('Vitalus.run local huge files',
+         lambda root, scale: trees.huge_files(root, 3, _scaled(200 << 20, scale)))
+full_run('Vitalus.run local deep tree',
+         lambda root, scale: trees.deep_tree(root, _scaled(300, scale)))
+full_run('Vitalus.run ssh tiny files',
+         lambda root, scale: trees.tiny_files(root, _scaled(20000, scale)), ssh=True)
+
+
+@benchmark('Vitalus.run nothing due', repeat=20)
+def bench_run_nothing_due(workdir, scale):
+    source = os.path.join(workdir, 'src_due')
+    os.makedirs(source)
+    jobs = [('due%i' % number, source) for number in range(50)]
+    vitalus = _vitalus(workdir, os.path.join(workdir, 'dst_due'), jobs, force=False, period=3600)
+    for name, source in jobs:
+        vitalus.state.set_last_backup(name, datetime.datetime.now())
+
+    def setup():
+        return _vitalus(workdir, os.path.join(workdir, 'dst_due'), jobs, force=False, period=3600)
+    return setup, _quiet_run
+
+
+def measure(name, workdir, scale, repeat=None):
+    """
+    Run a benchmark
+
+    :returns: dict -- min, median (seconds) and repeat
+    """
+    function, default_repeat = BENCHMARKS[name]
+    if repeat is None:
+        repeat = default_repeat
+    functions = function(workdir, scale)
+    setup, run = functions[:2]
+    check = functions[2] if len(functions) > 2 else None
+    times = []
+    for number in range(repeat):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+        if check is not None:
+            check(state)
+    return {'min': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+
+def environment():
+    """
+    Return a description of the machine and of rsync
+    """
+    try:
+        rsync = subprocess.run(['/usr/bin/rsync', '--version'], stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL).stdout.decode().splitlines()[0]
+    except (OSError, IndexError):
+        rsync = None
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'rsync': rsync}
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the results and their ratio to the baseline
+
+    :returns: list -- names of the benchmarks slower than threshold * baseline
+    """
+    regressions = []
+    print('%-44s %10s %10s %10s' % ('benchmark', 'min (s)', 'baseline', 'ratio'))
+    for name, result in results.items():
+        reference = baseline.get('results', {}).get(name)
+        if reference is None:
+            print('%-44s %10.4f %10s %10s' % (name, result['min'], '-', '-'))
+            continue
+        ratio = result['min'] / reference['min']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-44s %10.4f %10.4f %10.2f%s' % (name, result['min'], reference['min'],
+                                                 ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    global LOG_DIR
+    parser = argparse.ArgumentParser(description='Benchmarks of Vitalus')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (substring of the names), default: all')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiply the sizes of the trees (e.g. 0.1 for a quick run)')
+    parser.add_argument('--repeat', type=int, help='measures per benchmark')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='ratio to the baseline above which a benchmark regressed')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print('\n'.join(BENCHMARKS))
+        return 0
+    names = [name for name in BENCHMARKS
+             if not args.names or any(pattern in name for pattern in args.names)]
+
+    # SSH destinations are run locally by bin/ssh,
+    # no SSH server to probe
+    os.environ['PATH'] = os.path.join(HERE, 'bin') + os.pathsep + os.environ['PATH']
+    Target.availability._set(('localhost', 22), True)
+    Target.availability.ttl = float('inf')
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='vitalus-bench-')
+    LOG_DIR = os.path.join(workdir, 'log')
+    try:
+        for name in names:
+            directory = os.path.join(workdir, str(len(results)))
+            os.mkdir(directory)
+            results[name] = measure(name, directory, args.scale, args.repeat)
+            # The trees are not needed anymore
+            subprocess.run(['rm', '-rf', directory])
+    finally:
+        subprocess.run(['rm', '-rf', workdir])
+
+    try:
+        with open(args.baseline) as baseline:
+            baseline = json.load(baseline)
+    except (OSError, ValueError):
+        baseline = {}
+    if baseline and baseline.get('scale') != args.scale:
+        print('Baseline measured with scale %s, ratios are not meaningful' % baseline.get('scale'))
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        # The benchmarks not run keep their baseline
+        if baseline.get('scale') == args.scale:
+            baseline['results'].update(results)
+        else:
+            baseline = {'scale': args.scale, 'results': results}
+        baseline.update({'date': datetime.datetime.now().isoformat(),
+                         'environment': environment()})
+        with open(args.baseline, 'w') as output:
+            json.dump(baseline, output, indent=2, sort_keys=True)
+        print('Baseline saved in %s' % args.baseline)
+    if regressions:
+        print('Regressions: %s' % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Author: Francois Boulogne <fboulogne at sciunto dot org>, 2012
+
+"""
+Synthetic trees for the benchmarks.
+
+The content only depends on the arguments (fixed seeds),
+so that two machines benchmark the same trees.
+"""
+
+import os
+import random
+import datetime
+
+from Vitalus.history import FORMAT
+
+# Entries per directory for the trees of many files
+FANOUT = 1000
+CHUNK = 1 << 20
+
+
+def tiny_files(root, count, size=100, seed=0):
+    """
+    Create many small files, FANOUT per directory
+
+    :param root: directory, created
+    :param count: number of files
+    :param size: size of each file (bytes)
+    :returns: list of the file paths
+    """
+    generator = random.Random(seed)
+    paths = []
+    for number in range(count):
+        directory = os.path.join(root, 'd%04i' % (number // FANOUT))
+        if number % FANOUT == 0:
+            os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'f%06i' % number)
+        with open(path, 'wb') as output:
+            output.write(generator.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+def huge_files(root, count, size, seed=0):
+    """
+    Create a few large files of incompressible data
+
+    :param root: directory, created
+    :param count: number of files
+    :param size: size of each file (bytes)
+    :returns: list of the file paths
+    """
+    generator = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    paths = []
+    for number in range(count):
+        path = os.path.join(root, 'huge%02i.bin' % number)
+        with open(path, 'wb') as output:
+            written = 0
+            while written < size:
+                chunk = generator.randbytes(min(CHUNK, size - written))
+                output.write(chunk)
+                written += len(chunk)
+        paths.append(path)
+    return paths
+
+
+def deep_tree(root, depth, files=2, size=10):
+    """
+    Create a chain of nested directories, with a few files at each level
+
+    :param root: directory, created
+    :param depth: number of nested directories
+    :param files: files per level
+    :param size: size of each file (bytes)
+    """
+    path = root
+    os.makedirs(path, exist_ok=True)
+    for level in range(depth):
+        for number in range(files):
+            with open(os.path.join(path, 'f%i' % number), 'wb') as output:
+                output.write(b'x' * size)
+        path = os.path.join(path, 'l%i' % level)
+        # os.makedirs() is recursive
+        os.mkdir(path)
+
+
+def snapshot_names(count, end=None, step=3600):
+    """
+    Return snapshot names, one every "step" seconds until "end"
+
+    :param count: number of names
+    :param end: date of the last snapshot (default: now)
+    :param step: seconds between two snapshots
+    :returns: list
+    """
+    if end is None:
+        end = datetime.datetime.now()
+    return [(end - datetime.timedelta(seconds=step * number)).strftime(FORMAT)
+            for number in reversed(range(count))]
+
+
+def snapshot_history(job_dir, snapshots, files, changed=0.05, size=100, step=3600, seed=0):
+    """
+    Create the snapshots of a job as rsync --link-dest does:
+    the unchanged files are hardlinks to the previous snapshot.
+
+    :param job_dir: job directory in the destination, created
+    :param snapshots: number of snapshots
+    :param files: files per snapshot
+    :param changed: part of the files changed between two snapshots
+    :param size: size of each file (bytes)
+    :param step: seconds between two snapshots, the last one is a step ago
+    :returns: list of the snapshot names
+    """
+    generator = random.Random(seed)
+    names = snapshot_names(snapshots, datetime.datetime.now() - datetime.timedelta(seconds=step),
+                           step)
+    previous = None
+    for name in names:
+        snapshot = os.path.join(job_dir, name)
+        for number in range(files):
+            directory = os.path.join(snapshot, 'd%04i' % (number // FANOUT))
+            if number % FANOUT == 0:
+                os.makedirs(directory)
+            path = os.path.join(directory, 'f%06i' % number)
+            if previous is not None and generator.random() >= changed:
+                os.link(os.path.join(previous, os.path.relpath(path, snapshot)), path)
+            else:
+                with open(path, 'wb') as output:
+                    output.write(generator.randbytes(size))
+        previous = snapshot
+    os.symlink(names[-1], os.path.join(job_dir, 'last'))
+    return names
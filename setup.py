@@ -13,6 +13,7 @@ setup(
     author_email = info.EMAIL,
     description  = info.SHORT_DESCRIPTION,
     packages     = find_packages(),
+    python_requires = '>=3.7',
     scripts      = [],
     #test_suite   = "nose.collector",
 )